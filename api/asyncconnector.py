@@ -0,0 +1,279 @@
+import asyncio
+import json as jsonlib
+import aiohttp
+from datetime import datetime
+from os import makedirs
+from os.path import dirname, getsize, isfile, realpath
+from time import perf_counter, time
+from typing import Callable
+
+from chilitools.api import asyncendpoints
+from chilitools.api.connector import ChiliConnector, _getCachedAPIKey, _storeAPIKey
+from chilitools.api.response import ChiliResponse
+from chilitools.api.retry import RetryPolicy
+from chilitools.utilities.defaults import DEFAULT_CHUNKSIZE, DEFAULT_RESPONSEPARSER
+from chilitools.utilities.metrics import RequestMetrics
+from chilitools.utilities.file import _rangeValidator
+
+
+class _AsyncResponse:
+    """Holds a fully read aiohttp response with the attributes ChiliResponse expects from a requests.Response"""
+    def __init__(self, response: aiohttp.ClientResponse, content: bytes):
+        self.status_code = response.status
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.content = content
+        self.encoding = response.get_encoding()
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors='replace')
+
+    def json(self):
+        return jsonlib.loads(self.text)
+
+
+class AsyncChiliConnector(ChiliConnector):
+    def __init__(self, backofficeURL: str, logger = None, forceKeyRegen: bool = False, username: str = None, password: str = None, apiVersion: str = '1.2', debugLevel = 1, retryPolicy: RetryPolicy = None, maxConcurrency: int = 20, poolSize: int = 100, keepAlive: float = 30, metrics: RequestMetrics = None):
+        super().__init__(backofficeURL=backofficeURL, logger=logger, forceKeyRegen=forceKeyRegen, username=username, password=password, apiVersion=apiVersion, debugLevel=debugLevel, retryPolicy=retryPolicy, metrics=metrics)
+
+        # The aiohttp session has to be created inside a running event loop so it is created on the first request
+        self.session = None
+        self.maxConcurrency = maxConcurrency
+        self.poolSize = poolSize
+        self.keepAlive = keepAlive
+        self._semaphore = None
+        self._apiKeyLock = None
+
+        # Endpoints
+        self.resources = asyncendpoints.AsyncResources(self)
+        self.system = asyncendpoints.AsyncSystem(self)
+        self.documents = asyncendpoints.AsyncDocuments(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _getSession(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.poolSize, limit_per_host=self.poolSize, keepalive_timeout=self.keepAlive)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.maxConcurrency)
+        return self.session
+
+    async def makeRequest(self, method: str, endpoint: str, headers: dict = None, queryParams: dict = None, json: dict = None, authRequired: bool = True, parser: str = DEFAULT_RESPONSEPARSER, data = None) -> ChiliResponse:
+
+        requestURL = self.requestURL + endpoint
+
+        requestHeaders = { "accept":"*/*" }
+
+        # Get API key if Auth is required
+        if authRequired:
+            apiKey = await self.getAPIKey()
+            requestHeaders['API-KEY'] = apiKey
+
+        if headers is not None:
+            for header, value in headers.items():
+                requestHeaders[header] = value
+
+        # aiohttp only accepts strings and numbers, match what requests does with None and bools
+        requestQueryParams = {}
+
+        if queryParams is not None:
+            for param, value in queryParams.items():
+                if value is not None:
+                    requestQueryParams[param] = str(value)
+
+        method = method.lower()
+
+        # aiohttp can't work out the length of file-like bodies on its own
+        if data is not None and hasattr(data, '__len__'):
+            requestHeaders['Content-Length'] = str(len(data))
+
+        # Request body size for the metrics, aiohttp serializes json the same way
+        if data is not None:
+            bytesOut = len(data) if hasattr(data, '__len__') else 0
+        else:
+            bytesOut = len(jsonlib.dumps(json)) if json is not None else 0
+
+        session = self._getSession()
+        attempt = 0
+        while True:
+            # Streaming bodies have to be rewound before they can be sent again
+            if attempt > 0 and hasattr(data, 'seek'):
+                data.seek(0)
+            try:
+                async with self._semaphore:
+                    start = perf_counter()
+                    async with session.request(method=method, url=requestURL, headers=requestHeaders, params=requestQueryParams, json=json, data=data) as resp:
+                        content = await resp.read()
+                    self.metrics.record(method, endpoint, resp.status, perf_counter() - start, bytesOut=bytesOut, bytesIn=len(content))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.metrics.record(method, endpoint, e.__class__.__name__, perf_counter() - start, bytesOut=bytesOut)
+                if not self.retryPolicy.shouldRetry(method, attempt):
+                    raise
+                backoff = self.retryPolicy.getBackoff(attempt)
+                self._displayMsg(f"AsyncChiliConnector: {method.upper()} {endpoint} failed with {e.__class__.__name__}, retrying in {backoff:.2f}s ({attempt + 1}/{self.retryPolicy.maxRetries})")
+            else:
+                if not self.retryPolicy.shouldRetry(method, attempt, resp.status):
+                    break
+                backoff = self.retryPolicy.getBackoff(attempt, resp.headers.get('Retry-After'))
+                self._displayMsg(f"AsyncChiliConnector: {method.upper()} {endpoint} returned {resp.status}, retrying in {backoff:.2f}s ({attempt + 1}/{self.retryPolicy.maxRetries})")
+            # Sleep outside of the semaphore so waiting retries don't hold a slot
+            await asyncio.sleep(backoff)
+            attempt += 1
+
+        response = ChiliResponse(_AsyncResponse(resp, content), parser=parser)
+
+        if self.debugLevel == 2:
+            request = {'url':requestURL, 'method':method, 'headers':requestHeaders, 'queryParams':requestQueryParams, 'body':json}
+            self._displayMsg({'request':request, 'response':response.text})
+
+        return response
+
+    async def downloadToFile(self, endpoint: str, target, queryParams: dict = None, authRequired: bool = True, resume: bool = False, progress: Callable = None, chunkSize: int = DEFAULT_CHUNKSIZE) -> dict:
+        """Async version of ChiliConnector.downloadToFile, streams the body to a file path or binary file object"""
+        requestHeaders = { "accept":"*/*" }
+        if authRequired:
+            requestHeaders['API-KEY'] = await self.getAPIKey()
+
+        requestQueryParams = {}
+        if queryParams is not None:
+            for param, value in queryParams.items():
+                if value is not None:
+                    requestQueryParams[param] = str(value)
+
+        if isinstance(target, str):
+            makedirs(dirname(realpath(target)), exist_ok=True)
+            offset = getsize(target) if resume and isfile(target) else 0
+            file = open(target, 'ab' if offset > 0 else 'wb')
+        else:
+            file = target
+            offset = 0
+        start = file.tell() - offset if file.seekable() else None
+
+        resumed = offset > 0
+        validator = None
+        downloaded = 0
+        attempt = 0
+        startTime = time()
+        session = self._getSession()
+        try:
+            while True:
+                requestHeaders.pop('If-Range', None)
+                if offset > 0:
+                    requestHeaders['Range'] = f"bytes={offset}-"
+                    if validator is not None: requestHeaders['If-Range'] = validator
+                else:
+                    requestHeaders.pop('Range', None)
+                attemptStart = perf_counter()
+                attemptBytes = 0
+                status = None
+                try:
+                    async with self._semaphore:
+                        async with session.get(url=self.requestURL + endpoint, params=requestQueryParams, headers=requestHeaders) as resp:
+                            status = resp.status
+                            # The partial file is already complete
+                            if resp.status == 416 and offset > 0:
+                                break
+                            if self.retryPolicy.shouldRetry('get', attempt, resp.status):
+                                backoff = self.retryPolicy.getBackoff(attempt, resp.headers.get('Retry-After'))
+                            else:
+                                backoff = None
+                                resp.raise_for_status()
+                                validator = _rangeValidator(resp.headers)
+                                if resp.status != 206 and offset > 0:
+                                    # The server ignored the Range header or the file changed, start over from the beginning
+                                    if start is None:
+                                        raise IOError(f"The server does not support resuming and {target} can not be rewound")
+                                    file.seek(start)
+                                    file.truncate()
+                                    offset = 0
+
+                                total = offset + resp.content_length if resp.content_length is not None else None
+                                async for chunk in resp.content.iter_chunked(chunkSize):
+                                    file.write(chunk)
+                                    offset += len(chunk)
+                                    downloaded += len(chunk)
+                                    attemptBytes += len(chunk)
+                                    if progress is not None:
+                                        progress(offset, total, downloaded / max(time() - startTime, 1e-6))
+                    if backoff is None:
+                        break
+                except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                    status = e.__class__.__name__
+                    if not self.retryPolicy.shouldRetry('get', attempt):
+                        raise
+                    if validator is None and offset > 0 and not resume:
+                        # Nothing tells us the file is still the same, appending to what we have could mix two versions
+                        if start is None:
+                            raise
+                        file.seek(start)
+                        file.truncate()
+                        offset = 0
+                    else:
+                        resumed = resumed or offset > 0
+                    backoff = self.retryPolicy.getBackoff(attempt)
+                except Exception as e:
+                    if status is None: status = e.__class__.__name__
+                    raise
+                finally:
+                    self.metrics.record('get', endpoint, status, perf_counter() - attemptStart, bytesIn=attemptBytes)
+                await asyncio.sleep(backoff)
+                attempt += 1
+        finally:
+            if isinstance(target, str): file.close()
+
+        seconds = time() - startTime
+        return {'bytes':downloaded, 'seconds':seconds, 'bytesPerSecond':downloaded / max(seconds, 1e-6), 'resumed':resumed}
+
+    async def getAPIKey(self) -> str:
+        if self.forceKeyRegen:
+            self._displayMsg("AsyncChiliConnector: Forcing a new API key to be generated")
+            apiKey = await self._generateAPIKey()
+            return apiKey['key'] if apiKey else None
+
+        apiKey = _getCachedAPIKey(self.backofficeURL)
+        if apiKey is not None and datetime.now() < apiKey['validTill']:
+            return apiKey['key']
+
+        # Only one coroutine generates a key, the rest of the fan out waits here and reuses it
+        if self._apiKeyLock is None:
+            self._apiKeyLock = asyncio.Lock()
+        async with self._apiKeyLock:
+            apiKey = _getCachedAPIKey(self.backofficeURL)
+            if apiKey is not None and datetime.now() < apiKey['validTill']:
+                return apiKey['key']
+
+            self._displayMsg(f"AsyncChiliConnector: Key not found or expired for {self.backofficeURL}, generating one...")
+            apiKey = await self._generateAPIKey()
+            if apiKey is None:
+                return None
+            _storeAPIKey(self.backofficeURL, apiKey['key'], apiKey['validTill'])
+            return apiKey['key']
+
+    async def _generateAPIKey(self) -> dict:
+        # There is no interactive credential prompt here, it would block the event loop
+        keyResp = await self.system.GenerateApiKey(username=self.username, password=self.password)
+        if not keyResp.success:
+            self._displayMsg(f"AsyncChiliConnector: There was an issue connecting to the environment: {keyResp.text}", error=True)
+            return None
+
+        key = keyResp.content['apiKey']
+        if key.get("@succeeded") == "false" or "@key" not in key.keys():
+            self._displayMsg(f"AsyncChiliConnector: There was an issue authenticating with CHILI: {key.get('@errorMessage', key)}", error=True)
+            return None
+
+        validTill = datetime.fromisoformat(key['@validTill'].replace(' ', 'T').replace('Z', ''))
+        self._displayMsg(f"AsyncChiliConnector: Successfully generated API key for {self.backofficeURL}")
+        return {'key':key['@key'], 'validTill':validTill}
+
+    def __str__(self) -> str:
+        return f'AsyncChiliConnector(backofficeURL={self.backofficeURL}, environment={self.environment}, baseURL={self.baseURL}, requestURL={self.requestURL})'
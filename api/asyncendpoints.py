@@ -0,0 +1,186 @@
+from __future__ import annotations
+import asyncio
+from collections import deque
+from typing import TYPE_CHECKING, OrderedDict
+if TYPE_CHECKING:
+    from chilitools.api.asyncconnector import AsyncChiliConnector
+    from chilitools.api.response import ChiliResponse
+
+from chilitools.api.endpoints import Resources, Documents, System
+from chilitools.utilities.defaults import DEFAULT_TASKPRIORITY, DEFAULT_TASKUPDATETIME, PARSER_NONE
+from chilitools.utilities.document import FrameProbe, FrameFound
+
+# The plain endpoint methods are inherited as is, they return the coroutine from
+# AsyncChiliConnector.makeRequest so they can be awaited directly.
+# Only the helpers that chain multiple requests are overridden here.
+
+class AsyncResources(Resources):
+  def __init__(self, connector: AsyncChiliConnector):
+    super().__init__(connector)
+
+  async def AsyncResourceGetTreeLevel(self, resourceType: str, parentFolder: str = '', numLevels: int = 1, includeSubDirectories: bool = True, includeFiles: bool = True) -> ChiliResponse:
+    return await self.ResourceGetTreeLevel(resourceType, parentFolder, numLevels, includeSubDirectories, includeFiles)
+
+  async def doesItemExist(self, resourceType: str, itemID: str) -> bool:
+    res = await self.ResourceItemGetDefinitionXML(resourceType, itemID, parser=PARSER_NONE)
+    if res.statusCode == 404:
+      return False
+    return True
+
+  async def getItemIDs(self, resourceType: str, folder: str = '') -> set:
+    resp = await self.ResourceGetTreeLevel(
+      resourceType=resourceType,
+      parentFolder=folder,
+      numLevels=-1,
+      includeSubDirectories=True,
+      includeFiles=True,
+      parser=PARSER_NONE
+    )
+    if not resp.success:
+      raise IOError(f"There was an issue getting the {resourceType} tree: {resp.text}")
+    return set(resp.xml.xpath("//item[not(@isFolder='true')]/@id"))
+
+  async def get_name_if_exists(self, resourceType: str, itemID: str):
+    res = await self.ResourceItemGetDefinitionXML(resourceType, itemID)
+    if res.statusCode == 404:
+      return False
+    if resourceType.lower() == "fonts":
+      return res.content["item"]["@relativePath"].split("\\")[-1]
+
+    return res.content["item"]["@name"]
+
+  async def getDownloadURL(self, resourceType: str, itemID: str, downloadType: str = "original", pageNum: int = 1) -> str:
+    apiKey = await self.connector.getAPIKey()
+    return f"{self.connector.baseURL}{self.connector.environment}/download.aspx?type={downloadType}&resourceName={resourceType}&id={itemID}&apiKey={apiKey}&pageNum={pageNum}"
+
+  async def getFullResourceTree(self, resourceType: str, folder: str = '', workers: int = 8) -> dict:
+    tree = {folder: {}}
+    async for parentFolder, item in self._crawlTree(resourceType, folder, workers):
+      if item['@isFolder'] == 'true':
+        tree[item['@path']] = tree[parentFolder][item['@name']] = {}
+      else:
+        tree[parentFolder][item['@name']] = item
+    return tree[folder]
+
+  async def get_items_in_tree(self, resourceType: str, folder: str = '', workers: int = 8) -> list:
+    return [item async for item in self.iterTreeItems(resourceType, folder=folder, workers=workers)]
+
+  async def iterTreeItems(self, resourceType: str, folder: str = '', workers: int = 8, includeFolders: bool = False):
+    async for _, item in self._crawlTree(resourceType, folder, workers):
+      if includeFolders or item['@isFolder'] != 'true':
+        yield item
+
+  async def _getTreeLevelItems(self, resourceType: str, folder: str) -> list:
+    resp = await self.ResourceGetTreeLevel(
+      resourceType=resourceType,
+      parentFolder=folder,
+      numLevels=1,
+      includeSubDirectories=True,
+      includeFiles=True
+    )
+    if not resp.success:
+      raise IOError(f"There was an issue getting the {resourceType} tree level for {folder}: {resp.text}")
+    items = resp.content['tree'].get('item')
+    if items is None:
+      return []
+    if not isinstance(items, list):
+      items = [items]
+    return items
+
+  async def _crawlTree(self, resourceType: str, folder: str, workers: int):
+    # Folders waiting for a free worker are kept in a queue so only `workers` requests are in flight
+    queued = deque([folder])
+    pending = {}
+    try:
+      def startQueued():
+        while queued and len(pending) < workers:
+          path = queued.popleft()
+          pending[asyncio.ensure_future(self._getTreeLevelItems(resourceType, path))] = path
+
+      while queued or pending:
+        startQueued()
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+          parentFolder = pending.pop(task)
+          items = task.result()
+          # Request the subfolders before yielding, the consumer can take its time with every item
+          queued.extend(item['@path'] for item in items if item['@isFolder'] == 'true')
+          startQueued()
+          for item in items:
+            yield parentFolder, item
+    finally:
+      for task in pending:
+        task.cancel()
+
+
+class AsyncDocuments(Documents):
+  def __init__(self, connector: AsyncChiliConnector):
+    super().__init__(connector)
+
+  async def _getSettingsXML(self, settingsXML: str, settingsID: str) -> str:
+    if settingsID is not None:
+      return (await self.connector.resources.getPDFSettingsXML(settingsID=settingsID, parser=PARSER_NONE)).text
+    return settingsXML
+
+  async def createPDF(self, documentID: str, settingsXML: str = None, settingsID: str = None, taskPriority: int = DEFAULT_TASKPRIORITY) -> ChiliResponse:
+    if settingsID is None and settingsXML is None:
+      return
+    settingsXML = await self._getSettingsXML(settingsXML, settingsID)
+    return await super().createPDF(documentID=documentID, settingsXML=settingsXML, taskPriority=taskPriority)
+
+  async def createTempPDF(self, documentXML: str, settingsXML: str = None, settingsID: str = None, itemID: str = None, taskPriority: int = DEFAULT_TASKPRIORITY) -> ChiliResponse:
+    if settingsID is None and settingsXML is None:
+      return
+    settingsXML = await self._getSettingsXML(settingsXML, settingsID)
+    return await super().createTempPDF(documentXML=documentXML, settingsXML=settingsXML, itemID=itemID, taskPriority=taskPriority)
+
+  async def createImages(self, documentID: str, imageConversionProfileID: str, settingsXML: str = None, settingsID: str = None, taskPriority: int = DEFAULT_TASKPRIORITY) -> ChiliResponse:
+    if settingsID is None and settingsXML is None:
+      return
+    settingsXML = await self._getSettingsXML(settingsXML, settingsID)
+    return await super().createImages(documentID=documentID, imageConversionProfileID=imageConversionProfileID, settingsXML=settingsXML, taskPriority=taskPriority)
+
+  async def createTempImages(self, imageConversionProfileID: str, documentID: str = None, documentXML: str = '', settingsXML: str = None, settingsID: str = None, taskPriority: int = DEFAULT_TASKPRIORITY) -> ChiliResponse:
+    if settingsID is None and settingsXML is None:
+      return
+    if documentID is None and documentXML is None:
+      return
+    settingsXML = await self._getSettingsXML(settingsXML, settingsID)
+    return await super().createTempImages(imageConversionProfileID=imageConversionProfileID, documentID=documentID, documentXML=documentXML, settingsXML=settingsXML, taskPriority=taskPriority)
+
+  async def probeIsBlank(self, documentID: str) -> bool:
+    try:
+      await self.connector.resources.ResourceItemGetXMLToFile(resourceType="documents", itemID=documentID, target=FrameProbe())
+    except FrameFound:
+      return False
+    return True
+
+
+class AsyncSystem(System):
+  def __init__(self, connector: AsyncChiliConnector):
+    super().__init__(connector)
+
+  @property
+  def taskWaiter(self):
+    # The TaskWaiter polls from a thread with blocking requests, tasks are awaited on the event loop instead
+    raise NotImplementedError("The AsyncChiliConnector has no TaskWaiter, await system.waitForTask or system.waitForTasks instead")
+
+  async def waitForTask(self, taskID: str, taskUpdateTime: int = DEFAULT_TASKUPDATETIME, debug: bool = False) -> OrderedDict:
+    while True:
+      resp = (await self.getTaskStatus(taskID=taskID)).contentAsDict()
+      taskStatus = resp['task']['@finished']
+      if debug: print(f"Polled Task: Current Status: {taskStatus}")
+      if taskStatus == "True":
+        return resp
+      await asyncio.sleep(taskUpdateTime)
+
+  async def waitForTasks(self, taskIDs: list, taskUpdateTime: int = DEFAULT_TASKUPDATETIME, timeout: float = None) -> dict:
+    """Waits on a batch of tasks, returns a dict of taskID to the finished task or the exception if it failed or timed out"""
+    waits = [asyncio.wait_for(self.waitForTask(taskID=taskID, taskUpdateTime=taskUpdateTime), timeout) for taskID in taskIDs]
+    return dict(zip(taskIDs, await asyncio.gather(*waits, return_exceptions=True)))
+
+  async def GenerateApiKey(self, username: str = None, password: str = None) -> ChiliResponse:
+    # Looking up stored credentials can make blocking requests for staff logins
+    if not username or not password:
+      username, password = await asyncio.get_running_loop().run_in_executor(None, self._getLogin, username, password)
+    return await super().GenerateApiKey(username=username, password=password)
@@ -0,0 +1,170 @@
+import re
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from requests import Response
+
+from chilitools.utilities.defaults import DEFAULT_CACHE_MAXENTRIES, DEFAULT_CACHE_TTL, RESOURCE_PATH_KEYWORDS
+
+_resourcePath = re.compile(r'^/resources/([^/]+)(?:/items)?(?:/([^/]+))?')
+# Requests that are not GET but don't change anything, ex: rendering a PDF
+_readOnlyEndpoint = re.compile(r'/(representations|tempxml)/[^/]+$')
+
+
+class CacheRule:
+    """Caching settings for the GET endpoints matching a template like `/resources/{resourceType}/items/{itemID}/xml`
+
+    :param endpoint: Endpoint template, every {name} matches one path segment
+    :param ttl: Seconds a response is served from the cache without asking the server
+    :param revalidate: Once the TTL is over, ask the server with If-None-Match/If-Modified-Since instead of downloading it again
+    """
+    def __init__(self, endpoint: str, ttl: float = DEFAULT_CACHE_TTL, revalidate: bool = True):
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.pattern = re.compile('^' + re.sub(r'\\\{[^}]+\\\}', '[^/]+', re.escape(endpoint)) + '$')
+
+    def matches(self, endpoint: str) -> bool:
+        return self.pattern.match(endpoint) is not None
+
+    def __repr__(self) -> str:
+        return f'CacheRule(endpoint={self.endpoint}, ttl={self.ttl}, revalidate={self.revalidate})'
+
+
+DEFAULT_CACHE_RULES = [
+    CacheRule('/resources/PdfExportSettings/items/{itemID}/xml', ttl=3600),
+    CacheRule('/resources/{resourceType}/items/{itemID}/xml'),
+    CacheRule('/resources/{resourceType}/items/{itemID}/definitionxml'),
+]
+
+
+class _CacheEntry:
+    def __init__(self, response: Response, rule: CacheRule, item: tuple):
+        self.response = response
+        self.rule = rule
+        self.item = item
+        self.expires = monotonic() + rule.ttl
+        self.etag = response.headers.get('ETag')
+        self.lastModified = response.headers.get('Last-Modified')
+
+    @property
+    def fresh(self) -> bool:
+        return monotonic() < self.expires
+
+    def conditionalHeaders(self) -> dict:
+        headers = {}
+        if self.etag: headers['If-None-Match'] = self.etag
+        if self.lastModified: headers['If-Modified-Since'] = self.lastModified
+        return headers
+
+
+class ResponseCache:
+    """Opt-in LRU cache of GET responses for a ChiliConnector, pass it as `cache=ResponseCache()`.
+
+    Only endpoints matching one of the rules are cached, the first matching rule wins. Responses are kept until their
+    TTL is over, after that they are revalidated with the ETag/Last-Modified the server sent (if any) so an unchanged
+    item only costs a 304. Any other request the connector makes to a resource item (save, replace file, move, delete...)
+    drops the cached responses for that item, writes without an item ID (add, folder changes) drop the whole resource type.
+
+    :param rules: List of CacheRule, defaults to item XML, definition XML and PDF export settings
+    :param maxEntries: Maximum amount of responses kept, the least recently used one is dropped first
+    """
+    def __init__(self, rules: list = None, maxEntries: int = DEFAULT_CACHE_MAXENTRIES):
+        self.rules = rules if rules is not None else list(DEFAULT_CACHE_RULES)
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = Lock()
+
+    def getRule(self, endpoint: str) -> CacheRule:
+        for rule in self.rules:
+            if rule.matches(endpoint):
+                return rule
+        return None
+
+    def lookup(self, endpoint: str, queryParams: dict = None) -> tuple:
+        """Returns (key, entry) for a GET request. The key is None if the endpoint isn't cached, the entry is None on a miss.
+        An entry that is not `fresh` anymore has to be revalidated with its `conditionalHeaders()`
+        """
+        if self.getRule(endpoint) is None:
+            return None, None
+        key = (endpoint.lower(), tuple(sorted((k, str(v)) for k, v in (queryParams or {}).items() if v is not None)))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return (key, self._generation), None
+            self._entries.move_to_end(key)
+            if entry.fresh:
+                self.hits += 1
+            elif not entry.rule.revalidate or not entry.conditionalHeaders():
+                self.misses += 1
+                entry = None
+            return (key, self._generation), entry
+
+    def store(self, key: tuple, endpoint: str, response: Response):
+        """Caches a successful response, unless something was invalidated while it was being requested"""
+        key, generation = key
+        if response.status_code != 200 or 'no-store' in response.headers.get('Cache-Control', ''):
+            return
+        rule = self.getRule(endpoint)
+        # Reading the body now so the connection goes back to the pool and the cached response can be read again
+        response.content
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = _CacheEntry(response, rule, _itemOf(endpoint))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def refresh(self, entry: _CacheEntry):
+        """The server answered 304 Not Modified, the cached response is good for another TTL"""
+        with self._lock:
+            self.revalidated += 1
+            entry.expires = monotonic() + entry.rule.ttl
+
+    def invalidateEndpoint(self, endpoint: str):
+        """Drops what a write to this endpoint can change"""
+        if _readOnlyEndpoint.search(endpoint):
+            return
+        resourceType, itemID = _itemOf(endpoint)
+        if resourceType is not None:
+            self.invalidate(resourceType, itemID)
+
+    def invalidate(self, resourceType: str, itemID: str = None):
+        """Drops the responses of an item, and the responses that are not about one item (tree levels), of a resource type.
+        Without an itemID every response of the resource type is dropped.
+        """
+        resourceType = resourceType.lower()
+        with self._lock:
+            self._generation += 1
+            for key in [key for key, entry in self._entries.items() if entry.item[0] == resourceType and (itemID is None or entry.item[1] in (itemID, None))]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated}
+
+
+def _itemOf(endpoint: str) -> tuple:
+    # (resourceType, itemID) of an endpoint, lower case resource type, None when there isn't one
+    match = _resourcePath.match(endpoint)
+    if match is None:
+        return None, None
+    resourceType, itemID = match.groups()
+    if itemID in RESOURCE_PATH_KEYWORDS:
+        itemID = None
+    return resourceType.lower(), itemID
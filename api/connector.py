@@ -1,16 +1,64 @@
 import requests
 from datetime import datetime
 from logging import Logger
+from threading import Lock
+from typing import Callable
+from time import perf_counter, sleep
 
 from chilitools.api import endpoints
+from chilitools.api.cache import ResponseCache
 from chilitools.api.response import ChiliResponse
+from chilitools.api.retry import RetryPolicy
+from chilitools.utilities.defaults import DEFAULT_RESPONSEPARSER
+from chilitools.utilities.metrics import RequestMetrics
 from chilitools.utilities.backoffice import getBaseURL, getRequestURL, getEnvironmentName
-from chilitools.utilities.file import checkForFile, writeFile, readFile
+from chilitools.utilities.file import checkForFile, writeFile, readFile, streamDownload
 from chilitools.settings.config import APIKEY_FILE
 
+# API keys are cached in memory per backofficeURL for the whole process so the key file
+# is only read once and only written when a key actually changes
+_apiKeyCache = {}
+_apiKeyCacheLoaded = False
+_apiKeyCacheLock = Lock()
+_apiKeyGenLocks = {}
+
+def _readAPIKeyFile() -> dict:
+    if not checkForFile(APIKEY_FILE):
+        return {}
+    try:
+        return readFile(fileName=APIKEY_FILE, isJSON=True)
+    except:
+        return {}
+
+def _getCachedAPIKey(backofficeURL: str) -> dict:
+    global _apiKeyCacheLoaded
+    with _apiKeyCacheLock:
+        if not _apiKeyCacheLoaded:
+            for url, apiKey in _readAPIKeyFile().items():
+                try:
+                    _apiKeyCache[url] = {'key':apiKey['key'], 'validTill':datetime.fromisoformat(apiKey['validTill'])}
+                except (KeyError, TypeError, ValueError):
+                    continue
+            _apiKeyCacheLoaded = True
+        return _apiKeyCache.get(backofficeURL)
+
+def _storeAPIKey(backofficeURL: str, key: str, validTill: datetime) -> None:
+    with _apiKeyCacheLock:
+        _apiKeyCache[backofficeURL] = {'key':key, 'validTill':validTill}
+        # Merge with the file so keys written by other processes are kept
+        apiKeys = _readAPIKeyFile()
+        apiKeys[backofficeURL] = {'key':key, 'validTill':validTill.isoformat()}
+        writeFile(fileName=APIKEY_FILE, data=apiKeys, isJSON=True)
+
+def _getAPIKeyLock(backofficeURL: str) -> Lock:
+    with _apiKeyCacheLock:
+        if backofficeURL not in _apiKeyGenLocks:
+            _apiKeyGenLocks[backofficeURL] = Lock()
+        return _apiKeyGenLocks[backofficeURL]
+
 
 class ChiliConnector:
-    def __init__(self, backofficeURL: str, logger = None, forceKeyRegen: bool = False, username: str = None, password: str = None, apiVersion: str = '1.2', debugLevel = 1):
+    def __init__(self, backofficeURL: str, logger = None, forceKeyRegen: bool = False, username: str = None, password: str = None, apiVersion: str = '1.2', debugLevel = 1, retryPolicy: RetryPolicy = None, cache: ResponseCache = None, metrics: RequestMetrics = None):
         self.backofficeURL = backofficeURL
         # Yes I misspelled environment early on and haven't search replaced it yet :D
         self.environment = getEnvironmentName(backofficeURL=backofficeURL)
@@ -26,6 +74,15 @@ class ChiliConnector:
         # Session
         self.session = requests.Session()
 
+        # Retry policy for failed requests, pass RetryPolicy(maxRetries=0) to disable retrying
+        self.retryPolicy = retryPolicy if retryPolicy is not None else RetryPolicy()
+
+        # Optional cache for GET responses, see api.cache.ResponseCache
+        self.cache = cache
+
+        # Per endpoint request metrics, pass the same RequestMetrics to several connectors to add them up
+        self.metrics = metrics if metrics is not None else RequestMetrics()
+
         # Reuse API keys or force new API key every call
         self.forceKeyRegen = forceKeyRegen
 
@@ -40,7 +97,7 @@ class ChiliConnector:
         self.system = endpoints.System(self)
         self.documents = endpoints.Documents(self)
 
-    def makeRequest(self, method: str, endpoint: str, headers: dict = None, queryParams: dict = None, json: dict = None, authRequired: bool = True) -> ChiliResponse:
+    def makeRequest(self, method: str, endpoint: str, headers: dict = None, queryParams: dict = None, json: dict = None, authRequired: bool = True, parser: str = DEFAULT_RESPONSEPARSER, data = None) -> ChiliResponse:
 
         requestURL = self.requestURL + endpoint
 
@@ -63,9 +120,49 @@ class ChiliConnector:
 
         method = method.lower()
 
-        resp = self.session.request(method=method, url=requestURL, headers=requestHeaders, params=requestQueryParams, json=json)
+        cacheKey, cached = None, None
+        if self.cache is not None and method == 'get':
+            cacheKey, cached = self.cache.lookup(endpoint, requestQueryParams)
+            if cached is not None:
+                if cached.fresh:
+                    return ChiliResponse(cached.response, parser=parser)
+                requestHeaders.update(cached.conditionalHeaders())
+
+        attempt = 0
+        while True:
+            # Streaming bodies have to be rewound before they can be sent again
+            if attempt > 0 and hasattr(data, 'seek'):
+                data.seek(0)
+            start = perf_counter()
+            try:
+                resp = self.session.request(method=method, url=requestURL, headers=requestHeaders, params=requestQueryParams, json=json, data=data)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.metrics.record(method, endpoint, e.__class__.__name__, perf_counter() - start)
+                if not self.retryPolicy.shouldRetry(method, attempt):
+                    raise
+                backoff = self.retryPolicy.getBackoff(attempt)
+                self._displayMsg(f"ChiliConnector: {method.upper()} {endpoint} failed with {e.__class__.__name__}, retrying in {backoff:.2f}s ({attempt + 1}/{self.retryPolicy.maxRetries})")
+            else:
+                self.metrics.recordResponse(method, endpoint, resp, perf_counter() - start)
+                if not self.retryPolicy.shouldRetry(method, attempt, resp.status_code):
+                    break
+                backoff = self.retryPolicy.getBackoff(attempt, resp.headers.get('Retry-After'))
+                self._displayMsg(f"ChiliConnector: {method.upper()} {endpoint} returned {resp.status_code}, retrying in {backoff:.2f}s ({attempt + 1}/{self.retryPolicy.maxRetries})")
+                resp.close()
+            sleep(backoff)
+            attempt += 1
+
+        if self.cache is not None:
+            if cacheKey is None:
+                if method != 'get':
+                    self.cache.invalidateEndpoint(endpoint)
+            elif cached is not None and resp.status_code == 304:
+                self.cache.refresh(cached)
+                resp = cached.response
+            else:
+                self.cache.store(cacheKey, endpoint, resp)
 
-        response = ChiliResponse(resp)
+        response = ChiliResponse(resp, parser=parser)
 
         if self.debugLevel == 2:
             request = {'url':requestURL, 'method':method, 'headers':requestHeaders, 'queryParams':requestQueryParams, 'body':json}
@@ -73,76 +170,91 @@ class ChiliConnector:
 
         return response
 
-    # This is a nightmare of a function. Don't ever do this again Austin
-    def getAPIKey(self) -> str:
-        genKey = True
+    def downloadToFile(self, endpoint: str, target, queryParams: dict = None, authRequired: bool = True, resume: bool = False, progress: Callable = None) -> dict:
+        """Streams the body of a GET endpoint to a file path or binary file object, see utilities.file.streamDownload"""
+        requestHeaders = { "accept":"*/*" }
+        if authRequired:
+            requestHeaders['API-KEY'] = self.getAPIKey()
+
+        return streamDownload(
+            url=self.requestURL + endpoint,
+            target=target,
+            queryParams=queryParams,
+            headers=requestHeaders,
+            session=self.session,
+            resume=resume,
+            retryPolicy=self.retryPolicy,
+            progress=progress,
+            onAttempt=lambda status, seconds, bytesIn: self.metrics.record('get', endpoint, status, seconds, bytesIn=bytesIn)
+        )
 
+    def getAPIKey(self) -> str:
         if self.debugLevel == 2:
             if self.username and self.password:
                 self._displayMsg("ChiliConnector: Using supplied credentials instead of stored credentials to authenticate")
 
         if self.forceKeyRegen:
             self._displayMsg("ChiliConnector: Forcing a new API key to be generated")
-        else:
-            if checkForFile(APIKEY_FILE):
-                try:
-                    apiKeys = readFile(fileName=APIKEY_FILE, isJSON=True)
-                except:
-                    apiKeys = {}
-            else:
-                self._displayMsg("ChiliConnector: Key file not found, creating one...")
-                apiKeys = {}
-
-            if self.backofficeURL in apiKeys:
-                if datetime.now() < datetime.fromisoformat(apiKeys[self.backofficeURL]['validTill']):
-                    return apiKeys[self.backofficeURL]['key']
-                else:
-                    self._displayMsg(f"ChiliConnector: Key found for {self.backofficeURL} is expired, generating a new one...")
+            apiKey = self._generateAPIKey()
+            # Don't store the key if they are forceRegen
+            return apiKey['key'] if apiKey else None
+
+        apiKey = _getCachedAPIKey(self.backofficeURL)
+        if apiKey is not None and datetime.now() < apiKey['validTill']:
+            return apiKey['key']
+
+        # Only one caller per BackOffice generates a key, everyone else waits here and reuses it
+        with _getAPIKeyLock(self.backofficeURL):
+            apiKey = _getCachedAPIKey(self.backofficeURL)
+            if apiKey is not None:
+                if datetime.now() < apiKey['validTill']:
+                    return apiKey['key']
+                self._displayMsg(f"ChiliConnector: Key found for {self.backofficeURL} is expired, generating a new one...")
             else:
                 self._displayMsg(f"ChiliConnector: Key not found for {self.backofficeURL}, generating one...")
 
-        if genKey:
+            apiKey = self._generateAPIKey()
+            if apiKey is None:
+                return None
+            _storeAPIKey(self.backofficeURL, apiKey['key'], apiKey['validTill'])
+            return apiKey['key']
+
+    # This is a nightmare of a function. Don't ever do this again Austin
+    def _generateAPIKey(self) -> dict:
+        keyResp = self.system.GenerateApiKey(username=self.username, password=self.password)
+        if not keyResp.success:
+            # This should only happen if the request is malformed or the user cannot connect to the environment API
+            self._displayMsg("ChiliConnector: There was an issue connecting to the environment. Please try again or contact support", error=True)
+            print(keyResp)
+            exit(0)
+        key = keyResp.content['apiKey']
+
+        while key["@succeeded"] == "false":
+            self._displayMsg(keyResp)
+            self._displayMsg("ChiliConnector: There was an issue authenticating with CHILI. Please check the error message below", error=True)
+            self._displayMsg(f"Error: {key['@errorMessage']}\n", error=True)
+
+            if self.username and self.password:
+                print("Please enter your CHILI username")
+                username = input().strip()
+                print("Please enter your CHILI password")
+                password = input().strip()
+            else:
+                from chilitools.api.mycp import deleteLoginFile, inputCredentials
+                deleteLoginFile()
+                print("Enter your login information again, or press CTRL-C to exit")
+                inputCredentials()
             keyResp = self.system.GenerateApiKey(username=self.username, password=self.password)
-            if not keyResp.success:
-                # This should only happen if the request is malformed or the user cannot connect to the environment API
-                self._displayMsg("ChiliConnector: There was an issue connecting to the environment. Please try again or contact support", error=True)
-                print(keyResp)
-                exit(0)
             key = keyResp.content['apiKey']
 
-            while key["@succeeded"] == "false":
-                self._displayMsg(keyResp)
-                self._displayMsg("ChiliConnector: There was an issue authenticating with CHILI. Please check the error message below", error=True)
-                self._displayMsg(f"Error: {key['@errorMessage']}\n", error=True)
-
-                if self.username and self.password:
-                    print("Please enter your CHILI username")
-                    username = input().strip()
-                    print("Please enter your CHILI password")
-                    password = input().strip()
-                else:
-                    from chilitools.api.mycp import deleteLoginFile, inputCredentials
-                    deleteLoginFile()
-                    print("Enter your login information again, or press CTRL-C to exit")
-                    inputCredentials()
-                keyResp = self.system.GenerateApiKey(username=self.username, password=self.password)
-                key = keyResp.content['apiKey']
-
-
-            if "@key" in key.keys():
-                # Don't store the key if they are forceRegen
-                if self.forceKeyRegen: return key["@key"]
-
-                # Date format checking
-                validTill = key['@validTill'].replace(' ', 'T').replace('Z', '')
-                apiKeys[self.backofficeURL] = {'key':key['@key'], 'validTill':validTill}
-                self._displayMsg(f"ChiliConnector: Successfully generated API key for {self.backofficeURL}")
-            else:
-                self._displayMsg(f"ChiliConnector: Error extracting API key from response: {key}", error=True)
+        if "@key" not in key.keys():
+            self._displayMsg(f"ChiliConnector: Error extracting API key from response: {key}", error=True)
+            return None
 
-        # Save key file
-        writeFile(fileName=APIKEY_FILE, data=apiKeys, isJSON=True)
-        return apiKeys[self.backofficeURL]['key']
+        # Date format checking
+        validTill = datetime.fromisoformat(key['@validTill'].replace(' ', 'T').replace('Z', ''))
+        self._displayMsg(f"ChiliConnector: Successfully generated API key for {self.backofficeURL}")
+        return {'key':key['@key'], 'validTill':validTill}
 
     # honestly not sure the best way to pass log level without bigger refactor.
     def _displayMsg(self, msg: str, error: bool = False):
@@ -1,16 +1,18 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, OrderedDict
+from typing import TYPE_CHECKING, Callable, OrderedDict
 from urllib import request
 if TYPE_CHECKING:
     from chilitools.api.connector import ChiliConnector
     from chilitools.api.response import ChiliResponse
 
-from time import sleep
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
 from chilitools.api.mycp import generateLoginTokenForURL, getCredentials
+from chilitools.api.tasks import TaskWaiter
 from chilitools.utilities.errors import ErrorHandler
-from chilitools.utilities.file import getBase64String
-from chilitools.utilities.defaults import DEFAULT_TASKPRIORITY, DEFAULT_TASKUPDATETIME, STAFF_TYPE, USER_TYPE
-from chilitools.utilities.document import ChiliDocument
+from chilitools.utilities.file import getBase64Body
+from chilitools.utilities.defaults import DEFAULT_TASKPRIORITY, DEFAULT_TASKUPDATETIME, STAFF_TYPE, USER_TYPE, DEFAULT_RESPONSEPARSER, PARSER_NONE
+from chilitools.utilities.document import ChiliDocument, FrameProbe, FrameFound
 
 class Resources:
   def __init__(self, connector: ChiliConnector):
@@ -36,7 +38,15 @@ class Resources:
       method='delete',
       endpoint=f"/resources/{resourceType}/items/{itemID}/previewoverride"
     )
-  def ResourceItemReplaceFile(self, resourceType: str, itemID: str, fileData: str) -> ChiliResponse:
+  def ResourceItemReplaceFile(self, resourceType: str, itemID: str, fileData: str = None, filePath: str = None) -> ChiliResponse:
+    # Passing filePath streams the file through a base64 encoder instead of building fileData in memory
+    if filePath is not None:
+      return self.connector.makeRequest(
+        method="put",
+        endpoint=f"/resources/{resourceType}/items/{itemID}/file",
+        headers={'content-type':'application/json'},
+        data=getBase64Body(filePath=filePath)
+      )
     return self.connector.makeRequest(
       method="put",
       endpoint=f"/resources/{resourceType}/items/{itemID}/file",
@@ -72,10 +82,19 @@ class Resources:
       endpoint=f"/resources/{resourceType}/items/{itemID}/save",
       json={'xml':xml}
     )
-  def ResourceItemGetXML(self, resourceType: str, itemID: str) -> ChiliResponse:
+  def ResourceItemGetXML(self, resourceType: str, itemID: str, parser: str = DEFAULT_RESPONSEPARSER) -> ChiliResponse:
     return self.connector.makeRequest(
       method='get',
-      endpoint=f"/resources/{resourceType}/items/{itemID}/xml"
+      endpoint=f"/resources/{resourceType}/items/{itemID}/xml",
+      parser=parser
+    )
+  def ResourceItemGetXMLToFile(self, resourceType: str, itemID: str, target, progress: Callable = None) -> dict:
+    """Streams the item XML to a file path or binary file object, see ChiliConnector.downloadToFile"""
+    return self.connector.downloadToFile(
+      endpoint=f"/resources/{resourceType}/items/{itemID}/xml",
+      target=target,
+      resume=False,
+      progress=progress
     )
   def ResourceItemGetURL(self, resourceType: str, itemID: str, URLtype: str, pageNum: int = 1) -> ChiliResponse:
     return self.connector.makeRequest(
@@ -89,9 +108,18 @@ class Resources:
       newName=newName,
       folderPath=folderPath,
       xml = '',
-      fileData=getBase64String(filePath=assetFilePath)
+      filePath=assetFilePath
     )
-  def ResourceItemAdd(self, resourceType: str, newName: str, folderPath: str, xml: str, fileData: str = '') -> ChiliResponse:
+  def ResourceItemAdd(self, resourceType: str, newName: str, folderPath: str, xml: str, fileData: str = '', filePath: str = None) -> ChiliResponse:
+    # Passing filePath streams the file through a base64 encoder instead of building fileData in memory
+    if filePath is not None:
+      return self.connector.makeRequest(
+        method='post',
+        endpoint=f"/resources/{resourceType}/items",
+        queryParams={'newName':newName, 'folderPath':folderPath},
+        headers={'content-type':'application/json'},
+        data=getBase64Body(filePath=filePath, fields={'xml':xml})
+      )
     return self.connector.makeRequest(
       method='post',
       endpoint=f"/resources/{resourceType}/items",
@@ -104,11 +132,12 @@ class Resources:
       endpoint=f"/resources/{resourceType}/items/fromurl",
       queryParams={'newName':newName, 'folderPath':folderPath, 'url':url, 'login':authUsername, 'pw':authPassword, 'reuseExisting':reuseExisting, 'previewFileURL':previewFileURL, 'previewExtension':previewExtension, 'isPermanentPreview':isPermanentPreview },
     )
-  def ResourceGetTreeLevel(self, resourceType: str, parentFolder: str = '', numLevels: int = 1, includeSubDirectories: bool = True, includeFiles: bool = True) -> ChiliResponse:
+  def ResourceGetTreeLevel(self, resourceType: str, parentFolder: str = '', numLevels: int = 1, includeSubDirectories: bool = True, includeFiles: bool = True, parser: str = DEFAULT_RESPONSEPARSER) -> ChiliResponse:
     return self.connector.makeRequest(
       method='get',
       endpoint=f"/resources/{resourceType}/treelevel",
-      queryParams={'parentFolder':parentFolder, 'numLevels':numLevels, 'includeSubDirectories':includeSubDirectories, 'includeFiles':includeFiles}
+      queryParams={'parentFolder':parentFolder, 'numLevels':numLevels, 'includeSubDirectories':includeSubDirectories, 'includeFiles':includeFiles},
+      parser=parser
     )
   async def AsyncResourceGetTreeLevel(self, resourceType: str, parentFolder: str = '', numLevels: int = 1, includeSubDirectories: bool = True, includeFiles: bool = True) -> ChiliResponse:
     return self.connector.makeRequest(
@@ -128,10 +157,11 @@ class Resources:
       endpoint=f"/resources/{resourceType}",
       queryParams={'name':name}
     )
-  def ResourceItemGetDefinitionXML(self, resourceType: str, itemID: str)-> ChiliResponse:
+  def ResourceItemGetDefinitionXML(self, resourceType: str, itemID: str, parser: str = DEFAULT_RESPONSEPARSER)-> ChiliResponse:
     return self.connector.makeRequest(
       method='get',
-      endpoint=f"/resources/{resourceType}/items/{itemID}/definitionxml"
+      endpoint=f"/resources/{resourceType}/items/{itemID}/definitionxml",
+      parser=parser
     )
   def ResourceFolderAdd(self, resourceType: str, newName: str, parentPath: str = None) -> ChiliResponse:
     return self.connector.makeRequest(
@@ -161,12 +191,22 @@ class Resources:
     return self.connector.makeRequest(
       method='get',
       endpoint=f"/resources/{resourceType}/download",
-      queryParams={'id':id, 'path':itemPath, 'name':name, 'type':assetType, 'page':page, 'docId':docID, 'taskPriority':taskPriority}
+      queryParams={'id':id, 'path':itemPath, 'name':name, 'type':assetType, 'page':page, 'docId':docID, 'taskPriority':taskPriority},
+      parser=PARSER_NONE
+    )
+  def DownloadAssetToFile(self, resourceType: str, id: str, target, itemPath: str = None, name: str = None, assetType: str = None, page: int = None, docID: str = None, taskPriority: int = DEFAULT_TASKPRIORITY, resume: bool = False, progress: Callable = None) -> dict:
+    return self.connector.downloadToFile(
+      endpoint=f"/resources/{resourceType}/download",
+      target=target,
+      queryParams={'id':id, 'path':itemPath, 'name':name, 'type':assetType, 'page':page, 'docId':docID, 'taskPriority':taskPriority},
+      resume=resume,
+      progress=progress
     )
-  def getPDFSettingsXML(self, settingsID: str) -> ChiliResponse:
+  def getPDFSettingsXML(self, settingsID: str, parser: str = DEFAULT_RESPONSEPARSER) -> ChiliResponse:
     return self.connector.makeRequest(
       method='get',
-      endpoint=f"/resources/PdfExportSettings/items/{settingsID}/xml"
+      endpoint=f"/resources/PdfExportSettings/items/{settingsID}/xml",
+      parser=parser
     )
   def setNextResourceItemID(self, resourceType: str, itemID: str) -> ChiliResponse:
     return self.connector.makeRequest(
@@ -190,11 +230,28 @@ class Resources:
       )
 
   def doesItemExist(self, resourceType: str, itemID: str) -> bool:
-    res = self.ResourceItemGetXML(resourceType, itemID)
+    # The definition is a few hundred bytes, the item XML of a document can be megabytes
+    res = self.ResourceItemGetDefinitionXML(resourceType, itemID, parser=PARSER_NONE)
     if res.statusCode == 404:
       return False
     return True
 
+  def getItemIDs(self, resourceType: str, folder: str = '') -> set:
+    """Returns the IDs of every item in the resource tree (or below `folder`) with a single request.
+    Use it to check a lot of items for existence, ex: `itemID in ids`, instead of calling doesItemExist for each
+    """
+    resp = self.ResourceGetTreeLevel(
+      resourceType=resourceType,
+      parentFolder=folder,
+      numLevels=-1,
+      includeSubDirectories=True,
+      includeFiles=True,
+      parser=PARSER_NONE
+    )
+    if not resp.success:
+      raise IOError(f"There was an issue getting the {resourceType} tree: {resp.text}")
+    return set(resp.xml.xpath("//item[not(@isFolder='true')]/@id"))
+
   def get_name_if_exists(self, resourceType: str, itemID: str):
     res = self.ResourceItemGetDefinitionXML(resourceType, itemID)
     if res.statusCode == 404:
@@ -207,38 +264,29 @@ class Resources:
   def getDownloadURL(self, resourceType: str, itemID: str, downloadType: str = "original", pageNum: int = 1) -> ChiliResponse:
     return f"{self.connector.baseURL}{self.connector.environment}/download.aspx?type={downloadType}&resourceName={resourceType}&id={itemID}&apiKey={self.connector.getAPIKey()}&pageNum={pageNum}"
 
-  def getFullResourceTree(self, resourceType: str, folder: str = '') -> dict:
-    items = dict()
-    return self._resourceTreeIter(resourceType, items, folder=folder)
-
-  def get_items_in_tree(self, resourceType: str, folder: str = '') -> list:
-    items = list()
-    return self._resourceItemsIter(resourceType, items, folder=folder)
-
-  def _resourceTreeIter(self, resourceType: str, itemsDict: dict, folder: str = '') -> dict:
-
-    resp = self.ResourceGetTreeLevel(
-      resourceType=resourceType,
-      parentFolder=folder,
-      numLevels=1,
-      includeSubDirectories=True,
-      includeFiles=True
-    )
+  def getFullResourceTree(self, resourceType: str, folder: str = '', workers: int = 8) -> dict:
+    tree = {folder: {}}
+    for parentFolder, item in self._crawlTree(resourceType, folder, workers):
+      if item['@isFolder'] == 'true':
+        tree[item['@path']] = tree[parentFolder][item['@name']] = {}
+      else:
+        tree[parentFolder][item['@name']] = item
+    return tree[folder]
 
-    items = resp.content['tree'].get('item')
+  def get_items_in_tree(self, resourceType: str, folder: str = '', workers: int = 8) -> list:
+    return list(self.iterTreeItems(resourceType, folder=folder, workers=workers))
 
-    if items is not None:
-      if not isinstance(items, list): items = [items]
-      for item in items:
-        if item['@isFolder'] == 'true':
-          itemsDict[item['@name']] = {}
-          self._resourceTreeIter(resourceType, itemsDict[item['@name']], item['@path'])
-        else:
-          itemsDict[item['@name']] = item
-    return itemsDict
+  def iterTreeItems(self, resourceType: str, folder: str = '', workers: int = 8, includeFolders: bool = False):
+    """Yields the items in the resource tree while it is being crawled.
+    Folders are expanded breadth first, up to `workers` folders are requested at the same time
 
-  def _resourceItemsIter(self, resourceType: str, items_list: list = None, folder: str = '') -> list:
+    :param includeFolders: Also yield the folder items
+    """
+    for _, item in self._crawlTree(resourceType, folder, workers):
+      if includeFolders or item['@isFolder'] != 'true':
+        yield item
 
+  def _getTreeLevelItems(self, resourceType: str, folder: str) -> list:
     resp = self.ResourceGetTreeLevel(
       resourceType=resourceType,
       parentFolder=folder,
@@ -246,18 +294,34 @@ class Resources:
       includeSubDirectories=True,
       includeFiles=True
     )
-
+    if not resp.success:
+      raise IOError(f"There was an issue getting the {resourceType} tree level for {folder}: {resp.text}")
     items = resp.content['tree'].get('item')
+    if items is None:
+      return []
+    if not isinstance(items, list):
+      items = [items]
+    return items
 
-    if items is not None:
-      if not isinstance(items, list):
-        items = [items]
-      for item in items:
-        if item['@isFolder'] == 'true':
-          self._resourceItemsIter(resourceType, items_list, item['@path'])
-        else:
-          items_list.append(item)
-    return items_list
+  def _crawlTree(self, resourceType: str, folder: str, workers: int):
+    # Yields (parentFolder, item), a folder is always yielded before anything inside of it
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='TreeCrawl')
+    try:
+      pending = {pool.submit(self._getTreeLevelItems, resourceType, folder): folder}
+      while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          parentFolder = pending.pop(future)
+          items = future.result()
+          # Request the subfolders before yielding, the consumer can take its time with every item
+          for item in items:
+            if item['@isFolder'] == 'true':
+              pending[pool.submit(self._getTreeLevelItems, resourceType, item['@path'])] = item['@path']
+          for item in items:
+            yield parentFolder, item
+    finally:
+      # The consumer can stop early, don't crawl the rest of the tree
+      pool.shutdown(wait=False, cancel_futures=True)
 
 
 class Documents:
@@ -319,10 +383,11 @@ class Documents:
       endpoint=f"/resources/documents/{documentID}/urls/editor",
       queryParams={'workSpaceID':workSpaceID, 'viewPrefsID':viewPrefsID, 'constraintsID':constraintsID, 'viewerOnly':viewerOnly, 'forAnonymousUser':forAnonymousUser}
     )
-  def getXML(self, documentID: str) -> ChiliResponse:
+  def getXML(self, documentID: str, parser: str = DEFAULT_RESPONSEPARSER) -> ChiliResponse:
     return self.connector.makeRequest(
       method='get',
-      endpoint=f"/resources/documents/items/{documentID}/xml"
+      endpoint=f"/resources/documents/items/{documentID}/xml",
+      parser=parser
     )
   def saveXML(self, documentID: str, docXML: str) -> ChiliResponse:
     return self.connector.makeRequest(
@@ -345,7 +410,7 @@ class Documents:
     if settingsID is None and settingsXML is None:
       return
     if settingsID is not None:
-      settingsXML = self.connector.resources.getPDFSettingsXML(settingsID=settingsID).text
+      settingsXML = self.connector.resources.getPDFSettingsXML(settingsID=settingsID, parser=PARSER_NONE).text
     return self.connector.makeRequest(
       method='post',
       endpoint=f"/resources/documents/{documentID}/representations/pdf",
@@ -356,7 +421,7 @@ class Documents:
     if settingsID is None and settingsXML is None:
       return
     if settingsID is not None:
-      settingsXML = self.resources.getPDFSettingsXML(settingsID=settingsID).text
+      settingsXML = self.connector.resources.getPDFSettingsXML(settingsID=settingsID, parser=PARSER_NONE).text
     return self.connector.makeRequest(
       method='post',
       endpoint=f"/resources/documents/tempxml/pdf",
@@ -367,7 +432,7 @@ class Documents:
     if settingsID is None and settingsXML is None:
       return
     if settingsID is not None:
-      settingsXML = self.resources.getPDFSettingsXML(settingsID=settingsID).text
+      settingsXML = self.connector.resources.getPDFSettingsXML(settingsID=settingsID, parser=PARSER_NONE).text
     return self.connector.makeRequest(
       method='post',
       endpoint=f"/resources/documents/{documentID}/representations/images",
@@ -380,7 +445,7 @@ class Documents:
     if documentID is None and documentXML is None:
       return
     if settingsID is not None:
-      settingsXML = self.resources.getPDFSettingsXML(settingsID=settingsID).text
+      settingsXML = self.connector.resources.getPDFSettingsXML(settingsID=settingsID, parser=PARSER_NONE).text
     return self.connector.makeRequest(
       method='post',
       endpoint=f"/resources/documents/tempxml/images",
@@ -398,36 +463,44 @@ class Documents:
       doc = ChiliDocument(doc)
     if len(doc.frames) > 0: return False
     return True
+  def probeIsBlank(self, documentID: str) -> bool:
+    """Checks if a document on the server is blank. The XML is streamed and the download stops at the first frame"""
+    try:
+      self.connector.resources.ResourceItemGetXMLToFile(resourceType="documents", itemID=documentID, target=FrameProbe())
+    except FrameFound:
+      return False
+    return True
 
 class System:
   def __init__(self, connector: ChiliConnector):
     self.connector = connector
+    self._taskWaiter = None
+    self._taskWaiterLock = Lock()
+
+  @property
+  def taskWaiter(self) -> TaskWaiter:
+    """One TaskWaiter per connector so every thread waiting on tasks shares the same polling loop"""
+    with self._taskWaiterLock:
+      if self._taskWaiter is None:
+        self._taskWaiter = TaskWaiter(self.connector)
+      return self._taskWaiter
 
   def getTaskStatus(self, taskID: str) -> ChiliResponse:
     return self.connector.makeRequest(
       method='get',
       endpoint=f"/system/tasks/{taskID}/status"
     )
-  def waitForTask(self, taskID: str, taskUpdateTime: int = DEFAULT_TASKUPDATETIME, debug: bool = False) -> OrderedDict:
-    while True:
-      resp = self.getTaskStatus(taskID=taskID).contentAsDict()
-      taskStatus = resp['task']['@finished']
-      if debug: print(f"Polled Task: Current Status: {taskStatus}")
-      if taskStatus == "True":
-        return resp
-      sleep(taskUpdateTime)
+  def waitForTask(self, taskID: str, taskUpdateTime: int = DEFAULT_TASKUPDATETIME, debug: bool = False, timeout: float = None, taskPriority: int = DEFAULT_TASKPRIORITY) -> OrderedDict:
+    task = self.taskWaiter.track(taskID=taskID, priority=taskPriority, timeout=timeout, minInterval=taskUpdateTime).result()
+    if debug: print(f"Polled Task: Current Status: {task['task']['@finished']}")
+    return task
+  def waitForTasks(self, taskIDs: list, timeout: float = None, taskPriority: int = DEFAULT_TASKPRIORITY, callback = None) -> dict:
+    """Waits on a batch of tasks, returns a dict of taskID to the finished task or the exception if it failed or timed out"""
+    futures = self.taskWaiter.trackMany(taskIDs=taskIDs, priority=taskPriority, timeout=timeout, callback=callback)
+    return {taskID: future.exception() or future.result() for taskID, future in futures.items()}
 
   def GenerateApiKey(self, username: str = None, password: str = None) -> ChiliResponse:
-    if not username or not password:
-      # We need to get their credentials
-      login = getCredentials()
-
-      if login["type"] == STAFF_TYPE:
-        username = "ChiliAdmin"
-        password = generateLoginTokenForURL(backofficeURL=self.connector.backofficeURL)
-      else:
-        username = login["credentials"]["Username"]
-        password = login["credentials"]["Password"]
+    username, password = self._getLogin(username=username, password=password)
 
     requestJSON = {'userName':username, 'password': password}
 
@@ -440,6 +513,19 @@ class System:
       authRequired=False
     )
 
+  def _getLogin(self, username: str = None, password: str = None) -> tuple:
+    if not username or not password:
+      # We need to get their credentials
+      login = getCredentials()
+
+      if login["type"] == STAFF_TYPE:
+        username = "ChiliAdmin"
+        password = generateLoginTokenForURL(backofficeURL=self.connector.backofficeURL)
+      else:
+        username = login["credentials"]["Username"]
+        password = login["credentials"]["Password"]
+    return username, password
+
   def SetAutomaticPreviewGeneration(self, createPreviews: bool) -> ChiliResponse:
     return self.connector.makeRequest(
       method='put',
@@ -2,16 +2,21 @@ import xmltodict
 import json
 
 from typing import OrderedDict
+from lxml import etree
 from requests import Response
-from chilitools.utilities.defaults import statusCodes
+from chilitools.utilities.defaults import statusCodes, DEFAULT_RESPONSEPARSER, PARSER_XMLTODICT, PARSER_LXML, PARSER_NONE
 
 class ChiliResponse:
 
-    def __init__(self, response: Response):
+    def __init__(self, response: Response, parser: str = DEFAULT_RESPONSEPARSER):
         self.response = response
         self.statusCode = response.status_code
         self.success = False
-        self.parseSuccess = False
+        # The body is only parsed the first time .data is used, see _parseContent
+        self.parser = parser
+        self._data = None
+        self._parseSuccess = False
+        self._xml = None
 
         if 'content-type' in self.response.headers:
             self.type = self.response.headers['content-type'].split(';')[0]
@@ -25,23 +30,26 @@ class ChiliResponse:
         else:
             self.statusDescription = f"Status code description not found for status code {self.response.status_code}"
 
-        self._parseContent()
-
     def _parseContent(self):
-        if self.type == 'application/xml':
+        if self.parser == PARSER_NONE:
+            self._data = { "error":"response parsing was disabled for this request" }
+        elif self.type == 'application/xml':
             try:
-                self.data = xmltodict.parse(self.text)
-                self.parseSuccess = True
+                if self.parser == PARSER_LXML:
+                    self._data = self.xml
+                else:
+                    self._data = xmltodict.parse(self.text)
+                self._parseSuccess = True
             except:
-                self.data = { "error":"failed to parse xml" }
+                self._data = { "error":"failed to parse xml" }
         elif self.type == 'application/json':
             try:
-                self.data = self.response.json()
-                self.parseSuccess = True
+                self._data = self.response.json()
+                self._parseSuccess = True
             except:
-                self.data = { "error":"failed to parse json" }
+                self._data = { "error":"failed to parse json" }
         else:
-            self.data = { "error":"failed to find a proper method to parse the response" }
+            self._data = { "error":"failed to find a proper method to parse the response" }
 
     def asDict(self) -> dict:
         return {"success":self.success, "statusCode":self.response.status_code, "statusDescription":self.statusDescription, "data":self.data, "contentType":self.type, "responseText":self.response.text}
@@ -66,6 +74,25 @@ class ChiliResponse:
     def __iter__(self):
         yield from self.data
 
+    @property
+    def data(self):
+        if self._data is None:
+            self._parseContent()
+        return self._data
+
+    @property
+    def parseSuccess(self) -> bool:
+        if self._data is None:
+            self._parseContent()
+        return self._parseSuccess
+
+    @property
+    def xml(self) -> etree._Element:
+        """The response body parsed straight into an lxml element, independent of the parser setting"""
+        if self._xml is None:
+            self._xml = etree.fromstring(self.response.content)
+        return self._xml
+
     @property
     def text(self) -> str:
         return self.response.text
@@ -80,4 +107,4 @@ class ChiliResponse:
 
     @property
     def status(self) -> dict:
-        return {"code": self.response.status_code, "description":self.statusDescription}
\ No newline at end of file
+        return {"code": self.response.status_code, "description":self.statusDescription}
@@ -0,0 +1,66 @@
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from chilitools.utilities.defaults import DEFAULT_RETRY_METHODS, DEFAULT_RETRY_STATUSCODES
+
+
+class RetryPolicy:
+    """Decides if a request should be retried and how long to wait before the next attempt
+
+    :param maxRetries: Amount of retries after the first attempt, 0 disables retrying
+    :param backoffFactor: Base delay in seconds, attempt n waits a random time up to backoffFactor * 2^n
+    :param maxBackoff: Upper bound in seconds for any single wait, including Retry-After
+    :param statusCodes: Status codes that are retried for the idempotent methods
+    :param methods: Methods that are safe to retry (and are retried on connection errors)
+    :param statusMethods: Per status code override of the methods it is retried for. ex: {429: ['post']}
+    :param respectRetryAfter: Wait for the Retry-After header when the server sends one
+    """
+    def __init__(self, maxRetries: int = 3, backoffFactor: float = 0.5, maxBackoff: float = 60, statusCodes: list = DEFAULT_RETRY_STATUSCODES, methods: list = DEFAULT_RETRY_METHODS, statusMethods: dict = None, respectRetryAfter: bool = True):
+        self.maxRetries = maxRetries
+        self.backoffFactor = backoffFactor
+        self.maxBackoff = maxBackoff
+        self.statusCodes = set(statusCodes)
+        self.methods = {m.lower() for m in methods}
+        # A 429 is rejected before the server does any work so it is safe to retry for every method
+        if statusMethods is None:
+            statusMethods = {429: ['get', 'head', 'options', 'put', 'delete', 'post', 'patch']}
+        self.statusMethods = {code: {m.lower() for m in m_list} for code, m_list in statusMethods.items()}
+        self.respectRetryAfter = respectRetryAfter
+
+    def shouldRetry(self, method: str, attempt: int, statusCode: int = None) -> bool:
+        """Check if attempt number `attempt` (starting at 0) can be retried. statusCode None means a connection error"""
+        if attempt >= self.maxRetries:
+            return False
+        method = method.lower()
+        if statusCode is None:
+            return method in self.methods
+        if statusCode in self.statusMethods:
+            return method in self.statusMethods[statusCode]
+        return statusCode in self.statusCodes and method in self.methods
+
+    def getBackoff(self, attempt: int, retryAfter: str = None) -> float:
+        """Seconds to wait before the next attempt, uses "full jitter" so parallel callers don't retry in lockstep"""
+        if retryAfter and self.respectRetryAfter:
+            seconds = self._parseRetryAfter(retryAfter)
+            if seconds is not None:
+                return min(seconds, self.maxBackoff)
+        return random.uniform(0, min(self.maxBackoff, self.backoffFactor * (2 ** attempt)))
+
+    @staticmethod
+    def _parseRetryAfter(retryAfter: str) -> float:
+        # Retry-After can either be delay-seconds or an HTTP-date
+        try:
+            return max(0.0, float(retryAfter))
+        except ValueError:
+            pass
+        try:
+            date = parsedate_to_datetime(retryAfter)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+    def __str__(self) -> str:
+        return f'RetryPolicy(maxRetries={self.maxRetries}, backoffFactor={self.backoffFactor}, maxBackoff={self.maxBackoff}, statusCodes={sorted(self.statusCodes)}, methods={sorted(self.methods)})'
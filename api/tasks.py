@@ -0,0 +1,183 @@
+from __future__ import annotations
+import heapq
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, wait
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+from typing import TYPE_CHECKING, Callable
+if TYPE_CHECKING:
+    from chilitools.api.connector import ChiliConnector
+
+from chilitools.utilities.defaults import DEFAULT_TASKPRIORITY, DEFAULT_TASKUPDATETIME
+
+
+class _TrackedTask:
+    def __init__(self, taskID: str, priority: int, deadline: float, minInterval: float):
+        self.taskID = taskID
+        self.priority = priority
+        self.deadline = deadline
+        self.minInterval = minInterval
+        self.started = monotonic()
+        self.polls = 0
+        self.future = Future()
+
+
+class TaskWaiter:
+    """Waits on many CHILI tasks at once from a single background polling loop.
+
+    Tasks are polled with an adaptive interval: a task is polled again after `ageFactor` times the time it has been
+    running, clamped between `minInterval` and `maxInterval`. Short renders finish quickly and long renders don't spam
+    the server. Lower task priority numbers (more urgent) are polled more often, higher numbers less often.
+    Due tasks are polled in parallel with `maxWorkers` threads.
+
+    :param connector: The ChiliConnector used for the task status requests
+    :param minInterval: Minimum seconds between two polls of the same task
+    :param maxInterval: Maximum seconds between two polls of the same task
+    :param ageFactor: Fraction of the task age to wait before the next poll
+    :param maxWorkers: Amount of status requests made at the same time
+    """
+    def __init__(self, connector: ChiliConnector, minInterval: float = DEFAULT_TASKUPDATETIME, maxInterval: float = 15, ageFactor: float = 0.2, maxWorkers: int = 4, debug: bool = False):
+        self.connector = connector
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.ageFactor = ageFactor
+        self.maxWorkers = maxWorkers
+        self.debug = debug
+        self.statusRequests = 0
+
+        self._queue = []
+        self._order = count()
+        self._condition = Condition()
+        self._thread = None
+        self._executor = None
+        self._running = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def track(self, taskID: str, priority: int = DEFAULT_TASKPRIORITY, timeout: float = None, callback: Callable = None, minInterval: float = None) -> Future:
+        """Start tracking a task. Returns a Future that resolves to the task status dict once the task is finished,
+        or raises TimeoutError when `timeout` seconds pass first.
+
+        :param callback: Called with the finished Future, see Future.add_done_callback
+        """
+        deadline = monotonic() + timeout if timeout is not None else None
+        task = _TrackedTask(taskID, priority, deadline, self.minInterval if minInterval is None else minInterval)
+        if callback is not None:
+            task.future.add_done_callback(callback)
+        with self._condition:
+            self._push(task, monotonic())
+            self._start()
+            self._condition.notify()
+        return task.future
+
+    def trackMany(self, taskIDs: list, priority: int = DEFAULT_TASKPRIORITY, timeout: float = None, callback: Callable = None) -> dict:
+        """Track a batch of tasks, returns a dict of taskID to Future"""
+        return {taskID: self.track(taskID, priority=priority, timeout=timeout, callback=callback) for taskID in taskIDs}
+
+    @property
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._queue)
+
+    def shutdown(self, wait: bool = True):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if wait and self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+        self._thread = None
+        self._executor = None
+
+    def _start(self):
+        if self._running:
+            return
+        self._running = True
+        self._executor = ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix='TaskWaiterPoll')
+        self._thread = Thread(target=self._loop, name='TaskWaiter', daemon=True)
+        self._thread.start()
+
+    def _push(self, task: _TrackedTask, when: float):
+        heapq.heappush(self._queue, (when, next(self._order), task))
+
+    def _nextInterval(self, task: _TrackedTask) -> float:
+        age = monotonic() - task.started
+        priorityFactor = min(2.0, max(0.5, task.priority / DEFAULT_TASKPRIORITY))
+        return min(self.maxInterval, max(task.minInterval, age * self.ageFactor)) * priorityFactor
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._queue or self._queue[0][0] > monotonic()):
+                    self._condition.wait(timeout=self._queue[0][0] - monotonic() if self._queue else None)
+                if not self._running:
+                    break
+                now = monotonic()
+                due = []
+                while self._queue and self._queue[0][0] <= now:
+                    due.append(heapq.heappop(self._queue)[2])
+
+            # Cancelled futures are dropped, the rest is polled in parallel
+            due = [task for task in due if not task.future.done()]
+            try:
+                polls = {self._executor.submit(self.connector.system.getTaskStatus, taskID=task.taskID): task for task in due}
+                wait(polls)
+                self.statusRequests += len(polls)
+
+                with self._condition:
+                    for poll, task in polls.items():
+                        self._handlePoll(task, poll)
+            except Exception as e:
+                # The loop is shared by every tracked task, one bad poll only fails the tasks it was polling
+                for task in due:
+                    self._resolve(task, exception=e)
+
+        # Anything left when shutting down will never finish
+        with self._condition:
+            for _, _, task in self._queue:
+                task.future.cancel()
+            self._queue = []
+
+    def _resolve(self, task: _TrackedTask, result: dict = None, exception: Exception = None):
+        # The future can be cancelled by its owner while it is being polled
+        if task.future.done():
+            return
+        try:
+            if exception is not None:
+                task.future.set_exception(exception)
+            else:
+                task.future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def _handlePoll(self, task: _TrackedTask, poll: Future):
+        if task.future.done():
+            return
+        task.polls += 1
+        try:
+            resp = poll.result()
+            if not resp.success:
+                raise RuntimeError(f"There was an issue getting the status of task {task.taskID}: {resp.text}")
+            status = resp.contentAsDict()
+            finished = status['task']['@finished'] == "True"
+        except Exception as e:
+            self._resolve(task, exception=e)
+            return
+
+        if self.debug: print(f"Polled Task {task.taskID}: Finished: {finished} after {task.polls} polls")
+        if finished:
+            self._resolve(task, result=status)
+            return
+
+        nextPoll = monotonic() + self._nextInterval(task)
+        if task.deadline is not None and nextPoll > task.deadline:
+            if monotonic() >= task.deadline:
+                self._resolve(task, exception=TimeoutError(f"Task {task.taskID} did not finish in time"))
+                return
+            nextPoll = task.deadline
+        self._push(task, nextPoll)
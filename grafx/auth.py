@@ -2,10 +2,15 @@ import requests
 import datetime
 
 from os import getenv
+from threading import Lock
 
 
 class GraFxAuth:
-    def __init__(self, client_id: str = None, client_secret: str = None):
+    def __init__(self, client_id: str = None, client_secret: str = None, session: requests.Session = None):
+        # Reuse the connectors pooled session when there is one
+        self.session = session if session is not None else requests.Session()
+        self._token_lock = Lock()
+
         # Check if credentials were supplied
         if all([client_id, client_secret]):
             self.client_id = client_id
@@ -24,6 +29,13 @@ class GraFxAuth:
         if hasattr(self, "_token") and not self._is_token_expired(self._token):
           return self._token["access_token"]
 
+        # Only one thread refreshes the token, the others wait and reuse it
+        with self._token_lock:
+            if hasattr(self, "_token") and not self._is_token_expired(self._token):
+                return self._token["access_token"]
+            return self._generate_token()
+
+    def _generate_token(self):
         headers = {
             "content-type": "application/json",
         }
@@ -49,7 +61,7 @@ class GraFxAuth:
                 "client_secret": self.client_secret,
             }
 
-        resp = requests.post(
+        resp = self.session.post(
             url=url,
             headers=headers,
             json=body)
@@ -1,31 +1,38 @@
 import requests
 import json
+from time import perf_counter
 from chilitools.grafx.auth import GraFxAuth
+from chilitools.grafx.session import create_session
 from chilitools.grafx.environment import GraFxEnvironment
 from chilitools.grafx.api.environment import Templates
 from chilitools.grafx.api.platform import Platform
+from chilitools.utilities.metrics import RequestMetrics
 
 
 #Todo(austin): Make some like exception handling thing where you just check_response(resp) and it throws for the usual 401 stuff, etc.
 
 # Gonna embrace the class madness I guess.
 class GraFxConnector:
-    def __init__(self, environment: str, environment_type: str = "production", client_id: str = None, client_secret: str = None, logger = None, api_version: str = "1"):
+    def __init__(self, environment: str, environment_type: str = "production", client_id: str = None, client_secret: str = None, logger = None, api_version: str = "1", session: requests.Session = None, pool_size: int = 10, metrics: RequestMetrics = None):
         self.environment = environment
-        self.auth = GraFxAuth(client_id, client_secret)
+        # One pooled keep-alive session for every call made through this connector (and its auth), safe to share between threads
+        self.session = session if session is not None else create_session(pool_size=pool_size)
+        self.auth = GraFxAuth(client_id, client_secret, session=self.session)
         self.environment = GraFxEnvironment(
             environment_name=environment,
             environment_type=environment_type,
             api_version=api_version
         )
         self.logger = logger
+        # Per endpoint request metrics, can be shared with other connectors
+        self.metrics = metrics if metrics is not None else RequestMetrics()
         self.templates = Templates(self)
         self.platform = Platform(self)
 
     def make_request(self, api: str, method: str, endpoint: str, headers: dict = None, query_params: dict = None, body: dict = None):
 
         if api == "platform":
-            req_url = self.platform_base_url + endpoint
+            req_url = self.platform.base_url + endpoint
         else:
             req_url = self.environment.base_url + endpoint
 
@@ -42,14 +49,23 @@ class GraFxConnector:
         if not body: body = {}
         if isinstance(body, dict): body = json.dumps(body)
 
-        resp = requests.request(method=req_method,
-                                url=req_url,
-                                headers=req_headers,
-                                params=query_params,
-                                data=body)
+        start = perf_counter()
+        try:
+            resp = self.session.request(method=req_method,
+                                        url=req_url,
+                                        headers=req_headers,
+                                        params=query_params,
+                                        data=body)
+        except requests.RequestException as e:
+            self.metrics.record(req_method, endpoint, e.__class__.__name__, perf_counter() - start, api=f"grafx-{api}")
+            raise
+        self.metrics.recordResponse(req_method, endpoint, resp, perf_counter() - start, api=f"grafx-{api}")
 
         return resp
 
+    def close(self):
+        self.session.close()
+
 
 
 
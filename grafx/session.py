@@ -0,0 +1,13 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def create_session(pool_size: int = 10, pool_block: bool = False) -> requests.Session:
+    """Creates a requests Session with a connection pool sized for `pool_size` concurrent requests per host.
+    Connections are kept alive and reused between requests, so threads sharing the session skip the TCP+TLS handshake.
+    With `pool_block` threads wait for a free connection instead of opening throwaway ones when the pool is exhausted."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=pool_block)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -0,0 +1,175 @@
+"""Benchmarks of the main workflows against local MockChiliServers, reports the throughput and peak memory of each.
+The mock servers run in the same process, so the peak memory is that of the client and both servers combined.
+
+    python -m chilitools.mock.benchmarks --items 10 --latency 0.02 --workers 8
+"""
+import argparse
+import json
+import logging
+import tracemalloc
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from os import devnull
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+from chilitools.api import connector as connectorModule
+from chilitools.api.connector import ChiliConnector
+from chilitools.mock.server import MockChiliServer
+from chilitools.utilities.personalise import PersonalisationEngine
+from chilitools.utilities.render import batchGenerateAndDownloadPDF
+from chilitools.utilities.ServerMigration import ServerMigrator
+
+
+@contextmanager
+def _temporaryAPIKeyFile():
+    # The keys of the mock servers are stored in a temporary file instead of the package's settings/apiKeys.txt
+    directory = mkdtemp(prefix='chilitools-benchmark-')
+    previous = connectorModule.APIKEY_FILE
+    connectorModule.APIKEY_FILE = f'{directory}/apiKeys.txt'
+    try:
+        yield
+    finally:
+        connectorModule.APIKEY_FILE = previous
+        rmtree(directory, ignore_errors=True)
+
+def _connector(server: MockChiliServer) -> ChiliConnector:
+    # Credentials are passed so the connector never asks for them, the mock accepts any
+    return ChiliConnector(server.backofficeURL, username='benchmark', password='benchmark', debugLevel=0)
+
+def treeCrawl(source: MockChiliServer, dest: MockChiliServer, options) -> int:
+    return sum(1 for _ in _connector(source).resources.iterTreeItems('assets', workers=options.workers))
+
+def existenceIndex(source: MockChiliServer, dest: MockChiliServer, options) -> int:
+    return len(_connector(source).resources.getItemIDs('assets'))
+
+def _migrate(source: MockChiliServer, dest: MockChiliServer, options, resource: str) -> int:
+    directory = mkdtemp(prefix='chilitools-benchmark-')
+    migrator = ServerMigrator(_connector(source), _connector(dest), directory, workers=options.workers, blankCheckDelay=0)
+    migrator.logger.setLevel(logging.WARNING)
+    try:
+        migrator.transferResource(resource)
+    finally:
+        migrator.journal.close()
+        for handler in [h for h in migrator.logger.handlers if isinstance(h, logging.FileHandler)]:
+            handler.close()
+            migrator.logger.removeHandler(handler)
+        rmtree(directory, ignore_errors=True)
+    return len(dest.items[resource])
+
+def migrateAssets(source: MockChiliServer, dest: MockChiliServer, options) -> int:
+    return _migrate(source, dest, options, 'assets')
+
+def migrateDocuments(source: MockChiliServer, dest: MockChiliServer, options) -> int:
+    # The documents bring their assets and fonts along
+    return _migrate(source, dest, options, 'documents')
+
+def batchPDF(source: MockChiliServer, dest: MockChiliServer, options) -> int:
+    outputFolder = mkdtemp(prefix='chilitools-benchmark-')
+    try:
+        summary = batchGenerateAndDownloadPDF(_connector(source), outputFolder, documentIDs=list(source.items['documents']), settingsID='pdf-settings', concurrency=options.workers)
+    finally:
+        rmtree(outputFolder, ignore_errors=True)
+    return summary['succeeded']
+
+def personalise(source: MockChiliServer, dest: MockChiliServer, options) -> int:
+    outputFolder = mkdtemp(prefix='chilitools-benchmark-')
+    records = ({'firstName': f'First {i}', 'lastName': f'Last {i}'} for i in range(options.records))
+    try:
+        engine = PersonalisationEngine(_connector(source), next(iter(source.items['documents'])), outputFolder, settingsID='pdf-settings', concurrency=options.workers, checkpointFile=f'{outputFolder}/checkpoint.json')
+        summary = engine.run(records)
+    finally:
+        rmtree(outputFolder, ignore_errors=True)
+    return summary['succeeded']
+
+WORKFLOWS = {
+    'treeCrawl': treeCrawl,
+    'existenceIndex': existenceIndex,
+    'migrateAssets': migrateAssets,
+    'migrateDocuments': migrateDocuments,
+    'batchPDF': batchPDF,
+    'personalise': personalise,
+}
+
+
+def runBenchmark(name: str, options) -> dict:
+    """Runs one workflow against a fresh source and destination server"""
+    serverOptions = dict(
+        latency=options.latency,
+        jitter=options.jitter,
+        failureRate=options.failureRate,
+        treeDepth=options.depth,
+        foldersPerLevel=options.folders,
+        itemsPerFolder=options.items,
+        assetSize=options.assetSize,
+        documentFrames=options.frames,
+        pdfSize=options.pdfSize,
+        renderSeconds=options.renderSeconds
+    )
+    # The destination starts out empty except for its PDF export settings
+    with _temporaryAPIKeyFile(), MockChiliServer(port=options.port, **serverOptions) as source, MockChiliServer(port=options.port + 1, **dict(serverOptions, itemsPerFolder=0, treeDepth=0)) as dest:
+        tracemalloc.start()
+        start = perf_counter()
+        try:
+            # The workflows print a lot of progress, only the results table is wanted
+            with open(devnull, 'w') as silenced, (nullcontext() if options.verbose else redirect_stdout(silenced)):
+                items = WORKFLOWS[name](source, dest, options)
+            error = None
+        except Exception as e:
+            items = 0
+            error = f"{e.__class__.__name__}: {e}"
+        seconds = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        requests = sum(source.requests.values()) + sum(dest.requests.values())
+
+    return {
+        'workflow': name,
+        'items': items,
+        'seconds': round(seconds, 3),
+        'itemsPerSecond': round(items / seconds, 2) if seconds else 0,
+        'requests': requests,
+        'requestsPerSecond': round(requests / seconds, 2) if seconds else 0,
+        # Client and mock servers together
+        'combinedPeakMemoryMB': round(peak / 1024 / 1024, 2),
+        'error': error
+    }
+
+def main(args: list = None):
+    parser = argparse.ArgumentParser(description="Benchmarks chilitools workflows against a local mock CHILI Publisher server")
+    parser.add_argument('--only', nargs='+', choices=list(WORKFLOWS), help="Workflows to run, defaults to all of them")
+    parser.add_argument('--workers', type=int, default=8, help="Concurrency of the crawlers, migrator and renderers")
+    parser.add_argument('--latency', type=float, default=0.01, help="Seconds added to every request by the mock server")
+    parser.add_argument('--jitter', type=float, default=0, help="Random extra latency in seconds, up to this much")
+    parser.add_argument('--failure-rate', dest='failureRate', type=float, default=0, help="Fraction of the requests that fail with a 503")
+    parser.add_argument('--depth', type=int, default=2, help="Folder levels of the generated resource trees")
+    parser.add_argument('--folders', type=int, default=3, help="Folders per level")
+    parser.add_argument('--items', type=int, default=5, help="Items per folder")
+    parser.add_argument('--asset-size', dest='assetSize', type=int, default=64 * 1024, help="Bytes per asset and font file")
+    parser.add_argument('--frames', type=int, default=20, help="Frames per document")
+    parser.add_argument('--pdf-size', dest='pdfSize', type=int, default=256 * 1024, help="Bytes per rendered PDF")
+    parser.add_argument('--render-seconds', dest='renderSeconds', type=float, default=0.5, help="Seconds a PDF task takes")
+    parser.add_argument('--records', type=int, default=100, help="Records for the personalise workflow")
+    parser.add_argument('--port', type=int, default=8700, help="Port of the source server, the destination uses the next one")
+    parser.add_argument('--json', dest='jsonFile', help="Also write the results to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Show what the workflows print")
+    options = parser.parse_args(args)
+
+    results = []
+    print(f"{'workflow':<18}{'items':>8}{'seconds':>10}{'items/s':>10}{'requests':>10}{'req/s':>10}{'peak MB*':>10}")
+    for name in options.only or WORKFLOWS:
+        result = runBenchmark(name, options)
+        results.append(result)
+        print(f"{name:<18}{result['items']:>8}{result['seconds']:>10}{result['itemsPerSecond']:>10}{result['requests']:>10}{result['requestsPerSecond']:>10}{result['combinedPeakMemoryMB']:>10}")
+        if result['error']: print(f"  {result['error']}")
+
+    print("* peak memory of the client and both mock servers, they run in the same process")
+
+    if options.jsonFile is not None:
+        with open(options.jsonFile, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+import base64
+import json
+import random
+import re
+import sys
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic, sleep
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape, quoteattr
+
+
+class MockChiliServer:
+    """Local stand-in for a CHILI Publisher server, implements the REST endpoints this package uses so the migrator,
+    the tree crawlers and the PDF helpers can be run and measured without a live environment.
+
+    Every resource type starts with a generated tree of `foldersPerLevel` folders per level, `treeDepth` levels deep and
+    `itemsPerFolder` items per folder. Documents reference random assets and fonts. Everything is kept in memory,
+    uploads and saves change the state like they would on a real server.
+
+    The base URL of a connector is `server.backofficeURL`. Any API key is accepted, but one has to be sent.
+
+    :param latency: Seconds added to every request
+    :param jitter: Random extra seconds, up to this much, added to every request
+    :param failureRate: Fraction of the requests (except for API keys) answered with `failureStatus`
+    :param assetSize: Size in bytes of the generated asset and font files
+    :param documentFrames: Amount of frames in a generated document, sets the size of the document XML
+    :param pdfSize: Size in bytes of a rendered PDF
+    :param renderSeconds: Time a PDF task takes to finish
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, environment: str = 'mock', latency: float = 0, jitter: float = 0, failureRate: float = 0, failureStatus: int = 503, treeDepth: int = 2, foldersPerLevel: int = 3, itemsPerFolder: int = 5, assetSize: int = 64 * 1024, documentFrames: int = 20, pdfSize: int = 256 * 1024, renderSeconds: float = 0.5, seed: int = 0):
+        self.host = host
+        self.port = port
+        self.environment = environment
+        self.latency = latency
+        self.jitter = jitter
+        self.failureRate = failureRate
+        self.failureStatus = failureStatus
+        self.assetSize = assetSize
+        self.documentFrames = documentFrames
+        self.pdfSize = pdfSize
+        self.renderSeconds = renderSeconds
+        self.requests = Counter()
+
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._ids = 0
+        self._nextItemIDs = {}
+        self._tasks = {}
+        self._server = None
+        self._thread = None
+
+        # resource type (lower case) -> item ID -> item dict with name, path, and the xml/data once it was uploaded
+        self.items = {'assets': {}, 'fonts': {}, 'documents': {}, 'pdfexportsettings': {}}
+        # resource type -> folder path -> items and sub folders directly in it, so a tree level doesn't scan every item
+        self._children = {}
+        self._subFolders = {}
+        for resourceType in ('assets', 'fonts', 'documents'):
+            self._generateTree(resourceType, '', treeDepth, foldersPerLevel, itemsPerFolder)
+        self.addItem('pdfexportsettings', 'Default', xml='<item name="Default" />', itemID='pdf-settings')
+
+    @property
+    def backofficeURL(self) -> str:
+        return f"http://{self.host}:{self.port}/{self.environment}/interface.aspx"
+
+    def start(self):
+        self._server = _MockHTTPServer((self.host, self.port), _MockHandler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self.port = self._server.server_address[1]
+        self._thread = Thread(target=self._server.serve_forever, name='MockChiliServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def addItem(self, resourceType: str, name: str, folder: str = '', xml: str = None, data: bytes = None, itemID: str = None) -> dict:
+        resourceType = resourceType.lower()
+        with self._lock:
+            if itemID is None:
+                itemID = self._nextItemIDs.pop(resourceType, None) or self._newID()
+            item = {'id': itemID, 'name': name, 'xml': xml, 'data': data, 'modified': _timestamp()}
+            self.items.setdefault(resourceType, {})[itemID] = item
+            self._place(resourceType, item, folder)
+        return item
+
+    def moveItem(self, resourceType: str, itemID: str, newName: str, folder: str):
+        resourceType = resourceType.lower()
+        with self._lock:
+            item = self.items[resourceType][itemID]
+            self._unplace(resourceType, item)
+            item['name'] = newName or item['name']
+            self._place(resourceType, item, folder)
+
+    def deleteItem(self, resourceType: str, itemID: str):
+        resourceType = resourceType.lower()
+        with self._lock:
+            self._unplace(resourceType, self.items[resourceType].pop(itemID))
+
+    def _newID(self) -> str:
+        self._ids += 1
+        return f"{self._ids:08x}-0000-4000-8000-{self._ids:012x}"
+
+    def _place(self, resourceType: str, item: dict, folder: str):
+        item['folder'] = folder
+        item['path'] = f"{folder}\\{item['name']}" if folder else item['name']
+        self._children.setdefault(resourceType, {}).setdefault(folder, {})[item['id']] = item
+        self._addFolder(resourceType, folder)
+
+    def _unplace(self, resourceType: str, item: dict):
+        self._children[resourceType][item['folder']].pop(item['id'], None)
+
+    def _addFolder(self, resourceType: str, folder: str):
+        # Every folder is registered in its parent, up to the root
+        while folder:
+            parent = folder.rpartition('\\')[0]
+            subFolders = self._subFolders.setdefault(resourceType, {}).setdefault(parent, set())
+            if folder in subFolders:
+                return
+            subFolders.add(folder)
+            folder = parent
+
+    def _generateTree(self, resourceType: str, folder: str, depth: int, foldersPerLevel: int, itemsPerFolder: int):
+        extension = {'assets': 'png', 'fonts': 'otf', 'documents': 'xml'}[resourceType]
+        for i in range(itemsPerFolder):
+            self.addItem(resourceType, f"{resourceType[:-1]}{i}.{extension}", folder)
+        if depth > 0:
+            for i in range(foldersPerLevel):
+                subFolder = f"{folder}\\folder{i}" if folder else f"folder{i}"
+                with self._lock:
+                    self._addFolder(resourceType, subFolder)
+                self._generateTree(resourceType, subFolder, depth - 1, foldersPerLevel, itemsPerFolder)
+
+    def fileData(self, resourceType: str, item: dict) -> bytes:
+        if item['data'] is not None:
+            return item['data']
+        pattern = item['id'].encode()
+        return (pattern * (self.assetSize // len(pattern) + 1))[:self.assetSize]
+
+    def itemXML(self, resourceType: str, item: dict) -> str:
+        if item['xml'] is not None:
+            return item['xml']
+        if resourceType == 'documents':
+            return self._documentXML(item)
+        return f'<item id="{item["id"]}" name={quoteattr(item["name"])} relativePath={quoteattr(item["path"])} />'
+
+    def definitionXML(self, resourceType: str, item: dict) -> str:
+        fileSize = ''
+        if resourceType in ('assets', 'fonts'):
+            fileSize = f' fileSize="{len(self.fileData(resourceType, item))}"'
+        fileInfo = f'<fileInfo fileIndexed="{item["modified"]}"{fileSize} />'
+        return f'<item id="{item["id"]}" name={quoteattr(item["name"])} relativePath={quoteattr(item["path"])} isFolder="false">{fileInfo}</item>'
+
+    def _documentXML(self, item: dict) -> str:
+        # Seeded by the ID so a document is the same every time it is requested
+        rnd = random.Random(item['id'])
+        assets = list(self.items['assets'])
+        fonts = list(self.items['fonts'])
+        usedFonts = rnd.sample(fonts, min(3, len(fonts)))
+        frames = []
+        for i in range(self.documentFrames):
+            if i % 2 == 0 and assets:
+                frames.append(f'<item id="frame{i}" type="image" hasContent="true" externalID="{rnd.choice(assets)}" x="{i}" y="{i}" width="100" height="100" />')
+            else:
+                frames.append(f'<item id="frame{i}" type="text" x="{i}" y="{i}" width="100" height="20"><textFlow><p><span font="{rnd.choice(usedFonts) if usedFonts else ""}">Text frame {i}</span></p></textFlow></item>')
+        fontItems = ''.join(f'<item id="{font}" name="font" />' for font in usedFonts)
+        return (
+            f'<document id="{item["id"]}" name={quoteattr(item["name"])}>'
+            f'<variables><item name="firstName" value="" /><item name="lastName" value="" /></variables>'
+            f'<fonts>{fontItems}</fonts>'
+            f'<pages><item id="page1"><frames>{"".join(frames)}</frames></item></pages>'
+            f'</document>'
+        )
+
+    def treeXML(self, resourceType: str, parentFolder: str, numLevels: int) -> str:
+        return f'<tree>{self._treeLevel(resourceType, parentFolder, numLevels)}</tree>'
+
+    def _treeLevel(self, resourceType: str, folder: str, numLevels: int) -> str:
+        out = []
+        with self._lock:
+            subFolders = sorted(self._subFolders.get(resourceType, {}).get(folder, ()))
+            items = list(self._children.get(resourceType, {}).get(folder, {}).values())
+        for subFolder in subFolders:
+            children = self._treeLevel(resourceType, subFolder, numLevels - 1) if numLevels != 1 else ''
+            name = subFolder.rpartition('\\')[2]
+            out.append(f'<item name={quoteattr(name)} path={quoteattr(subFolder)} isFolder="true">{children}</item>')
+        for item in items:
+            # Like CHILI the modification date is in the file info
+            out.append(f'<item id="{item["id"]}" name={quoteattr(item["name"])} path={quoteattr(item["path"])} isFolder="false"><fileInfo fileIndexed="{item["modified"]}" /></item>')
+        return ''.join(out)
+
+    def createTask(self) -> str:
+        with self._lock:
+            taskID = self._newID()
+            self._tasks[taskID] = monotonic() + self.renderSeconds
+        return taskID
+
+    def taskXML(self, taskID: str) -> str:
+        finished = monotonic() >= self._tasks[taskID]
+        result = escape(f'<result url="http://{self.host}:{self.port}/mock/pdf/{taskID}.pdf" />', {'"': '&quot;'}) if finished else ''
+        return f'<task id="{taskID}" finished="{finished}" succeeded="{finished}" result="{result}" errorMessage="" />'
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients closing their keep-alive connections is not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle every response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+    _apiPath = re.compile(r'^/rest-api/v[^/]+(/.*)$')
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def mock(self) -> MockChiliServer:
+        return self.server.mock
+
+    def do_GET(self): self._handle('GET')
+    def do_POST(self): self._handle('POST')
+    def do_PUT(self): self._handle('PUT')
+    def do_DELETE(self): self._handle('DELETE')
+
+    def _handle(self, method: str):
+        url = urlparse(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        body = self._readBody()
+
+        delay = self.mock.latency + (self.mock._random.uniform(0, self.mock.jitter) if self.mock.jitter else 0)
+        if delay: sleep(delay)
+
+        match = self._apiPath.match(url.path)
+        path = match.group(1) if match else url.path
+        route, handler, args = _route(method, path)
+        self.mock.requests[f"{method} {route}"] += 1
+
+        if route != '/system/apikey' and self.mock.failureRate and self.mock._random.random() < self.mock.failureRate:
+            return self._send(self.mock.failureStatus, '<error message="Simulated failure" />')
+        if match and route != '/system/apikey' and not self.headers.get('API-KEY'):
+            return self._send(401, '<error message="No API key" />')
+        if handler is None:
+            return self._send(404, f'<error message="Unknown endpoint {escape(method)} {escape(path)}" />')
+        try:
+            handler(self, body, *args)
+        except KeyError as e:
+            self._send(404, f'<error message="Item not found {escape(str(e))}" />')
+
+    def _readBody(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _json(self, body: bytes) -> dict:
+        return json.loads(body) if body else {}
+
+    def _send(self, status: int, body, contentType: str = 'application/xml'):
+        if isinstance(body, str): body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _item(self, resourceType: str, itemID: str) -> dict:
+        return self.mock.items[resourceType.lower()][itemID]
+
+    def apiKey(self, body):
+        self._send(200, f'<apiKey succeeded="true" key="mock-{self.mock._newID()}" validTill="2099-12-31 23:59:59Z" />')
+
+    def ok(self, body, *args):
+        self._send(200, '<ok />')
+
+    def resourceList(self, body):
+        self._send(200, '<resources>' + ''.join(f'<item name="{name}" />' for name in ('Assets', 'Fonts', 'Documents', 'PdfExportSettings')) + '</resources>')
+
+    def treeLevel(self, body, resourceType):
+        numLevels = int(self.query.get('numLevels', 1))
+        self._send(200, self.mock.treeXML(resourceType.lower(), self.query.get('parentFolder', '').strip('\\'), numLevels))
+
+    def itemXML(self, body, resourceType, itemID):
+        self._send(200, self.mock.itemXML(resourceType.lower(), self._item(resourceType, itemID)))
+
+    def definitionXML(self, body, resourceType, itemID):
+        self._send(200, self.mock.definitionXML(resourceType.lower(), self._item(resourceType, itemID)))
+
+    def download(self, body, resourceType):
+        item = self._item(resourceType, self.query['id'])
+        self._send(200, self.mock.fileData(resourceType.lower(), item), contentType='application/octet-stream')
+
+    def addItem(self, body, resourceType):
+        fields = self._json(body)
+        data = base64.b64decode(fields['fileData']) if fields.get('fileData') else None
+        item = self.mock.addItem(resourceType, self.query.get('newName', ''), self.query.get('folderPath', '').strip('\\/'), xml=fields.get('xml') or None, data=data)
+        self._send(200, self.mock.definitionXML(resourceType.lower(), item))
+
+    def saveItem(self, body, resourceType, itemID):
+        self._item(resourceType, itemID).update(xml=self._json(body)['xml'], modified=_timestamp())
+        self.ok(body)
+
+    def replaceFile(self, body, resourceType, itemID):
+        self._item(resourceType, itemID).update(data=base64.b64decode(self._json(body)['fileData']), modified=_timestamp())
+        self.ok(body)
+
+    def deleteItem(self, body, resourceType, itemID):
+        self.mock.deleteItem(resourceType, itemID)
+        self.ok(body)
+
+    def moveItem(self, body, resourceType, itemID):
+        self.mock.moveItem(resourceType, itemID, self.query.get('newName'), self.query.get('newFolderPath', '').strip('\\/'))
+        self.ok(body)
+
+    def nextItemID(self, body, resourceType):
+        with self.mock._lock:
+            self.mock._nextItemIDs[resourceType.lower()] = self.query['itemID']
+        self.ok(body)
+
+    def createPDF(self, body, documentID=None):
+        if documentID is not None:
+            self._item('documents', documentID)
+        self._send(200, f'<task id="{self.mock.createTask()}" />')
+
+    def taskStatus(self, body, taskID):
+        self._send(200, self.mock.taskXML(taskID))
+
+    def pdf(self, body, taskID):
+        self._send(200, (b'%PDF-1.4\n' + taskID.encode() * (self.mock.pdfSize // len(taskID) + 1))[:self.mock.pdfSize], contentType='application/pdf')
+
+
+_routes = [
+    ('POST', '/system/apikey', _MockHandler.apiKey),
+    ('PUT', '/system/apikey/autopreviewgeneration', _MockHandler.ok),
+    ('GET', '/system/tasks/{id}/status', _MockHandler.taskStatus),
+    ('GET', '/resources', _MockHandler.resourceList),
+    ('PUT', '/resources/documents/documentprocessor', _MockHandler.ok),
+    ('POST', '/resources/documents/tempxml/pdf', _MockHandler.createPDF),
+    ('POST', '/resources/documents/{id}/representations/pdf', _MockHandler.createPDF),
+    ('GET', '/resources/{type}/treelevel', _MockHandler.treeLevel),
+    ('GET', '/resources/{type}/download', _MockHandler.download),
+    ('POST', '/resources/{type}/nextitemid', _MockHandler.nextItemID),
+    ('POST', '/resources/{type}/items', _MockHandler.addItem),
+    ('GET', '/resources/{type}/items/{id}/xml', _MockHandler.itemXML),
+    ('GET', '/resources/{type}/items/{id}/definitionxml', _MockHandler.definitionXML),
+    ('PUT', '/resources/{type}/items/{id}/save', _MockHandler.saveItem),
+    ('PUT', '/resources/{type}/items/{id}/file', _MockHandler.replaceFile),
+    ('PUT', '/resources/{type}/items/{id}/move', _MockHandler.moveItem),
+    ('DELETE', '/resources/{type}/items/{id}', _MockHandler.deleteItem),
+    ('GET', '/mock/pdf/{id}.pdf', _MockHandler.pdf),
+]
+_compiledRoutes = [(method, template, re.compile('^' + re.sub(r'\\\{[^}]+\\\}', '([^/]+?)', re.escape(template)) + '$'), handler) for method, template, handler in _routes]
+
+def _route(method: str, path: str) -> tuple:
+    for routeMethod, template, pattern, handler in _compiledRoutes:
+        if routeMethod == method:
+            match = pattern.match(path)
+            if match:
+                return template, handler, match.groups()
+    return path, None, ()
+
+def _timestamp() -> str:
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
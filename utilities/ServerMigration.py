@@ -1,18 +1,35 @@
-import base64
+from os import remove
+from os.path import isfile, getsize
 from time import sleep
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock
+from requests.adapters import HTTPAdapter
 from chilitools.api.connector import ChiliConnector
-from chilitools.utilities.file import writeFile, readFile, checkForFile
+from chilitools.utilities.file import writeFile, readFile, checkForFile, fileChecksum, HashWriter
+from chilitools.utilities.strings import convertFileSize
 from chilitools.utilities.logger import getLogger
-from chilitools.utilities.document import ChiliDocument
+from chilitools.utilities.document import extract_dependencies, is_blank_xml
+from chilitools.utilities.journal import ProgressJournal
+from chilitools.utilities.migrationplan import MigrationPlan
+from chilitools.utilities.defaults import PARSER_NONE, VERIFY_SIZE, VERIFY_CHECKSUM
+
+# The modification date attribute depends on the resource type and the CHILI version, assets only have fileInfo/@fileIndexed
+_modifiedAttributes = ('@modifiedDate', '@dateModified', '@fileModified', '@modified', '@fileIndexed')
 
 
 class ServerMigrator:
-  def __init__(self, srcChili: ChiliConnector, destChili: ChiliConnector, directory: str, verbose: bool = False, update: bool = False):
+  def __init__(self, srcChili: ChiliConnector, destChili: ChiliConnector, directory: str, verbose: bool = False, update: bool = False, interval: float = 0, workers: int = 1, journalCompactEvery: int = 1000, existenceIndex: bool = True, verify: str = VERIFY_SIZE, verifyRetries: int = 4, deferVerification: bool = False, blankCheckRetries: int = 5, blankCheckDelay: float = 0.5, blankCheckMaxDelay: float = 8, resizePools: bool = True):
+    # Guards the progress dict and file, the worker threads all report into it
+    self._progressLock = RLock()
     # Try to load the progress JSON file
     self.progressFile = directory+'/progress.json'
-    if checkForFile(fileName=self.progressFile):
+    # Finished and queued items are appended to a journal, the full progress is only rewritten when it is compacted
+    self.journal = ProgressJournal(snapshotFile=self.progressFile, compactEvery=journalCompactEvery)
+    if self.journal.exists():
       print("Found progress file for server migration, loading it.")
-      self.progress = readFile(fileName=self.progressFile, isJSON=True)
+      self.progress, entries = self.journal.load()
+      self.__replayJournal(entries)
       if self.progress.get('sourceUsername'):
         print("Loading user information for source environment")
         self.source = ChiliConnector(backofficeURL=self.progress['sourceURL'], username=self.progress['sourceUsername'], password=self.progress['sourcePassword'])
@@ -40,9 +57,49 @@ class ServerMigrator:
     self.directory = directory
     self.logger = getLogger(directory+'/ServerMigrator.log')
     self.verbose = verbose
-    self.interval = 1
+    # Optional fixed pause between items, server push back is handled by the connectors RetryPolicy
+    self.interval = interval
     self.update = update
 
+    # Amount of items transferred at the same time
+    self.workers = max(1, workers)
+    self._reserveLocks = defaultdict(RLock)
+    self._queueLocks = defaultdict(RLock)
+    self._remaining = {}
+
+    # Items transferred or found on the destination during this session, and the dependency graph of the documents
+    self._transferred = set()
+    self.plan = MigrationPlan()
+
+    # IDs of the items on the destination, crawled once per resource type instead of checking every item with a request
+    self.existenceIndex = existenceIndex
+    self._destIndex = {}
+    self._destIndexLocks = defaultdict(RLock)
+
+    # How uploaded assets and fonts are checked against the local copy, see verifyTransfers
+    if verify not in (VERIFY_SIZE, VERIFY_CHECKSUM, None):
+      raise ValueError(f"verify must be '{VERIFY_SIZE}', '{VERIFY_CHECKSUM}' or None")
+    self.verify = verify
+    self.verifyRetries = verifyRetries
+    self.deferVerification = deferVerification
+
+    # Saved documents are checked for being blank after blankCheckDelay seconds, doubling up to blankCheckMaxDelay between saves
+    self.blankCheckRetries = blankCheckRetries
+    self.blankCheckDelay = blankCheckDelay
+    self.blankCheckMaxDelay = blankCheckMaxDelay
+    if self.workers > 1 and resizePools:
+      # Every worker needs its own keep-alive connection to both servers
+      for connector in (self.source, self.dest):
+        self.__resizePool(connector)
+
+  def __resizePool(self, connector: ChiliConnector):
+    # Only the default adapters requests mounts are replaced, a pool the caller set up (retries, TLS, its own size) is kept
+    for prefix in ('https://', 'http://'):
+      adapter = connector.session.adapters.get(prefix)
+      if type(adapter) is not HTTPAdapter or adapter.max_retries.total != 0 or adapter._pool_maxsize >= self.workers:
+        continue
+      connector.session.mount(prefix, HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, pool_block=adapter._pool_block))
+
   def getResourceTrees(self):
     self.logger.info("Getting list of resource items")
     resources = set()
@@ -72,15 +129,25 @@ class ServerMigrator:
   def transferList(self, resource: str, itemList: str):
     resource = resource.lower()
 
-    if resource not in self.progress['resources'].keys():
-      self.progress['resources'][resource] = {'toTransfer':[]}
+    # Documents being transferred in parallel share dependencies, only one of them works the queue of a resource at a time
+    with self._queueLocks[resource]:
+
+      with self._progressLock:
+        if resource not in self.progress['resources'].keys():
+          self.progress['resources'][resource] = {'toTransfer':{}}
+
+      # Items still in the transfer queue from a previous transfer are transferred along with the new ones
+      queued = self.progress['resources'][resource].setdefault('toTransfer', {})
+      if len(queued) > 0:
+        self.logger.info(f'Found {resource} still queued to be transferred from previously')
 
-    # Check if there are items still in the transfer queue from a previous transfer
-    if 'toTransfer' in self.progress['resources'][resource].keys() and len(self.progress['resources'][resource]['toTransfer']) > 0:
-      self.logger.info(f'Found {resource} still queued to be transferred from previously')
-      self.__transferItems(resource)
-    else:
       for item in itemList:
+        # Dependencies shared between documents only have to be transferred once
+        if item in queued or (resource, item) in self._transferred:
+          continue
+        # Checking the index costs nothing, items already on the destination don't need their definition
+        if self.existenceIndex and self.existsOnDestination(resource, item):
+          continue
         if self.verbose:
           self.logger.info(f"Getting item definition XML for ID: {item}")
         resp = self.source.resources.ResourceItemGetDefinitionXML(
@@ -97,8 +164,7 @@ class ServerMigrator:
         else:
           itemXML = resp.contentAsDict()['item']
           itemXML['@path'] = itemXML['@relativePath']
-          self.progress['resources'][resource]['toTransfer'].append(itemXML)
-          #self._saveProgressFile()
+          self.__queueItem(resource, itemXML)
       self.__transferItems(resource=resource, disablePreviews=False)
 
   def transferResource(self, resource: str, parentFolder: str = '', customPath: str = None):
@@ -112,7 +178,7 @@ class ServerMigrator:
       self.logger.info(f'Found {resource} still queued to be transferred from previously')
       self.__transferItems(resource)
     else:
-      self.progress['resources'][resource]['toTransfer'] = []
+      self.progress['resources'][resource]['toTransfer'] = {}
       filePath = self.progress['resources'][resource]['treeFile']
       if checkForFile(fileName=filePath):
         items = readFile(self.progress['resources'][resource]['treeFile'], isJSON=True)
@@ -120,6 +186,8 @@ class ServerMigrator:
         if 'item' in items['tree']:
           self.__iterresource(resource, items['tree']['item'], customPath)
           self._saveProgressFile()
+          # Baseline for the next syncResource
+          self.__saveSnapshot(resource, self.__fingerprints(resource, self.progress['resources'][resource]['toTransfer']))
           self.__transferItems(resource)
         else:
           self.logger.info(f'There are no items to transfer for the {resource} resource')
@@ -128,6 +196,223 @@ class ServerMigrator:
         self.getResourceTree(resource)
         self.transferResource(resource)
 
+  def syncResource(self, resource: str, parentFolder: str = ''):
+    """Transfers only the items that were added, changed or moved on the source since the last transferResource or syncResource.
+    Items are compared by ID, path, file size and modification date with the snapshot saved by the previous run.
+    Items that were deleted on the source are reported but not deleted on the destination.
+    """
+    resource = resource.lower()
+    if len(self.progress['resources'].get(resource, {}).get('toTransfer', {})) > 0:
+      self.logger.info(f'Found {resource} still queued to be transferred from the previous run, finishing those first')
+      self.__transferItems(resource)
+      return
+
+    self.getResourceTree(resource, parentFolder)
+    tree = readFile(self.progress['resources'][resource]['treeFile'], isJSON=True)
+    self.progress['resources'][resource]['toTransfer'] = {}
+    if 'item' in tree['tree']:
+      self.__iterresource(resource, tree['tree']['item'])
+    current = self.progress['resources'][resource]['toTransfer']
+
+    snapshot = self.__loadSnapshot(resource)
+    if snapshot is None:
+      self.logger.info(f'There is no snapshot of a previous {resource} transfer, every item is treated as new')
+      snapshot = {}
+
+    fingerprints = self.__fingerprints(resource, current)
+    toTransfer = {}
+    moved = []
+    changed = 0
+    for itemID, item in current.items():
+      previous = snapshot.get(itemID)
+      fingerprint = fingerprints[itemID]
+      if previous is None:
+        toTransfer[itemID] = item
+      # A snapshot without a date for the item can only be compared on file size
+      elif previous['fileSize'] != fingerprint['fileSize'] or None not in (previous['modified'], fingerprint['modified']) and previous['modified'] != fingerprint['modified']:
+        item['@syncAction'] = 'update'
+        toTransfer[itemID] = item
+        changed += 1
+      elif previous['path'] != fingerprint['path']:
+        moved.append(item)
+    removed = len(snapshot.keys() - current.keys())
+    self.logger.info(f'{resource} changes since the last run: {len(toTransfer) - changed} added, {changed} changed, {len(moved)} moved, {removed} deleted on the source (not deleted on the destination)')
+
+    self.progress['resources'][resource]['toTransfer'] = toTransfer
+    self._saveProgressFile()
+    # Moved items keep their old path in the snapshot until they are moved or queued, so a move that
+    # is interrupted is picked up again by the next sync
+    self.__saveSnapshot(resource, {**fingerprints, **{item['@id']: snapshot[item['@id']] for item in moved}})
+
+    for item in moved:
+      if not self.existsOnDestination(resource, item['@id']):
+        self.__queueItem(resource, item)
+        continue
+      folderPath, _, newName = item['@path'].rpartition('\\')
+      self.logger.info(f"Moving {resource}: {item['@id']} to {item['@path']} on the destination")
+      try:
+        resp = self.dest.resources.ResourceItemMove(resourceType=resource, itemID=item['@id'], newName=newName, newFolderPath=folderPath)
+        error = None if resp.didSucceed() else resp.text
+      except Exception as e:
+        error = repr(e)
+      if error is not None:
+        self.logger.error(f"There was an issue moving {resource}: {item['@id']} on the destination, transferring it again instead\n{error}")
+        item['@syncAction'] = 'update'
+        self.__queueItem(resource, item)
+    if moved:
+      self._saveProgressFile()
+      self.__saveSnapshot(resource, fingerprints)
+
+    self.__transferItems(resource)
+
+  def verifyTransfers(self, resource: str):
+    """Checks the assets or fonts uploaded with deferVerification=True against their local copies in one pass,
+    re-uploads the ones that don't match from the local copy and then removes the local copies.
+    Items that still don't match are removed from the destination and queued to be transferred again
+    """
+    resource = resource.lower()
+    with self._progressLock:
+      items = list(self.progress['resources'].get(resource, {}).get('toVerify', {}).values())
+    if not items:
+      return
+    self.logger.info(f"Verifying {len(items)} transferred {resource}")
+
+    def verify(item: dict) -> bool:
+      if not isfile(item['file']):
+        self.logger.error(f"The local copy of {resource}: {item['@id']} is missing, it can not be verified")
+        verified = False
+      else:
+        verified = self.__verifyItem(resource, item, item['file'])
+        remove(item['file'])
+      if not verified:
+        # The item is already done, it goes back in the queue to be transferred from the source again
+        self.__discardItem(resource, {key: value for key, value in item.items() if key != 'file'}, requeue=True)
+      with self._progressLock:
+        self.progress['resources'][resource]['toVerify'].pop(item['@id'], None)
+        self.journal.append({'op': 'verified', 'resource': resource, 'id': item['@id']})
+      return verified
+
+    if self.workers > 1:
+      with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"ServerMigrator-verify") as pool:
+        results = list(pool.map(verify, items))
+    else:
+      results = [verify(item) for item in items]
+    self._saveProgressFile()
+    self.logger.info(f"Verified {results.count(True)} of {len(items)} {resource}, {results.count(False)} failed")
+
+  def __queueVerification(self, resource: str, r: dict, localFile: str):
+    # The whole tree item is kept so a failed verification can queue it again, and check the local copy against the source file size
+    item = {**r, 'file': localFile}
+    with self._progressLock:
+      self.progress['resources'][resource].setdefault('toVerify', {})[r['@id']] = item
+      self.journal.append({'op': 'verify', 'resource': resource, 'item': item})
+
+  def __sourceSize(self, r: dict) -> int:
+    # File size from the source tree item, None when the tree doesn't have it
+    size = r.get('@fileSize', (r.get('fileInfo') or {}).get('@fileSize'))
+    try:
+      return int(size)
+    except (TypeError, ValueError):
+      return None
+
+  def __matchesSource(self, resource: str, r: dict, localFile: str) -> bool:
+    # A bad download would otherwise be uploaded and then verified as correct against itself
+    if self.verify is None:
+      return True
+    sourceSize = self.__sourceSize(r)
+    if sourceSize is None or sourceSize == getsize(localFile):
+      return True
+    self.logger.error(f"{resource} downloaded with the wrong size from the source, {getsize(localFile)} bytes instead of {sourceSize} - Name: {r['@name']} -- Item ID: {r['@id']}")
+    return False
+
+  def __verifyItem(self, resource: str, r: dict, localFile: str) -> bool:
+    if self.verify is None:
+      return True
+    if not self.__matchesSource(resource, r, localFile):
+      return False
+    size = getsize(localFile)
+    checksum = fileChecksum(localFile) if self.verify == VERIFY_CHECKSUM else None
+    for attempt in range(self.verifyRetries + 1):
+      if self.__matchesDestination(resource, r['@id'], size, checksum):
+        return True
+      if attempt == self.verifyRetries:
+        break
+      # Re-upload the bytes we already have instead of downloading them from the source again
+      self.logger.error(f"{resource} on the destination does not match the local copy - Name: {r['@name']} -- Item ID: {r['@id']}\nRe-uploading it, {self.verifyRetries - attempt} tries left.")
+      resp = self.dest.resources.ResourceItemReplaceFile(resourceType=resource, itemID=r['@id'], filePath=localFile)
+      if not resp.didSucceed():
+        self.logger.error(f"There was an issue re-uploading {resource} - Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
+    self.logger.error(f"{resource} could not be verified on the destination - Name: {r['@name']} -- Item ID: {r['@id']}")
+    return False
+
+  def __matchesDestination(self, resource: str, itemID: str, size: int, checksum: str = None) -> bool:
+    resp = self.dest.resources.ResourceItemGetDefinitionXML(resourceType=resource, itemID=itemID)
+    if not resp.didSucceed():
+      return False
+    fileSize = resp.data['item'].get('fileInfo', {}).get('@fileSize')
+    if fileSize is None or int(fileSize) != size:
+      return False
+    if checksum is None:
+      return True
+    # CHILI doesn't expose a hash of the file so the destination copy is streamed back and hashed
+    hasher = HashWriter()
+    try:
+      self.dest.resources.DownloadAssetToFile(resourceType=resource, id=itemID, target=hasher, assetType='original', page=1, resume=False)
+    except Exception as e:
+      self.logger.error(f"There was an issue downloading {resource}: {itemID} from the destination for the checksum\n{e}")
+      return False
+    return hasher.hexdigest() == checksum
+
+  def __snapshotFile(self, resource: str) -> str:
+    return f"{self.directory}/{resource}/snapshot.json"
+
+  def __modifiedDate(self, item: dict) -> str:
+    # Not every resource type has file info
+    for attributes in (item, item.get('fileInfo') or {}):
+      for key in _modifiedAttributes:
+        if attributes.get(key):
+          return attributes[key]
+    return None
+
+  def __fingerprint(self, item: dict) -> dict:
+    fileInfo = item.get('fileInfo') or {}
+    return {'path': item.get('@path', ''), 'fileSize': item.get('@fileSize', fileInfo.get('@fileSize')), 'modified': self.__modifiedDate(item)}
+
+  def __fingerprints(self, resource: str, items: dict) -> dict:
+    fingerprints = {itemID: self.__fingerprint(item) for itemID, item in items.items()}
+    missing = [itemID for itemID, fingerprint in fingerprints.items() if fingerprint['modified'] is None]
+    if not missing:
+      return fingerprints
+
+    # The tree level has no modification date for these items, the definition XML might
+    self.logger.info(f"Getting the modification date of {len(missing)} {resource} from their definition XML")
+    def lookup(itemID: str) -> str:
+      resp = self.source.resources.ResourceItemGetDefinitionXML(resourceType=resource, itemID=itemID)
+      if not resp.didSucceed():
+        return None
+      return self.__modifiedDate(resp.data.get('item') or {})
+
+    if self.workers > 1:
+      with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ServerMigrator-snapshot") as pool:
+        dates = list(pool.map(lookup, missing))
+    else:
+      dates = [lookup(itemID) for itemID in missing]
+    for itemID, modified in zip(missing, dates):
+      fingerprints[itemID]['modified'] = modified
+
+    undated = dates.count(None)
+    if undated:
+      self.logger.warning(f"The source server has no modification date for {undated} {resource}, syncResource only notices changes to those when their file size changes")
+    return fingerprints
+
+  def __loadSnapshot(self, resource: str) -> dict:
+    if not checkForFile(fileName=self.__snapshotFile(resource)):
+      return None
+    return readFile(self.__snapshotFile(resource), isJSON=True)
+
+  def __saveSnapshot(self, resource: str, fingerprints: dict):
+    writeFile(fileName=self.__snapshotFile(resource), data=fingerprints, isJSON=True)
+
   def __transferItems(self, resource: str, disablePreviews: bool = True):
     resource = resource.lower()
     items = self.progress['resources'][resource]['toTransfer']
@@ -141,210 +426,25 @@ class ServerMigrator:
         elif self.verbose:
           print(f"\n{resp.text}\n")
 
-      itemList = items.copy()
-      itemAmount = len(itemList)
-      self.logger.info(f'Amount of {resource} to transfer: {itemAmount}')
-      for r in itemList:
-        if self.verbose:
-          print(f"Name: {r['@name']}\nID: {r['@id']}\nPath: {r['@path']}\nDownload URL: {self.getDownloadURL(resource, r['@id'])}\n")
-
-        self.logger.info(f"Checking if {resource}: {r.get('@id')} exists on destination environment")
-        if self.dest.resources.doesItemExist(resource, r.get('@id')):
-          self.logger.info(f"{resource}: {r.get('@id')} exists on destination environment. Skipping...")
-          continue
+      with self._progressLock:
+        itemList = list(items.values())
+      self._remaining[resource] = len(itemList)
+      self.logger.info(f'Amount of {resource} to transfer: {len(itemList)}')
 
-        # Set ID for the next item
-        self.logger.info(f"Setting the ID for the next uploaded item to: {r['@id']}")
-        resp = self.dest.resources.setNextResourceItemID(resourceType=resource, itemID=r['@id'])
-        if not resp.didSucceed():
-          self.logger.error(f"There was an issue setting the next item ID for {r['@name']}: {r['@id']}\n{resp.text}")
-          continue
-        elif self.verbose:
-          print(f"\n{resp.text}\n")
+      if resource == 'documents':
+        self.__planDocuments(itemList)
 
-        # Extract path from resource tree item (original path is full path ending with <document name>.xml)
-        if len(r['@path']) != 0:
-          splitPath = r['@path'].split("\\")
-          fileName = splitPath.pop()
-          resourceItemPath = "\\".join(splitPath)+"\\"
-        else:
-          fileName = r['@name']
-          resourceItemPath = ''
-        print(f"Path: {resourceItemPath}")
-
-        # If the resource is an asset or font.
-        if resource == 'assets' or resource == 'fonts':
-
-          is_truncated = True
-          max_tries = 5
-
-          while is_truncated:
-            # Download the resource file data
-            self.logger.info(f"Downloading asset file data temporarily for: {r['@name']}")
-            fileData = self.source.resources.DownloadAsset(
-              resourceType=resource,
-              id=r['@id'],
-              itemPath=r['@path'],
-              assetType='original',
-              page=1
-            )
-            if not resp.didSucceed():
-              self.logger.error(f"There was an issue downloading the asset - Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
-              continue
-
-            # Base64 Encode the byte data
-            fileData = base64.b64encode(fileData.response.content)
-            fileData = fileData.decode('utf-8')
-
-            self.logger.info(f"Uploading asset data to destination CHILI server: {r['@name']}")
-            resp = self.dest.resources.ResourceItemAdd(
-              resourceType=resource,
-              newName=fileName,
-              fileData=fileData,
-              xml=None,
-              folderPath=resourceItemPath
-            )
-            if not resp.didSucceed():
-              self.logger.error(f"There was an issue uploading the asset to the destination server- Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
-              continue
-
-            self.logger.info(f"Comparing file sizes for - Name: {r['@name']} -- Item ID: {r['@id']}\n") 
-            itemSizeDest = self.dest.resources.ResourceItemGetDefinitionXML(resourceType=resource, itemID=r['@id'])
-            itemSizeSrc = self.source.resources.ResourceItemGetDefinitionXML(resourceType=resource, itemID=r['@id'])
-
-            # Check file size
-            if itemSizeSrc.data['item']['fileInfo']['@fileSize'] != itemSizeDest.data['item']['fileInfo']['@fileSize']:
-              if max_tries == 0: break
-              self.logger.error(f"{resource} wrong size from dest to src - Name: {r['@name']} -- Item ID: {r['@id']}\nGoing to retry {max_tries} more times.")
-              self.logger.info(f"Deleting item from dest so we can re-upload it - Name: {r['@name']} -- Item ID: {r['@id']}")
-              self.dest.resources.ResourceItemDelete(
-                resourceType=resource,
-                itemID=r['@id']
-              )
-              max_tries = max_tries - 1
-              continue
-            else:
-              is_truncated = False
-
-        elif resource == "documents":
-          # Download document
-          self.logger.info(f"Downloading document XML temporarily for: {r['@name']}")
-          resp = self.source.resources.ResourceItemGetXML(
-            resourceType='documents',
-            itemID=r['@id'],
-          )
-          if not resp.didSucceed():
-            self.logger.error(f"There was an issue downloading the document - Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
-            continue
-
-          docXml = resp.text
-
-          cd = ChiliDocument(docXml)
-
-          # Get the DataSource ID attached to the document if there is one
-          datasource_id = cd.datasource_id
-
-          fonts = []
-          for font in cd.get_fonts():
-            fonts.append(font["id"])
-
-          assets = cd.get_images()
-          images = [image.get("id") for image in assets if image.get("resource_type") == "Assets"]
-          daps = [image.get("id") for image in assets if image.get("resource_type") == "DynamicAssetProviders"]
-          barcodes = cd.get_barcode_ids()
-
-
-          if fonts:
-            self.logger.info(f"Found fonts in document, transferring... (Arial Regular will probably fail)")
-            self.transferList(itemList=fonts, resource="Fonts")
-          if images:
-            self.logger.info(f"Found images in document, transferring...")
-            self.transferList(itemList=images, resource="Assets")
-          if daps:
-            self.logger.info(f"Found Dynamic Asset Providers in document, transferring settings for DAP...")
-            self.transferList(itemList=daps, resource="DynamicAssetProviders")
-          if barcodes:
-            self.logger.info(f"Found Barcode frames in document, transferring Barcode settings...")
-            self.transferList(itemList=barcodes, resource="BarcodeTypes")
-          if datasource_id:
-            self.logger.info(f"Found DataSource attached to document, transferring DataSource settings")
-            self.transferList(itemList=[datasource_id], resource="DataSources")
-
-          # Create a placeholder document because if you ResourceItemAdd a document, CHILI will process the XML and will remove spaces
-          self.logger.info(f"Creating placeholder document to destination CHILI server: {r['@name']}")
-          resp = self.dest.resources.ResourceItemAdd(
-            resourceType='documents',
-            newName=fileName,
-            folderPath=resourceItemPath,
-            xml='<document />'
-          )
-          if not resp.didSucceed():
-            self.logger.error(f"There was an issue creating a placeholder document to the destination server- Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
-            continue
-
-          # CHILI loves blank documents so retry until it's not blank
-          blank_doc = True
+      if self.workers > 1 and len(itemList) > 1:
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"ServerMigrator-{resource}") as pool:
+          for future in [pool.submit(self.__transferItem, resource, r) for r in itemList]:
+            future.result()
+      else:
+        for r in itemList:
+          self.__transferItem(resource, r)
+      self._saveProgressFile()
 
-          while blank_doc:
-            self.logger.info(f"Uploading document data to destination CHILI server: {r['@name']}")
-            resp = self.dest.resources.ResourceItemSave(
-              resourceType="documents",
-              itemID=r['@id'],
-              xml=docXml,
-            )
-            if not resp.didSucceed():
-              self.logger.error(f"There was an issue uploading the document to the destination server- Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
-              break
-
-            self.logger.info(f"Processing document server side: {r['@name']}")
-            resp = self.dest.documents.processServerSide(
-              documentID=r['@id']
-            )
-            sleep(1)
-
-            self.logger.info(f"Checking if uploading doc is blank: {r['@name']}")
-            resp = self.dest.resources.ResourceItemGetXML(
-              resourceType="documents",
-              itemID=r['@id'])
-            if not resp.didSucceed():
-              self.logger.error(f"There was an issue getting the document XML for the blank document check- Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
-              break
-
-            blank_doc = self.dest.documents.is_blank(resp.text)
-            if blank_doc: self.logger.info(f"Uploaded document was blank. Going to retry the ResourceItemSave{r['@name']}")
-            else: self.logger.info(f"Uploaded document is not blank")
-
-        # Item is not a document, asset, or font
-        else:
-          # Get the item XML (I think only assets and fonts are using fileData)
-          resp = self.source.resources.ResourceItemGetXML(resourceType=resource, itemID=r['@id'])
-          if not resp.didSucceed():
-            self.logger.error(f"There was an issue getting the item XML - Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
-            continue
-          elif self.verbose:
-            print(f"\n{resp.text}\n")
-
-          item_xml = resp.text
-
-          resp = self.dest.resources.ResourceItemAdd(
-            resourceType=resource,
-            newName=r['@name'],
-            folderPath=resourceItemPath,
-            xml=item_xml
-          )
-          if not resp.didSucceed():
-            self.logger.error(f"There was an issue adding the item - Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
-            continue
-          elif self.verbose:
-            print(f"\n{resp.text}\n")
-
-        # Set a pause to avoid overwhelming the server.
-        self.logger.info(f"Successfully transferred Name: {r['@name']} - ID: {r['@id']} to the destination CHILI server.")
-        itemAmount = itemAmount - 1
-        self.logger.info(f"Waiting {self.interval} seconds to avoid server stress. There are {itemAmount} resources left")
-        self.progress['resources'][resource]['toTransfer'].remove(r)
-        self._saveProgressFile()
-        sleep(self.interval)
+      if self.deferVerification:
+        self.verifyTransfers(resource)
 
       if disablePreviews:
         # Turn back on the Automatic Preview Generation for the API KEY
@@ -357,6 +457,232 @@ class ServerMigrator:
     else:
       self.logger.info(f'There is nothing queued to transfer for the {resource} resource')
 
+  def __reserveAndAdd(self, resource: str, r: dict, **addArgs):
+    # setNextResourceItemID applies to the next item added for the resource type, so the
+    # reservation and the add have to happen back to back. Everything else runs in parallel
+    with self._reserveLocks[resource]:
+      self.logger.info(f"Setting the ID for the next uploaded item to: {r['@id']}")
+      resp = self.dest.resources.setNextResourceItemID(resourceType=resource, itemID=r['@id'])
+      if not resp.didSucceed():
+        self.logger.error(f"There was an issue setting the next item ID for {r['@name']}: {r['@id']}\n{resp.text}")
+        return resp
+      elif self.verbose:
+        print(f"\n{resp.text}\n")
+
+      resp = self.dest.resources.ResourceItemAdd(resourceType=resource, **addArgs)
+      if resp.didSucceed():
+        self.__updateDestIndex(resource, r['@id'], exists=True)
+      return resp
+
+  def __transferItem(self, resource: str, r: dict) -> bool:
+    if self.verbose:
+      print(f"Name: {r['@name']}\nID: {r['@id']}\nPath: {r['@path']}\nDownload URL: {self.getDownloadURL(resource, r['@id'])}\n")
+
+    self.logger.info(f"Checking if {resource}: {r.get('@id')} exists on destination environment")
+    if self.existsOnDestination(resource, r.get('@id')):
+      if r.get('@syncAction') != 'update':
+        self.logger.info(f"{resource}: {r.get('@id')} exists on destination environment. Skipping...")
+        with self._progressLock:
+          self._transferred.add((resource, r['@id']))
+        return False
+
+      # The item changed on the source since the last sync, it is replaced with the same ID
+      self.logger.info(f"{resource}: {r.get('@id')} changed on the source, replacing it on the destination environment")
+      resp = self.dest.resources.ResourceItemDelete(resourceType=resource, itemID=r['@id'])
+      if not resp.didSucceed():
+        self.logger.error(f"There was an issue deleting the outdated {resource}: {r['@id']} on the destination\n{resp.text}")
+        return False
+      self.__updateDestIndex(resource, r['@id'], exists=False)
+
+    # Extract path from resource tree item (original path is full path ending with <document name>.xml)
+    if len(r['@path']) != 0:
+      splitPath = r['@path'].split("\\")
+      fileName = splitPath.pop()
+      resourceItemPath = "\\".join(splitPath)+"\\"
+    else:
+      fileName = r['@name']
+      resourceItemPath = ''
+    print(f"Path: {resourceItemPath}")
+
+    # If the resource is an asset or font.
+    if resource == 'assets' or resource == 'fonts':
+
+      localFile = f"{self.directory}/{resource}/files/{r['@id']}"
+
+      # Stream the resource file data to a temporary file instead of holding it in memory
+      self.logger.info(f"Downloading asset file data temporarily for: {r['@name']}")
+      try:
+        download = self.source.resources.DownloadAssetToFile(
+          resourceType=resource,
+          id=r['@id'],
+          target=localFile,
+          itemPath=r['@path'],
+          assetType='original',
+          page=1,
+          resume=False
+        )
+      except Exception as e:
+        self.logger.error(f"There was an issue downloading the asset - Name: {r['@name']} -- Item ID: {r['@id']}\n{e}")
+        if isfile(localFile): remove(localFile)
+        return False
+      if self.verbose:
+        print(f"Downloaded {convertFileSize(download['bytes'], 'mb')} at {convertFileSize(download['bytesPerSecond'], 'mb')}/s")
+      if not self.__matchesSource(resource, r, localFile):
+        remove(localFile)
+        return False
+
+      # The file is base64 encoded while it is streamed into the request body
+      self.logger.info(f"Uploading asset data to destination CHILI server: {r['@name']}")
+      resp = self.__reserveAndAdd(
+        resource,
+        r,
+        newName=fileName,
+        filePath=localFile,
+        xml=None,
+        folderPath=resourceItemPath
+      )
+      if not resp.didSucceed():
+        self.logger.error(f"There was an issue uploading the asset to the destination server- Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
+        remove(localFile)
+        return False
+
+      if self.deferVerification:
+        # The local copy is kept until verifyTransfers checked it against the destination
+        self.__queueVerification(resource, r, localFile)
+      else:
+        verified = self.__verifyItem(resource, r, localFile)
+        remove(localFile)
+        if not verified:
+          self.__discardItem(resource, r)
+          return False
+
+    elif resource == "documents":
+      localXML = self.__documentXMLFile(r['@id'])
+      if ('documents', r['@id']) in self.plan and isfile(localXML):
+        # The document was downloaded and its dependencies transferred while planning
+        docXml = readFile(localXML, encoding='utf-8')
+      else:
+        # Download document
+        self.logger.info(f"Downloading document XML temporarily for: {r['@name']}")
+        resp = self.source.resources.ResourceItemGetXML(
+          resourceType='documents',
+          itemID=r['@id'],
+          parser=PARSER_NONE
+        )
+        if not resp.didSucceed():
+          self.logger.error(f"There was an issue downloading the document - Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
+          return False
+
+        docXml = resp.text
+
+        try:
+          dependencies = extract_dependencies(docXml)
+        except Exception as e:
+          self.logger.error(f"There was an issue reading the dependencies of the document - Name: {r['@name']} -- Item ID: {r['@id']}\n{e}")
+          dependencies = {}
+        for depResource, depIDs in dependencies.items():
+          if depIDs:
+            self.logger.info(f"Found {depResource} in document, transferring...")
+            self.transferList(itemList=depIDs, resource=depResource)
+
+      # Create a placeholder document because if you ResourceItemAdd a document, CHILI will process the XML and will remove spaces
+      self.logger.info(f"Creating placeholder document to destination CHILI server: {r['@name']}")
+      resp = self.__reserveAndAdd(
+        resource,
+        r,
+        newName=fileName,
+        folderPath=resourceItemPath,
+        xml='<document />'
+      )
+      if not resp.didSucceed():
+        self.logger.error(f"There was an issue creating a placeholder document to the destination server- Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
+        return False
+
+      # CHILI loves blank documents so retry the save until it's not blank, a document without frames on the source is blank on purpose
+      try:
+        expectFrames = not is_blank_xml(docXml)
+      except Exception as e:
+        # The placeholder exists already, let the blank check decide instead of leaving it behind
+        self.logger.error(f"Could not check the source document XML for frames, expecting it to have frames - Name: {r['@name']} -- Item ID: {r['@id']}\n{e}")
+        expectFrames = True
+      delay = self.blankCheckDelay
+      saved = False
+
+      for attempt in range(self.blankCheckRetries + 1):
+        self.logger.info(f"Uploading document data to destination CHILI server: {r['@name']}")
+        resp = self.dest.resources.ResourceItemSave(
+          resourceType="documents",
+          itemID=r['@id'],
+          xml=docXml,
+        )
+        if not resp.didSucceed():
+          self.logger.error(f"There was an issue uploading the document to the destination server- Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
+          break
+
+        self.logger.info(f"Processing document server side: {r['@name']}")
+        resp = self.dest.documents.processServerSide(
+          documentID=r['@id']
+        )
+        if not expectFrames:
+          saved = True
+          break
+
+        # Give the server a little more time after every blank result
+        sleep(delay)
+        self.logger.info(f"Checking if uploading doc is blank: {r['@name']}")
+        try:
+          blank_doc = self.dest.documents.probeIsBlank(documentID=r['@id'])
+        except Exception as e:
+          self.logger.error(f"There was an issue getting the document XML for the blank document check- Name: {r['@name']} -- Item ID: {r['@id']}\n{e}")
+          blank_doc = True
+
+        if not blank_doc:
+          self.logger.info(f"Uploaded document is not blank")
+          saved = True
+          break
+        self.logger.info(f"Uploaded document was blank. Going to retry the ResourceItemSave {r['@name']} ({attempt + 1}/{self.blankCheckRetries})")
+        delay = min(delay * 2, self.blankCheckMaxDelay)
+
+      if not saved:
+        self.logger.error(f"The document could not be saved without being blank - Name: {r['@name']} -- Item ID: {r['@id']}")
+        self.__discardItem(resource, r)
+        return False
+
+      if isfile(localXML): remove(localXML)
+
+    # Item is not a document, asset, or font
+    else:
+      # Get the item XML (I think only assets and fonts are using fileData)
+      resp = self.source.resources.ResourceItemGetXML(resourceType=resource, itemID=r['@id'], parser=PARSER_NONE)
+      if not resp.didSucceed():
+        self.logger.error(f"There was an issue getting the item XML - Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
+        return False
+      elif self.verbose:
+        print(f"\n{resp.text}\n")
+
+      item_xml = resp.text
+
+      resp = self.__reserveAndAdd(
+        resource,
+        r,
+        newName=r['@name'],
+        folderPath=resourceItemPath,
+        xml=item_xml
+      )
+      if not resp.didSucceed():
+        self.logger.error(f"There was an issue adding the item - Name: {r['@name']} -- Item ID: {r['@id']}\n{resp.text}")
+        return False
+      elif self.verbose:
+        print(f"\n{resp.text}\n")
+
+    self.logger.info(f"Successfully transferred Name: {r['@name']} - ID: {r['@id']} to the destination CHILI server.")
+    with self._progressLock:
+      self._remaining[resource] -= 1
+      self.logger.info(f"There are {self._remaining[resource]} {resource} left")
+      self.__finishItem(resource, r)
+    if self.interval > 0:
+      sleep(self.interval)
+    return True
 
   def __iterresource(self, resource: str, d, customPath: str = None):
     for v in d:
@@ -374,16 +700,123 @@ class ServerMigrator:
           else:
             if customPath is not None:
               v['@path'] = customPath
-            self.progress['resources'][resource]['toTransfer'].append(v)
+            self.progress['resources'][resource]['toTransfer'][v['@id']] = v
             if self.verbose:
               self.logger.info(f"Adding {v} to the transfer queue")
       elif isinstance(v, str):
         if isinstance(d[v], list):
           self.__iterresource(resource, d[v])
 
+  def existsOnDestination(self, resource: str, itemID: str) -> bool:
+    resource = resource.lower()
+    if not self.existenceIndex:
+      return self.dest.resources.doesItemExist(resource, itemID)
+    with self._destIndexLocks[resource]:
+      if resource not in self._destIndex:
+        self.logger.info(f"Building the index of the {resource} on the destination environment")
+        try:
+          self._destIndex[resource] = self.dest.resources.getItemIDs(resource)
+        except Exception as e:
+          self.logger.error(f"There was an issue building the {resource} index, checking every item instead\n{e}")
+          self._destIndex[resource] = None
+      index = self._destIndex[resource]
+    if index is None:
+      return self.dest.resources.doesItemExist(resource, itemID)
+    return itemID in index
+
+  def __updateDestIndex(self, resource: str, itemID: str, exists: bool):
+    with self._destIndexLocks[resource]:
+      index = self._destIndex.get(resource)
+      if index is None: return
+      if exists: index.add(itemID)
+      else: index.discard(itemID)
+
+  def __documentXMLFile(self, itemID: str) -> str:
+    return f"{self.directory}/documents/files/{itemID}.xml"
+
+  def __planDocuments(self, items: list):
+    # Every document is downloaded once and added to one dependency graph. The resources they share are then
+    # transferred once, in dependency order, before any of the documents
+    def plan(r: dict):
+      if ('documents', r['@id']) in self.plan or ('documents', r['@id']) in self._transferred:
+        return
+      if self.existsOnDestination('documents', r['@id']) and r.get('@syncAction') != 'update':
+        return
+      # Streamed to disk and scanned from there, the document is never held in memory
+      localXML = self.__documentXMLFile(r['@id'])
+      try:
+        self.source.resources.ResourceItemGetXMLToFile(resourceType='documents', itemID=r['@id'], target=localXML)
+        dependencies = extract_dependencies(localXML)
+      except Exception as e:
+        self.logger.error(f"There was an issue downloading the document for planning - Name: {r['@name']} -- Item ID: {r['@id']}\n{e}")
+        if isfile(localXML): remove(localXML)
+        return
+      with self._progressLock:
+        self.plan.addItem('documents', r['@id'], dependencies)
+
+    self.logger.info(f"Building the dependency graph of {len(items)} documents")
+    if self.workers > 1:
+      with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ServerMigrator-plan") as pool:
+        list(pool.map(plan, items))
+    else:
+      for r in items:
+        plan(r)
+
+    usage = self.plan.usage()
+    self.logger.info(f"The documents use {len(usage)} unique resources, {sum(usage.values())} references in total")
+    for resource, itemIDs in self.plan.batches(exclude=self._transferred):
+      if resource == 'documents':
+        continue
+      self.logger.info(f"Transferring {len(itemIDs)} {resource} used by the documents")
+      self.transferList(resource=resource, itemList=itemIDs)
+
   def getDownloadURL(self, resource: str, itemID: str):
     downloadURL =  self.source.baseURL + self.source.environment + '/download.aspx?type=original&resourceName=' + resource + '&id=' + itemID + '&apiKey=' + self.source.getAPIKey() + '&pageNum=1'
     return downloadURL
 
   def _saveProgressFile(self):
-    writeFile(fileName=self.progressFile, data=self.progress, isJSON=True)
\ No newline at end of file
+    # Writes a full snapshot of the progress and empties the journal
+    with self._progressLock:
+      self.journal.compact(self.progress)
+
+  def __replayJournal(self, entries: list):
+    # The queues are keyed by item ID, progress files from before the journal still have lists
+    for progress in self.progress['resources'].values():
+      if isinstance(progress.get('toTransfer'), list):
+        progress['toTransfer'] = {item['@id']: item for item in progress['toTransfer']}
+    for entry in entries:
+      progress = self.progress['resources'].setdefault(entry['resource'], {})
+      if entry['op'] == 'queue':
+        progress.setdefault('toTransfer', {})[entry['item']['@id']] = entry['item']
+      elif entry['op'] == 'done':
+        progress.setdefault('toTransfer', {}).pop(entry['id'], None)
+      elif entry['op'] == 'verify':
+        progress.setdefault('toVerify', {})[entry['item']['@id']] = entry['item']
+      elif entry['op'] == 'verified':
+        progress.setdefault('toVerify', {}).pop(entry['id'], None)
+
+  def __discardItem(self, resource: str, r: dict, requeue: bool = False):
+    # A half transferred item would be skipped as existing by the next run, so it is removed from the destination.
+    # If that fails it is queued as an update, which replaces it
+    resp = self.dest.resources.ResourceItemDelete(resourceType=resource, itemID=r['@id'])
+    if resp.didSucceed():
+      self.__updateDestIndex(resource, r['@id'], exists=False)
+    else:
+      self.logger.error(f"There was an issue removing the incomplete {resource}: {r['@id']} from the destination, it is replaced on the next run\n{resp.text}")
+      r['@syncAction'] = 'update'
+      requeue = True
+    if requeue:
+      self.__queueItem(resource, r)
+
+  def __queueItem(self, resource: str, item: dict):
+    with self._progressLock:
+      self.progress['resources'][resource].setdefault('toTransfer', {})[item['@id']] = item
+      self.journal.append({'op': 'queue', 'resource': resource, 'item': item})
+
+  def __finishItem(self, resource: str, item: dict):
+    with self._progressLock:
+      self.progress['resources'][resource]['toTransfer'].pop(item['@id'], None)
+      self._transferred.add((resource, item['@id']))
+      self.journal.append({'op': 'done', 'resource': resource, 'id': item['@id']})
+      if self.journal.needsCompaction:
+        self._saveProgressFile()
\ No newline at end of file
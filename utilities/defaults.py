@@ -1,7 +1,21 @@
 DEFAULT_TASKPRIORITY = 5
 DEFAULT_TASKUPDATETIME = 1
+DEFAULT_CHUNKSIZE = 1024 * 1024
 USER_TYPE = 'user'
 STAFF_TYPE = 'staff'
+DEFAULT_RETRY_STATUSCODES = [408, 429, 500, 502, 503, 504]
+DEFAULT_RETRY_METHODS = ['get', 'head', 'options', 'put', 'delete']
+PARSER_XMLTODICT = 'xmltodict'
+PARSER_LXML = 'lxml'
+PARSER_NONE = 'none'
+DEFAULT_RESPONSEPARSER = PARSER_XMLTODICT
+VERIFY_SIZE = 'size'
+VERIFY_CHECKSUM = 'checksum'
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_MAXENTRIES = 256
+DEFAULT_LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Path segments of the REST API that are never a resource type or item ID
+RESOURCE_PATH_KEYWORDS = {'items', 'treelevel', 'tree', 'folders', 'download', 'nextitemid', 'tempxml', 'documentprocessor', 'fromurl'}
 
 statusCodes = {
   200:"Request has succeeded",
@@ -11,6 +25,7 @@ statusCodes = {
   403:"Request failed, forbidden",
   404:"Request failed, resource not found",
   408:"Request timeout",
+  429:"Too many requests, the server is rate limiting",
   500:"Internal server error",
   502:"Server Error, invalid gateway",
   503:"Server is not ready to handle the request",
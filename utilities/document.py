@@ -1,3 +1,4 @@
+from io import BytesIO
 from lxml import etree
 
 class ChiliDocument:
@@ -102,3 +103,104 @@ class ChiliDocument:
 
   def text_frames(self):
     return self._get_frames(frame_type="text")
+
+  def get_dependencies(self) -> dict:
+    """Returns the IDs of the resources the document needs, by resource type, without duplicates"""
+    if self.doc is None: return
+    images = self.get_images()
+    dependencies = {
+      "Fonts": [font["id"] for font in self.get_fonts()],
+      "Assets": [image["id"] for image in images if image["resource_type"] == "Assets"],
+      "DynamicAssetProviders": [image["id"] for image in images if image["resource_type"] == "DynamicAssetProviders"],
+      "BarcodeTypes": self.get_barcode_ids(),
+      "DataSources": [self.datasource_id] if self.datasource_id else []
+    }
+    return {resource: list(dict.fromkeys(i for i in ids if i)) for resource, ids in dependencies.items()}
+
+
+def extract_dependencies(source) -> dict:
+  """Same result as ChiliDocument.get_dependencies() in one streaming pass over the XML.
+  Elements are freed as soon as they are parsed so memory use doesn't grow with the size of the document
+
+  :param source: Document XML as str or bytes, a file path or a binary file object
+  """
+  if isinstance(source, str) and source.lstrip().startswith("<"): source = source.encode("utf-8")
+  if isinstance(source, bytes): source = BytesIO(source)
+
+  dependencies = {"Fonts": {}, "Assets": {}, "DynamicAssetProviders": {}, "BarcodeTypes": {}, "DataSources": {}}
+  path = []
+  for event, element in etree.iterparse(source, events=("start", "end")):
+    if event == "end":
+      path.pop()
+      element.clear()
+      while element.getprevious() is not None:
+        del element.getparent()[0]
+      continue
+
+    depth = len(path)
+    if depth == 1 and element.tag == "dataSource":
+      dependencies["DataSources"][element.get("dataSourceID")] = None
+    elif depth >= 2 and path[1] == "fonts":
+      dependencies["Fonts"][element.get("id")] = None
+    elif depth >= 2 and path[1] == "pages" and _is_frame(element.tag, path):
+      frame_type = element.get("type")
+      if frame_type == "image" and element.get("hasContent", "false") == "true":
+        if len(element.get("dynamicAssetProviderID", "")) > 1:
+          dependencies["DynamicAssetProviders"][element.get("dynamicAssetProviderID")] = None
+        else:
+          dependencies["Assets"][element.get("externalID")] = None
+      elif frame_type == "barcode":
+        dependencies["BarcodeTypes"][element.get("barcodeTypeID")] = None
+    path.append(element.tag)
+
+  return {resource: [i for i in ids if i] for resource, ids in dependencies.items()}
+
+def _is_frame(tag: str, path: list) -> bool:
+  # pages//frames/item, or an inline frame: pages//frames/item/inlineFrames//item//frame
+  if tag == "item" and path[-1] == "frames":
+    return True
+  if tag != "frame":
+    return False
+  for i in range(3, len(path)):
+    if path[i] == "inlineFrames" and path[i - 1] == "item" and path[i - 2] == "frames" and "item" in path[i + 1:]:
+      return True
+  return False
+
+class FrameFound(Exception):
+  pass
+
+class FrameProbe:
+  """Write-only file object that parses a document XML while it is written to it and raises FrameFound at the first frame.
+  Pass it as a download target to check if a document is blank without downloading or parsing the rest of it
+  """
+  def __init__(self):
+    self._parser = etree.XMLPullParser(events=("start", "end"))
+    self._path = []
+
+  def write(self, data: bytes) -> int:
+    self._parser.feed(data)
+    for event, element in self._parser.read_events():
+      if event == "start":
+        # Same frames as ChiliDocument.frames, pages//frames/item
+        if element.tag == "item" and self._path[-1:] == ["frames"] and self._path[1:2] == ["pages"]:
+          raise FrameFound()
+        self._path.append(element.tag)
+      else:
+        self._path.pop()
+        # Nothing before this element is needed again
+        element.clear()
+        while element.getprevious() is not None:
+          del element.getparent()[0]
+    return len(data)
+
+  def seekable(self) -> bool:
+    return False
+
+def is_blank_xml(doc_xml) -> bool:
+  """Returns True if the document XML has no frames, stops parsing at the first frame"""
+  if isinstance(doc_xml, str): doc_xml = doc_xml.encode("utf-8")
+  try:
+    FrameProbe().write(doc_xml)
+  except FrameFound:
+    return False
+  return True
@@ -1,18 +1,24 @@
 from __future__ import annotations
 import requests
 import json
+import hashlib
 from base64 import b64encode
-from typing import TYPE_CHECKING
+from io import RawIOBase
+from time import perf_counter, sleep, time
+from typing import TYPE_CHECKING, Callable
 
 if TYPE_CHECKING:
     from chilitools.api.connector import ChiliConnector
 
-from os.path import isfile, dirname, realpath, sep, getsize
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from os.path import isfile, dirname, realpath, sep, getsize, join, relpath
 from os import makedirs
+from chilitools.api.retry import RetryPolicy
 from chilitools.utilities.errors import ErrorHandler
 from chilitools.utilities.strings import convertFileSize
 from chilitools.utilities.xmltools import getTaskResultURL, removeTimelineTags
-from chilitools.utilities.defaults import DEFAULT_TASKPRIORITY
+from chilitools.utilities.defaults import DEFAULT_TASKPRIORITY, DEFAULT_CHUNKSIZE, PARSER_NONE
 
 def currentPath(file: str) -> str:
   return dirname(realpath(file))
@@ -32,6 +38,132 @@ def getBase64String(filePath: str = None, fileBytes: bytes = None) -> str:
   fileData = b64encode(fileBytes)
   return fileData.decode('utf-8')
 
+def fileChecksum(filePath: str, algorithm: str = 'sha256', chunkSize: int = DEFAULT_CHUNKSIZE) -> str:
+  """Returns the hex digest of the file, read in chunks"""
+  hasher = hashlib.new(algorithm)
+  with open(filePath, 'rb') as file:
+    for chunk in iter(lambda: file.read(chunkSize), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+class HashWriter:
+  """Write-only file object that hashes what is written to it, pass it as a download target to checksum a download without storing it"""
+  def __init__(self, algorithm: str = 'sha256'):
+    self._hasher = hashlib.new(algorithm)
+    self.size = 0
+
+  def write(self, data: bytes) -> int:
+    self._hasher.update(data)
+    self.size += len(data)
+    return len(data)
+
+  def seekable(self) -> bool:
+    return False
+
+  def hexdigest(self) -> str:
+    return self._hasher.hexdigest()
+
+def getBase64Body(filePath: str, fileField: str = 'fileData', fields: dict = None) -> Base64JSONBody:
+  """Returns a streaming JSON request body with the file at filePath base64 encoded into fileField.
+  Use this instead of getBase64String for uploads so the encoded file never has to fit in memory
+
+  :type filePath: str
+  :type fileField: str
+  :type fields: dict
+  """
+  return Base64JSONBody(filePath=filePath, fileField=fileField, fields=fields)
+
+class Base64JSONBody(RawIOBase):
+  """File-like JSON request body where one field is a file encoded to base64 while it is being sent.
+  Only one chunk of the file is held in memory at a time, the length is known up front so requests
+  sends a normal Content-Length instead of a chunked body.
+
+  :param filePath: The file to encode into `fileField`
+  :param fields: The other JSON fields of the body, ex: {'xml': ''}
+  """
+  def __init__(self, filePath: str, fileField: str = 'fileData', fields: dict = None, chunkSize: int = DEFAULT_CHUNKSIZE):
+    super().__init__()
+    self.filePath = filePath
+    prefix = json.dumps(fields)[:-1] + ', ' if fields else '{'
+    self._prefix = (prefix + json.dumps(fileField) + ': "').encode('utf-8')
+    self._suffix = b'"}'
+    self._encodedSize = 4 * ((getsize(filePath) + 2) // 3)
+    self._length = len(self._prefix) + self._encodedSize + len(self._suffix)
+    # Chunks must be a multiple of 3 bytes so the encoded chunks can be concatenated without padding
+    self._chunkSize = max(3, chunkSize - chunkSize % 3)
+    self._file = None
+    self._buffer = b''
+    self._bufferPos = 0
+    self._pos = 0
+
+  def __len__(self) -> int:
+    return self._length
+
+  def readable(self) -> bool:
+    return True
+
+  def seekable(self) -> bool:
+    return True
+
+  def tell(self) -> int:
+    return self._pos
+
+  def seek(self, offset: int, whence: int = 0) -> int:
+    if whence == 1: offset += self._pos
+    elif whence == 2: offset += self._length
+    self._pos = min(max(0, offset), self._length)
+    self._buffer = b''
+    self._bufferPos = 0
+    encodedPos = self._pos - len(self._prefix)
+    if 0 <= encodedPos < self._encodedSize:
+      # Re-encode the 3 byte group the position lands in and skip into it
+      self._openFile().seek((encodedPos // 4) * 3)
+      self._buffer = b64encode(self._file.read(3))
+      self._bufferPos = encodedPos % 4
+    elif self._file is not None and not self._file.closed:
+      self._file.seek(0)
+    return self._pos
+
+  def readinto(self, b) -> int:
+    data = self._read(len(b))
+    b[:len(data)] = data
+    return len(data)
+
+  def _openFile(self):
+    if self._file is None or self._file.closed:
+      self._file = open(self.filePath, 'rb')
+    return self._file
+
+  def _read(self, size: int) -> bytes:
+    out = bytearray()
+    prefixEnd = len(self._prefix)
+    encodedEnd = prefixEnd + self._encodedSize
+    while len(out) < size and self._pos < self._length:
+      need = size - len(out)
+      if self._pos < prefixEnd:
+        take = self._prefix[self._pos:self._pos + need]
+      elif self._pos < encodedEnd:
+        if self._bufferPos >= len(self._buffer):
+          self._buffer = b64encode(self._openFile().read(self._chunkSize))
+          self._bufferPos = 0
+          if not self._buffer:
+            raise IOError(f"{self.filePath} changed size while it was being uploaded")
+        take = self._buffer[self._bufferPos:self._bufferPos + need]
+        self._bufferPos += len(take)
+        if self._pos + len(take) >= encodedEnd:
+          # Done with the file, it is re-opened if the body is rewound for a retry
+          self._file.close()
+      else:
+        start = self._pos - encodedEnd
+        take = self._suffix[start:start + need]
+      out += take
+      self._pos += len(take)
+    return bytes(out)
+
+  def close(self):
+    if self._file is not None: self._file.close()
+    super().close()
+
 def readFile(fileName: str, isJSON: bool = False, encoding: str = None):
   if checkForFile(fileName=fileName):
     with open(fileName, 'r', encoding=encoding) as file:
@@ -73,17 +205,170 @@ def removeTimelineFromDocFile(fileName: str, outputFolder: str, verbose: bool =
   # except Exception as e:
   #   return f'There was an issue removing the timeline docs: {e}'
 
-def downloadFile(url: str, fullFileName: str, queryParams: dict = None) -> bool:
+def _stripTimelineFile(fileName: str, outputFile: str) -> dict:
+  # Runs in a worker process, errors are reported instead of stopping the batch
+  result = {'file': fileName, 'output': outputFile, 'sizeBefore': getsize(fileName)}
+  try:
+    with open(fileName, 'rb') as file:
+      docXML = removeTimelineTags(docXML=file.read())
+    makedirs(dirname(realpath(outputFile)), exist_ok=True)
+    with open(outputFile, mode='w', encoding='utf-8') as file:
+      file.write(docXML)
+    result['sizeAfter'] = getsize(outputFile)
+    result['saved'] = result['sizeBefore'] - result['sizeAfter']
+  except Exception as e:
+    result['error'] = str(e)
+  return result
+
+def removeTimelineFromDirectory(inputFolder: str, outputFolder: str, workers: int = None, verbose: bool = False) -> dict:
+  """Strips the timeline tags from every .xml file under inputFolder with a pool of processes.
+  The files are written to outputFolder with the same folder structure.
+
+  :param workers: Amount of processes, defaults to the amount of CPUs
+  :returns: dict with the result of every file (sizes before and after, bytes saved or the error) and the totals
+  """
+  fileNames = sorted(glob(join(inputFolder, '**', '*.xml'), recursive=True))
+  outputFiles = [join(outputFolder, relpath(fileName, inputFolder)) for fileName in fileNames]
+
+  results = []
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    for result in pool.map(_stripTimelineFile, fileNames, outputFiles, chunksize=4):
+      if verbose:
+        if 'error' in result: print(f"{result['file']}: There was an issue stripping the timeline tags: {result['error']}")
+        else: print(f"{result['file']}: {convertFileSize(result['sizeBefore'], 'kb')} -> {convertFileSize(result['sizeAfter'], 'kb')}")
+      results.append(result)
+
+  stripped = [result for result in results if 'error' not in result]
+  summary = {
+    'files': len(results),
+    'failed': len(results) - len(stripped),
+    'sizeBefore': sum(result['sizeBefore'] for result in stripped),
+    'sizeAfter': sum(result['sizeAfter'] for result in stripped),
+    'results': results
+  }
+  summary['saved'] = summary['sizeBefore'] - summary['sizeAfter']
+  if verbose: print(f"Stripped {len(stripped)} of {len(results)} documents, saved {convertFileSize(summary['saved'], 'mb')}")
+  return summary
+
+def downloadFile(url: str, fullFileName: str, queryParams: dict = None, progress: Callable = None) -> bool:
   if queryParams is None: queryParams = {}
   try:
-    download = requests.get(url=url, allow_redirects=True, params=queryParams)
-    open(fullFileName, 'wb').write(download.content)
+    streamDownload(url=url, target=fullFileName, queryParams=queryParams, progress=progress)
     return True
   except Exception as e:
     print(e)
     return False
 
-def generateAndDownloadPDF(connector: ChiliConnector, fullFileName: str, documentID: str = None, documentXML: str = None, settingsXML: str = None, settingsID: str = None, taskPriority: int = DEFAULT_TASKPRIORITY, verbose: bool = False, downloadXML: bool = False) -> str:
+def streamDownload(url: str, target, queryParams: dict = None, headers: dict = None, session: requests.Session = None, chunkSize: int = DEFAULT_CHUNKSIZE, resume: bool = False, retryPolicy: RetryPolicy = None, progress: Callable = None, onAttempt: Callable = None) -> dict:
+  """Streams the response body of a GET request to disk in chunks instead of holding it in memory.
+  If the connection drops the download continues where it stopped with an HTTP Range request. The Range request carries
+  the ETag or Last-Modified of the first response as If-Range, so the server sends the whole file again if it changed in
+  between. Without either header the download starts over instead.
+
+  :param target: File path or a writable binary file object
+  :param resume: Continue a partial file already at `target`. There is nothing to check it against, only use this when
+    the file at `url` can't have changed since the partial file was written
+  :param retryPolicy: Decides how often a failed download is retried, defaults to RetryPolicy()
+  :param progress: Called after every chunk as progress(bytesDownloaded, totalBytes or None, bytesPerSecond)
+  :param onAttempt: Called after every request as onAttempt(statusCode or exception name, seconds, bytesReceived), ex: to record RequestMetrics
+  :returns: dict with the bytes downloaded, seconds taken, bytesPerSecond and if the download was resumed
+  """
+  if retryPolicy is None: retryPolicy = RetryPolicy()
+  closeSession = session is None
+  if session is None: session = requests.Session()
+
+  if isinstance(target, str):
+    makedirs(dirname(realpath(target)), exist_ok=True)
+    offset = getsize(target) if resume and isfile(target) else 0
+    file = open(target, 'ab' if offset > 0 else 'wb')
+    closeFile = True
+  else:
+    file = target
+    offset = 0
+    closeFile = False
+  start = file.tell() - offset if file.seekable() else None
+
+  resumed = offset > 0
+  validator = None
+  downloaded = 0
+  attempt = 0
+  startTime = time()
+  try:
+    while True:
+      requestHeaders = dict(headers) if headers else {}
+      if offset > 0:
+        requestHeaders['Range'] = f"bytes={offset}-"
+        if validator is not None: requestHeaders['If-Range'] = validator
+      attemptStart = perf_counter()
+      attemptBytes = 0
+      status = None
+      backoff = None
+      try:
+        with session.get(url=url, params=queryParams, headers=requestHeaders, stream=True, allow_redirects=True) as resp:
+          status = resp.status_code
+          # The partial file is already complete
+          if resp.status_code == 416 and offset > 0:
+            break
+          if retryPolicy.shouldRetry('get', attempt, resp.status_code):
+            backoff = retryPolicy.getBackoff(attempt, resp.headers.get('Retry-After'))
+          else:
+            resp.raise_for_status()
+            validator = _rangeValidator(resp.headers)
+            if resp.status_code != 206 and offset > 0:
+              # The server ignored the Range header or the file changed, start over from the beginning
+              if start is None:
+                raise IOError(f"The server does not support resuming and {target} can not be rewound")
+              file.seek(start)
+              file.truncate()
+              offset = 0
+
+            total = offset + int(resp.headers['Content-Length']) if 'Content-Length' in resp.headers else None
+            for chunk in resp.iter_content(chunk_size=chunkSize):
+              file.write(chunk)
+              offset += len(chunk)
+              downloaded += len(chunk)
+              attemptBytes += len(chunk)
+              if progress is not None:
+                progress(offset, total, downloaded / max(time() - startTime, 1e-6))
+        if backoff is None:
+          break
+      except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+        status = e.__class__.__name__
+        if not retryPolicy.shouldRetry('get', attempt):
+          raise
+        if validator is None and offset > 0 and not resume:
+          # Nothing tells us the file is still the same, appending to what we have could mix two versions
+          if start is None:
+            raise
+          file.seek(start)
+          file.truncate()
+          offset = 0
+        else:
+          resumed = resumed or offset > 0
+        backoff = retryPolicy.getBackoff(attempt)
+      except Exception as e:
+        if status is None: status = e.__class__.__name__
+        raise
+      finally:
+        if onAttempt is not None:
+          onAttempt(status, perf_counter() - attemptStart, attemptBytes)
+      sleep(backoff)
+      attempt += 1
+  finally:
+    if closeFile: file.close()
+    if closeSession: session.close()
+
+  seconds = time() - startTime
+  return {'bytes':downloaded, 'seconds':seconds, 'bytesPerSecond':downloaded / max(seconds, 1e-6), 'resumed':resumed}
+
+def _rangeValidator(headers) -> str:
+  # If-Range only takes a strong ETag or a Last-Modified date
+  etag = headers.get('ETag')
+  if etag and not etag.startswith('W/'):
+    return etag
+  return headers.get('Last-Modified')
+
+def generateAndDownloadPDF(connector: ChiliConnector, fullFileName: str, documentID: str = None, documentXML: str = None, settingsXML: str = None, settingsID: str = None, taskPriority: int = DEFAULT_TASKPRIORITY, verbose: bool = False, downloadXML: bool = False, progress: Callable = None) -> str:
 
   if documentID is None and documentXML is None:
     return 'You need to provide a document ID or document XML parameter'
@@ -95,7 +380,8 @@ def generateAndDownloadPDF(connector: ChiliConnector, fullFileName: str, documen
     if verbose: print("Downloading XML for document")
     resp = connector.resources.ResourceItemGetXML(
       resourceType="documents",
-      itemID=documentID
+      itemID=documentID,
+      parser=PARSER_NONE
     )
     if not resp.didSucceed:
       return "There was a problem getting the XML for the document"
@@ -104,7 +390,7 @@ def generateAndDownloadPDF(connector: ChiliConnector, fullFileName: str, documen
 
   if settingsID is not None:
     print(f"Getting PDF Export Settings XML for {settingsID}")
-    settingsXML = connector.resources.getPDFSettingsXML(settingsID=settingsID).text
+    settingsXML = connector.resources.getPDFSettingsXML(settingsID=settingsID, parser=PARSER_NONE).text
 
   if documentID is not None:
     resp = connector.makeRequest(
@@ -122,7 +408,7 @@ def generateAndDownloadPDF(connector: ChiliConnector, fullFileName: str, documen
     resultURL = getTaskResultURL(task=task)
     if resultURL == ErrorHandler().getError(errorName="TASKNOTSUCCEEDED"):
       return False
-    success = downloadFile(url=resultURL, fullFileName=fullFileName)
+    success = downloadFile(url=resultURL, fullFileName=fullFileName, progress=progress)
     print(f"URL: {getTaskResultURL(task=task)}")
     if success:
       return (f"The file successfully downloaded to {fullFileName}")
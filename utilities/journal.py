@@ -0,0 +1,95 @@
+import json
+from os import fsync, makedirs, replace
+from os.path import dirname, getsize, isfile, realpath
+from threading import RLock
+
+
+class ProgressJournal:
+  """Crash safe progress store made of a JSON snapshot and an append-only journal of changes since that snapshot.
+
+  Every change is appended as one JSON line, so recording progress costs a few bytes instead of rewriting the whole state.
+  `compact` atomically replaces the snapshot and empties the journal. A line cut off by a crash is ignored when loading.
+
+  :param snapshotFile: Path of the JSON snapshot, ex: progress.json
+  :param journalFile: Path of the journal, defaults to the snapshot path with a .journal extension
+  :param compactEvery: Amount of journal entries after which `needsCompaction` is True
+  :param sync: fsync every entry, slower but survives power loss and not just a crashed process
+  """
+  def __init__(self, snapshotFile: str, journalFile: str = None, compactEvery: int = 1000, sync: bool = False):
+    self.snapshotFile = snapshotFile
+    self.journalFile = journalFile if journalFile is not None else snapshotFile.rsplit('.json', 1)[0] + '.journal'
+    self.compactEvery = compactEvery
+    self.sync = sync
+    self.entries = 0
+    self._file = None
+    self._lock = RLock()
+
+  @property
+  def needsCompaction(self) -> bool:
+    return self.entries >= self.compactEvery
+
+  def exists(self) -> bool:
+    return isfile(self.snapshotFile)
+
+  def load(self) -> tuple:
+    """Returns the snapshot (None if there is none) and the list of journal entries written after it"""
+    snapshot = None
+    if isfile(self.snapshotFile):
+      with open(self.snapshotFile, 'r') as file:
+        snapshot = json.load(file)
+
+    entries = []
+    if isfile(self.journalFile):
+      with open(self.journalFile, 'r') as file:
+        for line in file:
+          try:
+            entries.append(json.loads(line))
+          except json.JSONDecodeError:
+            # An entry cut off by a crash, appending starts a new line after it
+            continue
+    self.entries = len(entries)
+    return snapshot, entries
+
+  def append(self, entry: dict):
+    line = json.dumps(entry, separators=(',', ':')) + '\n'
+    with self._lock:
+      if self._file is None:
+        makedirs(dirname(realpath(self.journalFile)), exist_ok=True)
+        self._file = open(self.journalFile, 'a')
+        # Start on a fresh line if the previous run crashed in the middle of an entry
+        if self._file.tell() > 0 and not self._endsWithNewline():
+          self._file.write('\n')
+      self._file.write(line)
+      self._file.flush()
+      if self.sync: fsync(self._file.fileno())
+      self.entries += 1
+
+  def compact(self, snapshot):
+    """Atomically writes a new snapshot and empties the journal"""
+    with self._lock:
+      makedirs(dirname(realpath(self.snapshotFile)), exist_ok=True)
+      tmpFile = self.snapshotFile + '.tmp'
+      with open(tmpFile, 'w') as file:
+        json.dump(snapshot, file)
+        file.flush()
+        fsync(file.fileno())
+      replace(tmpFile, self.snapshotFile)
+
+      # Replaying the old journal on top of the new snapshot is harmless so a crash right here loses nothing
+      if self._file is not None:
+        self._file.close()
+      self._file = open(self.journalFile, 'w')
+      self.entries = 0
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+  def _endsWithNewline(self) -> bool:
+    if getsize(self.journalFile) == 0:
+      return True
+    with open(self.journalFile, 'rb') as file:
+      file.seek(-1, 2)
+      return file.read(1) == b'\n'
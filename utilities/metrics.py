@@ -0,0 +1,172 @@
+import json
+import re
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+
+from chilitools.utilities.defaults import DEFAULT_LATENCY_BUCKETS, RESOURCE_PATH_KEYWORDS
+
+# Collections whose next path segment is an item ID, /resources/{type}/items/{id} or /system/tasks/{id}
+_collections = {'items', 'tasks', 'templates', 'environments'}
+_idLike = re.compile(r'^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})$')
+
+def templateEndpoint(endpoint: str) -> str:
+  """Replaces the resource types and IDs in an endpoint with placeholders so the calls for every item add up,
+  ex: /resources/Assets/items/1234/xml -> /resources/{type}/items/{id}/xml
+  """
+  segments = endpoint.split('?', 1)[0].strip('/').split('/')
+  template = []
+  for i, segment in enumerate(segments):
+    previous = segments[i - 1] if i > 0 else None
+    if previous == 'resources':
+      template.append('{type}')
+    elif segment in RESOURCE_PATH_KEYWORDS:
+      template.append(segment)
+    elif previous in _collections or _idLike.match(segment):
+      template.append('{id}')
+    # /resources/documents/{id}/info
+    elif i == 2 and segments[0] == 'resources':
+      template.append('{id}')
+    else:
+      template.append(segment)
+  return '/' + '/'.join(template)
+
+
+class EndpointMetrics:
+  """Counters of one api, method and endpoint template"""
+  def __init__(self, buckets: list):
+    self.buckets = buckets
+    self.count = 0
+    self.errors = 0
+    self.statusCodes = Counter()
+    # Amount of requests per latency bucket, the last one is everything above the highest bucket
+    self.latencyCounts = [0] * (len(buckets) + 1)
+    self.seconds = 0.0
+    self.maxSeconds = 0.0
+    self.bytesOut = 0
+    self.bytesIn = 0
+
+  def record(self, statusCode, seconds: float, bytesOut: int, bytesIn: int):
+    self.count += 1
+    self.statusCodes[str(statusCode)] += 1
+    if not isinstance(statusCode, int) or statusCode >= 400:
+      self.errors += 1
+    self.latencyCounts[bisect_left(self.buckets, seconds)] += 1
+    self.seconds += seconds
+    self.maxSeconds = max(self.maxSeconds, seconds)
+    self.bytesOut += bytesOut
+    self.bytesIn += bytesIn
+
+  def asDict(self) -> dict:
+    return {
+      'count': self.count,
+      'errors': self.errors,
+      'statusCodes': dict(self.statusCodes),
+      'seconds': round(self.seconds, 6),
+      'avgSeconds': round(self.seconds / self.count, 6) if self.count else 0,
+      'maxSeconds': round(self.maxSeconds, 6),
+      'latencyBuckets': {str(le): n for le, n in zip(self.buckets + ['+Inf'], self.latencyCounts)},
+      'bytesOut': self.bytesOut,
+      'bytesIn': self.bytesIn
+    }
+
+
+class RequestMetrics:
+  """Request counts, latency histogram, status codes and bytes sent/received per endpoint template.
+
+  Every ChiliConnector and GraFxConnector records into one, pass the same instance to several connectors to add them up.
+  Query it with `snapshot()` or `top()`, or export it with `toJSON()` and `toPrometheus()`.
+
+  :param buckets: Upper bounds in seconds of the latency histogram buckets
+  """
+  def __init__(self, buckets: list = None):
+    self.buckets = sorted(buckets if buckets is not None else DEFAULT_LATENCY_BUCKETS)
+    self._endpoints = {}
+    self._lock = Lock()
+
+  def record(self, method: str, endpoint: str, statusCode, seconds: float, bytesOut: int = 0, bytesIn: int = 0, api: str = 'publisher'):
+    """Records one request, statusCode is the name of the exception for requests that didn't get a response"""
+    key = (api, method.upper(), templateEndpoint(endpoint))
+    with self._lock:
+      metrics = self._endpoints.get(key)
+      if metrics is None:
+        metrics = self._endpoints[key] = EndpointMetrics(self.buckets)
+      metrics.record(statusCode, seconds, bytesOut, bytesIn)
+
+  def recordResponse(self, method: str, endpoint: str, response, seconds: float, api: str = 'publisher'):
+    """Records a requests.Response"""
+    self.record(method, endpoint, response.status_code, seconds, bytesOut=_requestSize(response.request), bytesIn=_responseSize(response), api=api)
+
+  def snapshot(self) -> list:
+    """Returns the metrics of every endpoint as a list of dicts with the api, method and endpoint template"""
+    with self._lock:
+      return [{'api': api, 'method': method, 'endpoint': endpoint, **metrics.asDict()} for (api, method, endpoint), metrics in self._endpoints.items()]
+
+  def get(self, method: str, endpoint: str, api: str = 'publisher') -> dict:
+    """Returns the metrics of one endpoint, the endpoint can be a template or a real path"""
+    with self._lock:
+      metrics = self._endpoints.get((api, method.upper(), templateEndpoint(endpoint)))
+      return metrics.asDict() if metrics is not None else None
+
+  def top(self, n: int = 10, by: str = 'seconds') -> list:
+    """Returns the n endpoints with the highest `by`: seconds, count, errors, bytesIn or bytesOut"""
+    return sorted(self.snapshot(), key=lambda m: m[by], reverse=True)[:n]
+
+  def reset(self):
+    with self._lock:
+      self._endpoints.clear()
+
+  def toJSON(self, indent: int = None) -> str:
+    return json.dumps(self.snapshot(), indent=indent)
+
+  def toPrometheus(self, prefix: str = 'chilitools') -> str:
+    """Returns the metrics in the Prometheus text exposition format"""
+    lines = []
+    with self._lock:
+      endpoints = sorted(self._endpoints.items())
+
+      lines.append(f'# HELP {prefix}_requests_total Requests made, by status code')
+      lines.append(f'# TYPE {prefix}_requests_total counter')
+      for key, metrics in endpoints:
+        for status, n in sorted(metrics.statusCodes.items()):
+          lines.append(f'{prefix}_requests_total{{{_labels(key)},status="{_escape(status)}"}} {n}')
+
+      lines.append(f'# HELP {prefix}_request_duration_seconds Request latency')
+      lines.append(f'# TYPE {prefix}_request_duration_seconds histogram')
+      for key, metrics in endpoints:
+        labels = _labels(key)
+        cumulative = 0
+        for le, n in zip(self.buckets + ['+Inf'], metrics.latencyCounts):
+          cumulative += n
+          lines.append(f'{prefix}_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'{prefix}_request_duration_seconds_sum{{{labels}}} {metrics.seconds}')
+        lines.append(f'{prefix}_request_duration_seconds_count{{{labels}}} {metrics.count}')
+
+      for name, attribute, description in (('request_bytes_total', 'bytesOut', 'Bytes sent in request bodies'), ('response_bytes_total', 'bytesIn', 'Bytes received in response bodies')):
+        lines.append(f'# HELP {prefix}_{name} {description}')
+        lines.append(f'# TYPE {prefix}_{name} counter')
+        for key, metrics in endpoints:
+          lines.append(f'{prefix}_{name}{{{_labels(key)}}} {getattr(metrics, attribute)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(key: tuple) -> str:
+  api, method, endpoint = key
+  return f'api="{_escape(api)}",method="{method}",endpoint="{_escape(endpoint)}"'
+
+def _escape(value: str) -> str:
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _requestSize(request) -> int:
+  if request is None or request.body is None:
+    return 0
+  if isinstance(request.body, (bytes, str)):
+    return len(request.body)
+  # Streamed bodies, ex: a base64 encoded file
+  return int(request.headers.get('Content-Length', 0))
+
+def _responseSize(response) -> int:
+  contentLength = response.headers.get('Content-Length')
+  if contentLength is not None:
+    return int(contentLength)
+  return len(response.content)
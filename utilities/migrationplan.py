@@ -0,0 +1,59 @@
+from graphlib import TopologicalSorter
+
+
+class MigrationPlan:
+  """Dependency graph of the items being migrated.
+
+  Every item is a (resource, itemID) node, an item depends on the resources it uses (ex: a document on its fonts and assets).
+  Shared resources are a single node no matter how many items use them, so they are transferred once.
+  `batches` walks the graph in topological order, grouped by resource type so each group can be transferred in one go.
+  """
+  def __init__(self):
+    self.graph = {}
+
+  def __len__(self) -> int:
+    return len(self.graph)
+
+  def __contains__(self, node: tuple) -> bool:
+    return node in self.graph
+
+  def addItem(self, resource: str, itemID: str, dependencies: dict = None):
+    """Adds an item and the resources it depends on
+
+    :param dependencies: Dict of resource type to a list of item IDs, ex: ChiliDocument.get_dependencies()
+    """
+    node = (resource.lower(), itemID)
+    edges = self.graph.setdefault(node, set())
+    for depResource, itemIDs in (dependencies or {}).items():
+      for depID in itemIDs:
+        dep = (depResource.lower(), depID)
+        self.graph.setdefault(dep, set())
+        edges.add(dep)
+
+  def dependencies(self, resource: str, itemID: str) -> set:
+    return self.graph.get((resource.lower(), itemID), set())
+
+  def usage(self) -> dict:
+    """Returns how many items use each dependency"""
+    counts = {}
+    for edges in self.graph.values():
+      for dep in edges:
+        counts[dep] = counts.get(dep, 0) + 1
+    return counts
+
+  def batches(self, exclude: set = None):
+    """Yields (resource, [itemIDs]) in dependency order, every item comes after everything it depends on
+
+    :param exclude: Nodes that should not be yielded, ex: the items already transferred
+    """
+    sorter = TopologicalSorter(self.graph)
+    sorter.prepare()
+    while sorter.is_active():
+      ready = sorter.get_ready()
+      groups = {}
+      for resource, itemID in ready:
+        if exclude is None or (resource, itemID) not in exclude:
+          groups.setdefault(resource, []).append(itemID)
+      for resource, itemIDs in groups.items():
+        yield resource, itemIDs
+      sorter.done(*ready)
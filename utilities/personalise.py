@@ -0,0 +1,131 @@
+from __future__ import annotations
+from os import makedirs
+from threading import RLock
+from typing import TYPE_CHECKING, Callable, Iterable
+
+if TYPE_CHECKING:
+  from chilitools.api.connector import ChiliConnector
+
+from lxml.etree import XMLParser, fromstring, tostring
+from chilitools.utilities.defaults import DEFAULT_TASKPRIORITY, PARSER_NONE
+from chilitools.utilities.journal import ProgressJournal
+from chilitools.utilities.render import PDFBatchRenderer
+
+_templateParser = XMLParser(huge_tree=True)
+
+class PersonalisationEngine:
+  """Renders one PDF per record from a template document, without saving anything on the server.
+
+  The template XML is fetched and parsed once. For every record the document variables named like the record keys
+  get the record values and the document is rendered with createTempPDF through a PDFBatchRenderer, so only
+  `concurrency` documents are in memory at a time and the records can be a generator or a csv.DictReader.
+
+  With a `checkpointFile` every finished record is appended to a ProgressJournal, running the same records again
+  skips the ones that already have their PDF.
+
+  :param nameField: Record key used as the output file name, records are named by their index when it is not set
+  """
+  def __init__(self, connector: ChiliConnector, templateID: str, outputFolder: str, settingsID: str = None, settingsXML: str = None, nameField: str = None, concurrency: int = 10, downloadWorkers: int = 4, taskPriority: int = DEFAULT_TASKPRIORITY, timeout: float = None, checkpointFile: str = None, checkpointCompactEvery: int = 1000, verbose: bool = False):
+    self.connector = connector
+    self.templateID = templateID
+    self.outputFolder = outputFolder
+    self.nameField = nameField
+    self.verbose = verbose
+    self.renderer = PDFBatchRenderer(
+      connector=connector,
+      outputFolder=outputFolder,
+      settingsID=settingsID,
+      settingsXML=settingsXML,
+      concurrency=concurrency,
+      downloadWorkers=downloadWorkers,
+      taskPriority=taskPriority,
+      timeout=timeout,
+      verbose=verbose
+    )
+    self.journal = None
+    if checkpointFile is not None:
+      self.journal = ProgressJournal(snapshotFile=checkpointFile, compactEvery=checkpointCompactEvery)
+    self._template = None
+    self._variables = None
+    self._defaults = None
+    self._done = set()
+    self._lock = RLock()
+
+  def _loadTemplate(self):
+    if self._template is not None:
+      return
+    resp = self.connector.documents.getXML(documentID=self.templateID, parser=PARSER_NONE)
+    if not resp.success:
+      raise IOError(f"There was an issue getting the template document XML for {self.templateID}: {resp.text}")
+    self._template = fromstring(resp.response.content, parser=_templateParser)
+    self._variables = {item.get('name'): item for item in self._template.iterfind('variables/item')}
+    self._defaults = {name: item.get('value') for name, item in self._variables.items()}
+
+  def _loadCheckpoint(self):
+    if self.journal is None:
+      return
+    snapshot, entries = self.journal.load()
+    self._done = set(snapshot.get('done', [])) if snapshot else set()
+    self._done.update(entry['name'] for entry in entries)
+
+  def documentXML(self, record: dict) -> str:
+    """Returns the template document XML with the values of the record"""
+    self._loadTemplate()
+    # Every variable is set, a value left over from the previous record would end up in this one
+    for name, variable in self._variables.items():
+      value = record.get(name, self._defaults[name])
+      if value is None:
+        variable.attrib.pop('value', None)
+      else:
+        variable.set('value', str(value))
+    return tostring(self._template, encoding='unicode')
+
+  def _recordName(self, index: int, record: dict) -> str:
+    if self.nameField is None:
+      return str(index)
+    return str(record[self.nameField])
+
+  def _jobs(self, records: Iterable, state: dict):
+    # The shared template tree is only touched here, the renderer pulls one job at a time from the calling thread
+    for index, record in enumerate(records):
+      name = self._recordName(index, record)
+      if name in self._done:
+        state['skipped'] += 1
+        continue
+      yield {'name': name, 'documentXML': self.documentXML(record)}
+
+  def _finished(self, entry: dict):
+    if entry['status'] != 'success' or self.journal is None:
+      return
+    with self._lock:
+      self._done.add(entry['name'])
+      self.journal.append({'name': entry['name']})
+      if self.journal.needsCompaction:
+        self.journal.compact({'done': list(self._done)})
+
+  def run(self, records: Iterable, manifestFile: str = None, onResult: Callable = None) -> dict:
+    """Renders every record and returns the PDFBatchRenderer summary, plus the amount of records `skipped` by the checkpoint.
+
+    :param records: Iterable of dicts of variable name to value
+    :param manifestFile: Path of a JSON manifest with the timings and errors of every record
+    :param onResult: Called with the manifest entry of every record when it is done
+    """
+    self._loadTemplate()
+    self._loadCheckpoint()
+    makedirs(self.outputFolder, exist_ok=True)
+    if self.verbose and self._done: print(f"PersonalisationEngine: {len(self._done)} records are already done, skipping them")
+
+    def finished(entry: dict):
+      self._finished(entry)
+      if onResult is not None: onResult(entry)
+
+    state = {'skipped': 0}
+    try:
+      summary = self.renderer.render(self._jobs(records, state), manifestFile=manifestFile, onResult=finished)
+    finally:
+      if self.journal is not None:
+        with self._lock:
+          self.journal.compact({'done': list(self._done)})
+          self.journal.close()
+    summary['skipped'] = state['skipped']
+    return summary
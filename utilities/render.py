@@ -0,0 +1,181 @@
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Condition
+from time import time
+from typing import TYPE_CHECKING, Callable, Iterable
+
+if TYPE_CHECKING:
+    from chilitools.api.connector import ChiliConnector
+
+from chilitools.utilities.defaults import DEFAULT_TASKPRIORITY, PARSER_NONE
+from chilitools.utilities.file import streamDownload, writeFile
+from chilitools.utilities.xmltools import taskWasSuccessfull, getTaskResultURL
+
+
+class PDFBatchRenderer:
+  """Renders a batch of documents to PDF with one PdfExportSettings XML.
+
+  At most `concurrency` jobs are in flight (submitted but not yet downloaded), their tasks are tracked together
+  by the connector's TaskWaiter and every PDF is streamed to `outputFolder` as soon as its task finishes.
+  Jobs are consumed lazily so the job iterable can be a generator.
+
+  A job is a dict with a `name` (the output file name without extension) and either a `documentID` or `documentXML`.
+  """
+  def __init__(self, connector: ChiliConnector, outputFolder: str, settingsID: str = None, settingsXML: str = None, concurrency: int = 10, downloadWorkers: int = 4, taskPriority: int = DEFAULT_TASKPRIORITY, timeout: float = None, verbose: bool = False):
+    if settingsID is None and settingsXML is None:
+      raise ValueError("You need to provide a PDF Export Settings Item ID or PDF Export Settings XML")
+    self.connector = connector
+    self.outputFolder = outputFolder
+    self.settingsID = settingsID
+    self.settingsXML = settingsXML
+    self.concurrency = concurrency
+    self.downloadWorkers = downloadWorkers
+    self.taskPriority = taskPriority
+    self.timeout = timeout
+    self.verbose = verbose
+
+  def _getSettingsXML(self) -> str:
+    # Fetched once for the whole batch
+    if self.settingsXML is None:
+      resp = self.connector.resources.getPDFSettingsXML(settingsID=self.settingsID, parser=PARSER_NONE)
+      if not resp.success:
+        raise IOError(f"There was an issue getting the PDF Export Settings XML for {self.settingsID}: {resp.text}")
+      self.settingsXML = resp.text
+    return self.settingsXML
+
+  def render(self, jobs: Iterable, manifestFile: str = None, onResult: Callable = None) -> dict:
+    """Renders every job and returns a summary with the manifest entries.
+
+    :param manifestFile: Path of a JSON manifest with the timings and errors of every job, the entries are only kept in memory when this is set
+    :param onResult: Called with the manifest entry of every job when it is done, an exception it raises ends up in the entry's `callbackError`
+    """
+    settingsXML = self._getSettingsXML()
+    slots = BoundedSemaphore(self.concurrency)
+    finished = Condition()
+    state = {'inFlight': 0, 'success': 0, 'failed': 0}
+    entries = []
+    startTime = time()
+
+    def done(entry: dict):
+      # Every job is counted exactly once, otherwise render() waits forever or a slot is released twice
+      start = entry.pop('_start', None)
+      if start is None:
+        return
+      try:
+        entry['totalSeconds'] = round(time() - start, 3)
+        if self.verbose: print(f"PDFBatchRenderer: {entry['name']} {entry['status']} in {entry['totalSeconds']}s")
+        if onResult is not None: onResult(entry)
+      except Exception as e:
+        entry['callbackError'] = str(e)
+        if self.verbose: print(f"PDFBatchRenderer: onResult failed for {entry['name']}: {e}")
+      finally:
+        if manifestFile is not None: entries.append(entry)
+        with finished:
+          state['inFlight'] -= 1
+          state[entry['status']] += 1
+          finished.notify_all()
+        slots.release()
+
+    def fail(entry: dict, error):
+      entry['status'] = 'failed'
+      entry['error'] = str(error)
+      done(entry)
+
+    def download(entry: dict, task: dict):
+      try:
+        downloadStart = time()
+        result = streamDownload(url=getTaskResultURL(task=task), target=entry['file'], session=self.connector.session, resume=False, retryPolicy=self.connector.retryPolicy)
+        entry['downloadSeconds'] = round(time() - downloadStart, 3)
+        entry['bytes'] = result['bytes']
+        entry['status'] = 'success'
+        done(entry)
+      except Exception as e:
+        fail(entry, e)
+
+    def taskFinished(entry: dict, future: Future):
+      # Runs as a Future callback, where an exception would be swallowed and the job never finished
+      try:
+        entry['renderSeconds'] = round(time() - entry.pop('_submitted'), 3)
+        task = future.result()
+        if not taskWasSuccessfull(task=task):
+          return fail(entry, f"The task did not succeed: {task['task'].get('@errorMessage', '')}")
+        downloads.submit(download, entry, task)
+      except Exception as e:
+        fail(entry, e)
+
+    def submit(job: dict):
+      entry = {'name': None, 'documentID': None, 'file': None, '_start': time()}
+      try:
+        if not isinstance(job, dict) or 'name' not in job:
+          raise ValueError("Every job needs to be a dict with a name")
+        entry.update(name=job['name'], documentID=job.get('documentID'), file=f"{self.outputFolder}/{job['name']}.pdf")
+        if job.get('documentID') is not None:
+          resp = self.connector.documents.createPDF(documentID=job['documentID'], settingsXML=settingsXML, taskPriority=self.taskPriority)
+        else:
+          resp = self.connector.documents.createTempPDF(documentXML=job['documentXML'], settingsXML=settingsXML, taskPriority=self.taskPriority)
+        if not resp.success:
+          return fail(entry, f"There was an issue submitting the PDF task: {resp.text}")
+        entry['taskID'] = resp.contentAsDict()['task']['@id']
+        entry['submitSeconds'] = round(time() - entry['_start'], 3)
+        entry['_submitted'] = time()
+        self.connector.system.taskWaiter.track(
+          taskID=entry['taskID'],
+          priority=self.taskPriority,
+          timeout=self.timeout,
+          callback=lambda future: taskFinished(entry, future)
+        )
+      except Exception as e:
+        entry.pop('_submitted', None)
+        fail(entry, e)
+
+    with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='PDFSubmit') as submits, ThreadPoolExecutor(max_workers=self.downloadWorkers, thread_name_prefix='PDFDownload') as downloads:
+      for job in jobs:
+        slots.acquire()
+        with finished:
+          state['inFlight'] += 1
+        submits.submit(submit, job)
+      with finished:
+        finished.wait_for(lambda: state['inFlight'] == 0)
+
+    summary = {
+      'jobs': state['success'] + state['failed'],
+      'succeeded': state['success'],
+      'failed': state['failed'],
+      'seconds': round(time() - startTime, 3),
+      'entries': entries
+    }
+    if manifestFile is not None:
+      writeFile(fileName=manifestFile, data=summary, isJSON=True)
+    return summary
+
+
+def batchGenerateAndDownloadPDF(connector: ChiliConnector, outputFolder: str, documentIDs: list = None, documentXMLs = None, settingsID: str = None, settingsXML: str = None, concurrency: int = 10, taskPriority: int = DEFAULT_TASKPRIORITY, timeout: float = None, manifestFile: str = None, verbose: bool = False) -> dict:
+  """Batch version of generateAndDownloadPDF. Renders every document ID or document XML to `outputFolder`/<name>.pdf
+
+  :param documentIDs: List of document IDs, the ID is used as the file name
+  :param documentXMLs: Dict of file name to document XML, or a list of document XMLs (named by their index)
+  :param manifestFile: Path of a JSON manifest with the timings and failures of every document
+  """
+  if documentIDs is None and documentXMLs is None:
+    raise ValueError("You need to provide document IDs or document XMLs")
+
+  jobs = []
+  if documentIDs is not None:
+    jobs.extend({'name': documentID, 'documentID': documentID} for documentID in documentIDs)
+  if documentXMLs is not None:
+    if isinstance(documentXMLs, dict):
+      jobs.extend({'name': name, 'documentXML': xml} for name, xml in documentXMLs.items())
+    else:
+      jobs.extend({'name': str(index), 'documentXML': xml} for index, xml in enumerate(documentXMLs))
+
+  renderer = PDFBatchRenderer(
+    connector=connector,
+    outputFolder=outputFolder,
+    settingsID=settingsID,
+    settingsXML=settingsXML,
+    concurrency=concurrency,
+    taskPriority=taskPriority,
+    timeout=timeout,
+    verbose=verbose
+  )
+  return renderer.render(jobs, manifestFile=manifestFile)
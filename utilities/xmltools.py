@@ -1,18 +1,25 @@
 import re
+from functools import lru_cache
 import xmltodict
 from chilitools.utilities.errors import ErrorHandler
 from xml.sax.saxutils import unescape
-from lxml.etree import Element, SubElement, tostring
-from bs4 import BeautifulSoup
+from contextlib import contextmanager
+from io import BytesIO
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from lxml.etree import Element, SubElement, XMLParser, XMLSyntaxError, fromstring, iterparse, tostring
 
 #TODO FIX THE 'xml' package import problem conflicting with the xml.py filename
 
 illegalXMLCharacters = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
 
+_illegalXMLClass = u'\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF'
+_invisibleSpaces = u'\u200b\xa0\ufeff'
+_smartQuotes = {u'\u2018': '\'', u'\u2019': '\'', u'\u201c': '"', u'\u201d': '"'}
+_nonASCIICharacters = re.compile(u'[\x7f-\U0010FFFF]')
+
 def sanitizeAndUpload(chiliConnector, newName: str, folderPath: str, xml: str, strict: bool = False):
-  xml = cleanXML(xml)
-  xml = removeSpaces(xml)
-  if strict: xml = sanitize_text(xml).decode('utf-8')
+  xml = normalizeXML(xml, strict=strict)
   return chiliConnector.resources.ResourceItemAdd(
     resourceType='documents',
     newName=newName,
@@ -27,58 +34,143 @@ def parseXML(xmlString: str):
   return xmltodict.parse(xmlString)
 
 def cleanXML(val: str, replacement: str = '') -> str:
-  return illegalXMLCharacters.sub(replacement, val)
+  return normalizeXML(val, spaces=False, replacement=replacement)
 
 def removeSpaces(xmlString: str) -> str:
-  return xmlString.replace(u'\u200b', '').replace(u'\xa0', '').replace(u'\ufeff', '')
+  return normalizeXML(xmlString, illegal=False)
 
 def getIllegalChars(xmlString: str) -> list:
-  return [c for c in xmlString if ord(c) >= 127]
+  return _nonASCIICharacters.findall(xmlString)
 
 def sanitize_text(data: str, verbose: bool = False):
-  replace_with = {
-    u'\u2018': '\'',
-    u'\u2019': '\'',
-    u'\u201c': '"',
-    u'\u201d': '"'
-  }
-
-  bad_chars = [c for c in data if ord(c) >= 127]
-  if bad_chars and verbose:
-    print('INVALID CHARACTERS: {}'.format(bad_chars))
-  else:
-    print('INVALID CHARACTERS: {}'.format(bad_chars))
-
-  for uni_char in replace_with.keys():
-    data = data.replace(uni_char, replace_with.get(uni_char))
-
-  data = ''.join([c for c in data if ord(c) < 127])
-  return data.encode('utf-8', 'xmlcharreplace')
+  if verbose:
+    bad_chars = getIllegalChars(data)
+    if bad_chars: print('INVALID CHARACTERS: {}'.format(bad_chars))
+  return normalizeXML(data, illegal=False, spaces=False, strict=True).encode('utf-8')
+
+def normalizeXML(xmlString: str, illegal: bool = True, spaces: bool = True, strict: bool = False, replacement: str = '') -> str:
+  """Cleans a document XML string in a single pass, everything cleanXML, removeSpaces and sanitize_text do in one go.
+
+  :param illegal: Replace characters that are not allowed in XML with `replacement` (cleanXML)
+  :param spaces: Remove zero width spaces, non breaking spaces and byte order marks (removeSpaces)
+  :param strict: Replace smart quotes with plain quotes and remove every other non ASCII character (sanitize_text)
+  """
+  pattern, repl = _getNormalizer(illegal, spaces, strict, replacement)
+  if pattern is None:
+    return xmlString
+  return pattern.sub(repl, xmlString)
+
+def normalizeXMLStream(chunks, illegal: bool = True, spaces: bool = True, strict: bool = False, replacement: str = ''):
+  """Generator version of normalizeXML for text read in chunks, ex: iter(lambda: file.read(1048576), '')"""
+  pattern, repl = _getNormalizer(illegal, spaces, strict, replacement)
+  for chunk in chunks:
+    yield chunk if pattern is None else pattern.sub(repl, chunk)
+
+@lru_cache(maxsize=None)
+def _getNormalizer(illegal: bool, spaces: bool, strict: bool, replacement: str) -> tuple:
+  # One compiled character class per combination of options. A plain string replacement is used when possible,
+  # the function is only called for the characters that are actually found
+  illegalChars = re.compile(u'[' + _illegalXMLClass + u']')
+  characters = (_illegalXMLClass if illegal else '') + (_invisibleSpaces if spaces else '')
+  if strict:
+    characters += u'\x7f-\U0010FFFF'
+  if not characters:
+    return None, None
+  pattern = re.compile(u'[' + characters + u']')
+
+  if not strict and (replacement == '' or not illegal):
+    return pattern, ''
+  if not strict and not spaces:
+    return pattern, replacement.replace('\\', '\\\\')
+
+  def repl(match) -> str:
+    char = match.group()
+    if illegal and illegalChars.match(char):
+      return replacement
+    if strict:
+      return _smartQuotes.get(char, '')
+    return ''
+  return pattern, repl
 
 def createDatasourceXML(dataSourceID: str, data: list) -> str:
-  numChildren = len(data)
-  root = Element('dataSource', {'dataSourceID':dataSourceID, 'hasContent':'true', 'numRows':str(numChildren)})
-  for r in range(numChildren):
-    row = SubElement(root, 'row', {'rowNum':str(r+1)})
-    c = 1
-    for key, value in data[r].items():
-      col = SubElement(row, 'col'+str(c), {'varName':key})
-      col.text = str(value)
-      c += 1
-  return tostring(root, encoding='unicode')
+  buffer = BytesIO()
+  writeDatasourceXML(dataSourceID=dataSourceID, rows=data, target=buffer)
+  return buffer.getvalue().decode('utf-8')
 
 def createDatasource(dataSourceID: str, data: list) -> Element:
-  numChildren = len(data)
-  root = Element('dataSource', {'dataSourceID':dataSourceID, 'hasContent':'true', 'numRows':str(numChildren)})
-  for r in range(numChildren):
-    row = SubElement(root, 'row', {'rowNum':str(r+1)})
-    c = 1
-    for key, value in data[r].items():
-      col = SubElement(row, 'col'+str(c), {'varName':key})
-      col.text = str(value)
-      c += 1
+  root = Element('dataSource', {'dataSourceID':dataSourceID, 'hasContent':'true', 'numRows':str(len(data))})
+  for r, rowData in enumerate(data):
+    root.append(_datasourceRow(r+1, rowData))
   return root
 
+def _datasourceRow(rowNum: int, rowData: dict) -> Element:
+  row = Element('row', {'rowNum':str(rowNum)})
+  for c, (key, value) in enumerate(rowData.items()):
+    col = SubElement(row, 'col'+str(c+1), {'varName':key})
+    col.text = str(value)
+  return row
+
+def writeDatasourceXML(dataSourceID: str, rows, target, numRows: int = None, spoolSize: int = 8 * 1024 * 1024) -> int:
+  """Writes a dataSource node row by row to a file path or binary file object, only one row is held in memory.
+  Any iterable of dicts works as rows, ex: a csv.DictReader. Returns the amount of rows written.
+
+  numRows has to be in the opening tag, so if it isn't passed and the rows have no len() they are spooled to a
+  temporary file first (in memory up to spoolSize bytes) while they are counted.
+  """
+  if numRows is None and hasattr(rows, '__len__'):
+    numRows = len(rows)
+  if numRows is None:
+    with SpooledTemporaryFile(max_size=spoolSize) as spool:
+      numRows = _writeDatasourceRows(rows, spool)
+      spool.seek(0)
+      with _openTarget(target) as file:
+        file.write(_datasourceOpenTag(dataSourceID, numRows))
+        copyfileobj(spool, file)
+        file.write(b'</dataSource>')
+    return numRows
+
+  with _openTarget(target) as file:
+    file.write(_datasourceOpenTag(dataSourceID, numRows))
+    written = _writeDatasourceRows(rows, file)
+    file.write(b'</dataSource>')
+  if written != numRows:
+    raise ValueError(f"numRows was {numRows} but {written} rows were written")
+  return written
+
+def _datasourceOpenTag(dataSourceID: str, numRows: int) -> bytes:
+  return tostring(Element('dataSource', {'dataSourceID':dataSourceID, 'hasContent':'true', 'numRows':str(numRows)}))[:-2] + b'>'
+
+def _writeDatasourceRows(rows, file) -> int:
+  count = 0
+  for count, rowData in enumerate(rows, start=1):
+    file.write(tostring(_datasourceRow(count, rowData), encoding='utf-8'))
+  return count
+
+@contextmanager
+def _openTarget(target):
+  if isinstance(target, str):
+    with open(target, 'wb') as file:
+      yield file
+  else:
+    yield target
+
+def readDatasourceRows(source):
+  """Yields every row of a dataSource node as a dict of varName to value, one row at a time.
+
+  :param source: Document XML or dataSource XML as str or bytes, a file path or a binary file object
+  """
+  if isinstance(source, str) and source.lstrip().startswith('<'): source = source.encode('utf-8')
+  if isinstance(source, bytes): source = BytesIO(source)
+
+  for _, row in iterparse(source, events=('end',), tag='row', huge_tree=True):
+    parent = row.getparent()
+    if parent is None or parent.tag != 'dataSource':
+      continue
+    yield {col.get('varName'): col.text or '' for col in row}
+    row.clear()
+    while row.getprevious() is not None:
+      del parent[0]
+
 def taskWasSuccessfull(task) -> bool:
   if task['task']['@succeeded'] == "True":
     return True
@@ -92,20 +184,39 @@ def getTaskResultURL(task) -> str:
     return result['result']['@url']
   return ErrorHandler().getError(errorName="TASKNOTSUCCEEDED")
 
-def removeTimelineTags(docXML: str, verbose: bool = False):
-  doc = BeautifulSoup(docXML, 'xml')
-  #if verbose: print(f"Size of doc before: {len(str(doc))}")
-  doc = _stripTimelineTag(doc=doc, verbose=verbose)
-  #if verbose: print(f"Size of doc after: {len(newDoc)}")
-  return doc
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
 
-def _stripTimelineTag(doc, verbose: bool = False):
-  if doc.timeline is not None:
-    if verbose: print("Found some timeline tags, stripping them")
-    doc.timeline.decompose()
-  snippets = doc.find_all('item', attrs={'snippetDocXML':True})
+_timelineParser = XMLParser(huge_tree=True)
 
-  for snippet in snippets:
+def removeTimelineTags(docXML, verbose: bool = False) -> str:
+  """Removes the first <timeline> node of the document and of every snippet document in a snippetDocXML attribute.
+  The result starts with an XML declaration, like the snippets inside of it.
+
+  :param docXML: Document XML as str or bytes
+  """
+  if isinstance(docXML, str): docXML = docXML.encode('utf-8')
+  root = fromstring(docXML, parser=_timelineParser)
+  _stripTimelineTag(root=root, verbose=verbose)
+  return XML_DECLARATION + tostring(root.getroottree(), encoding='unicode')
+
+def _stripTimelineTag(root, verbose: bool = False):
+  timeline = next(root.iterdescendants('timeline'), None)
+  if timeline is not None:
+    if verbose: print("Found some timeline tags, stripping them")
+    # The text after the node belongs to the node in lxml, keep it
+    parent = timeline.getparent()
+    previous = timeline.getprevious()
+    if timeline.tail:
+      if previous is not None: previous.tail = (previous.tail or '') + timeline.tail
+      else: parent.text = (parent.text or '') + timeline.tail
+    parent.remove(timeline)
+
+  for snippet in root.iter('item'):
+    snippetXML = snippet.get('snippetDocXML')
+    if snippetXML is None:
+      continue
     if verbose: print("Found a snippet, checking for tags in there")
-    snippet['snippetDocXML'] = _stripTimelineTag(BeautifulSoup(snippet['snippetDocXML'], 'xml'), verbose=verbose)
-  return str(doc)
\ No newline at end of file
+    try:
+      snippet.set('snippetDocXML', removeTimelineTags(snippetXML, verbose=verbose))
+    except XMLSyntaxError:
+      if verbose: print("The snippet is not valid XML, leaving it as is")